@@ -0,0 +1,120 @@
+"""
+Age groups for aggregated records.
+
+A patient's age group depends only on their birth date and the date their age is measured at, and a
+jurisdiction has a few tens of thousands of distinct birth dates against any number of Immunizations.
+`AgeGrouper` therefore parses each distinct birth date once and labels each distinct (birth date,
+reference date) pair once, instead of parsing dates and reading the clock for every record.
+
+- Reference date (`AGE_REFERENCE_DATE`): `now` measures ages at the start of each aggregation (the
+  default); `occurrence` at the end of the Immunization's occurrence year, i.e. its `ReferenceDate`,
+  which makes results reproducible from run to run; or a fixed `YYYY-MM-DD`.
+- Bands (`AGE_BANDS`): empty for one group per year of age (`1 year`, `2 years`, ...); or ranges of
+  years such as `0-1,2-4,5-11,12-17,18+`, labelled as written, with ages outside every band as `Other`.
+"""
+
+from datetime import date, datetime, timedelta
+from itertools import count
+
+
+def parse_age_bands(spec):
+    """Parse `AGE_BANDS` into `(lowest age, highest age or None, label)` tuples; raises `ValueError` if malformed."""
+    bands = []
+    for label in (band.strip() for band in spec.split(",")):
+        if not label:
+            continue
+        if label.endswith("+"):
+            bands.append((int(label[:-1]), None, label))
+        else:
+            low, _, high = label.partition("-")
+            bands.append((int(low), int(high or low), label))
+    return bands
+
+
+def birth_date_range(low, high, reference_date):
+    """Birth dates `(after, until]` of people aged `low` to `high` years (`None`: no limit) at `reference_date`.
+
+    Ages are counted as `AgeGrouper` counts them, in whole 365-day years. `after` is `None` without an upper age.
+    """
+    until = reference_date - timedelta(days=365 * low)
+    after = reference_date - timedelta(days=365 * (high + 1)) if high is not None else None
+    return after, until
+
+
+def parse_age_reference(spec):
+    """Parse `AGE_REFERENCE_DATE` into `now`, `occurrence` or a `date`; raises `ValueError` if malformed."""
+    spec = spec.strip().lower()
+    if spec in ("now", "occurrence"):
+        return spec
+    return datetime.strptime(spec, "%Y-%m-%d").date()
+
+
+class AgeGrouper:
+    """Labels birth dates with age groups, memoizing parsed birth dates and labels."""
+
+    def __init__(self, bands=None, reference="now"):
+        self.bands = bands or []
+        self.reference = reference
+        self.today = date.today()
+        self.birth_dates = {}
+        self.labels = {}
+
+    def reset(self, today=None):
+        """Start a new aggregation: measure `now` ages at `today` (default: the current date)."""
+        self.today = today or date.today()
+        self.labels.clear()
+
+    def get_reference_date(self, occurrence_year):
+        if self.reference == "now":
+            return self.today
+        if self.reference == "occurrence":
+            return date(int(occurrence_year), 12, 31) if occurrence_year.isdigit() else None
+        return self.reference
+
+    def iter_age_ranges(self):
+        """`(label, lowest age, highest age or None)` of each age group in ascending order, `AGE_BANDS` or one per year.
+
+        Without bands the groups go on forever; `Unknown` and `Other` are what these ranges leave out.
+        Raises `ValueError` if bands overlap, since an age would then only count towards the first.
+        """
+        if not self.bands:
+            yield "1 year", 0, 1
+            yield from ((f"{age} years", age, age) for age in count(2))
+            return
+
+        bands = sorted(self.bands, key=lambda band: band[0])
+        for (_, high, label), (next_low, _, next_label) in zip(bands, bands[1:]):
+            if high is None or high >= next_low:
+                raise ValueError(f"Age bands {label} and {next_label} overlap")
+        for low, high, label in bands:
+            yield label, low, high
+
+    def parse_birth_date(self, birth_date):
+        if birth_date not in self.birth_dates:
+            try:
+                self.birth_dates[birth_date] = datetime.strptime(birth_date, "%Y-%m-%d").date()
+            except ValueError:
+                self.birth_dates[birth_date] = None
+        return self.birth_dates[birth_date]
+
+    def label(self, birth_date, occurrence_year="Unknown"):
+        """Age group of a patient born on `birth_date` (`YYYY-MM-DD`), for an Immunization in `occurrence_year`."""
+        reference_date = self.get_reference_date(occurrence_year)
+        key = (birth_date, reference_date)
+        label = self.labels.get(key)
+        if label is None:
+            label = self.labels[key] = self.compute_label(birth_date, reference_date)
+        return label
+
+    def compute_label(self, birth_date, reference_date):
+        born = self.parse_birth_date(birth_date) if birth_date else None
+        if born is None or reference_date is None or born > reference_date:
+            return "Unknown"
+
+        age = (reference_date - born).days // 365
+        if not self.bands:
+            return "1 year" if age <= 1 else f"{age} years"
+        for low, high, label in self.bands:
+            if low <= age and (high is None or age <= high):
+                return label
+        return "Other"
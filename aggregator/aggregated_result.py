@@ -0,0 +1,142 @@
+"""
+Completed aggregation results and the lookup structures built from them.
+
+An `AggregatedResult` is built once per aggregation and then only read, by any number of request
+threads. It holds:
+- the finest-grain records (one per OccurrenceYear × Jurisdiction × Sex × Age × Dose);
+- a rollup cube: the records summed over every subset of those dimensions, with `ALL` in place of the
+  rolled-up values, so consumers can ask for exactly the grain they need. It holds all 2^5 = 32 rollups,
+  keyed by the set of dimensions each keeps; `group_by` selects one, and the finest grain is the records
+  themselves. `ReferenceDate` is kept only where `OccurrenceYear` is, since it depends on the year;
+- per-dimension posting lists over every rollup (the row positions holding each value of each column),
+  so filtered requests intersect a few small sets instead of scanning or recomputing the result. Filters
+  on dimensions the `group_by` rollup keeps use its own posting lists; a filter on a rolled-up dimension
+  is applied to the finest grain, and only the matching rows are rolled up to the `group_by` grain;
+- a hash of its content, for `ETag`s, and each rollup's encoded (and gzipped) bodies, each built the
+  first time it is requested and then reused until the next aggregation.
+"""
+
+import hashlib
+import threading
+from collections import defaultdict
+from itertools import combinations
+
+from result_encodings import encode
+
+# Dimensions `/aggregated-data` can be grouped and filtered on, in output order
+DIMENSIONS = ("OccurrenceYear", "Jurisdiction", "Sex", "Age", "Dose")
+
+# Value of a dimension that has been rolled up
+ALL = "ALL"
+
+
+class IndexedRows:
+    """Aggregated rows plus, for each dimension, the positions of the rows holding each value."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.postings = {dimension: defaultdict(list) for dimension in DIMENSIONS}
+        for position, row in enumerate(rows):
+            for dimension in DIMENSIONS:
+                self.postings[dimension][row[dimension]].append(position)
+
+    def filter(self, values=None, year_from=None, year_to=None):
+        """Rows matching every given filter, in their original order.
+
+        `values` maps a dimension to the set of values to keep. `year_from`/`year_to` bound OccurrenceYear
+        inclusively; rows with an "Unknown" year are excluded once either bound is set. The rows returned
+        are these rows themselves, not copies.
+        """
+        position_sets = [
+            self.positions_with(dimension, allowed)
+            for dimension, allowed in (values or {}).items()
+        ]
+        if year_from is not None or year_to is not None:
+            years = [
+                year for year in self.postings["OccurrenceYear"]
+                if year.isnumeric()
+                and (year_from is None or int(year) >= year_from)
+                and (year_to is None or int(year) <= year_to)
+            ]
+            position_sets.append(self.positions_with("OccurrenceYear", years))
+
+        if not position_sets:
+            return self.rows
+
+        # Intersect starting from the smallest set, so the work is bounded by the most selective filter
+        position_sets.sort(key=len)
+        positions = position_sets[0].intersection(*position_sets[1:])
+        return [self.rows[position] for position in sorted(positions)]
+
+    def positions_with(self, dimension, allowed):
+        """Positions of the rows whose `dimension` holds any of the `allowed` values."""
+        postings = self.postings[dimension]
+        return set().union(*(postings.get(value, ()) for value in allowed))
+
+
+def roll_up(records, group_by):
+    """Sum `records` over the dimensions not in `group_by`, which become `ALL`."""
+    counts = defaultdict(int)
+    reference_dates = {}
+    for record in records:
+        key = tuple(record[dimension] if dimension in group_by else ALL for dimension in DIMENSIONS)
+        counts[key] += record["Count"]
+        reference_dates[key] = record["ReferenceDate"] if "OccurrenceYear" in group_by else ALL
+
+    return [
+        {**dict(zip(DIMENSIONS, key)), "Count": count, "ReferenceDate": reference_dates[key]}
+        for key, count in sorted(counts.items())
+    ]
+
+
+class AggregatedResult:
+    """One finished aggregation: its records, when it was computed, and its indexed rollup cube.
+
+    `complete` is `False` for a partial aggregation, counted from only some of the Immunizations.
+    `version` is its number in the snapshot history (see `snapshot_history.py`), once recorded there.
+    """
+
+    def __init__(self, records, aggregated_at, complete=True):
+        self.records = records
+        self.aggregated_at = aggregated_at
+        self.complete = complete
+        self.version = None
+
+        # All 2^5 rollups, keyed by the frozenset of dimensions they keep; the full set is `records` itself
+        self.cube = {frozenset(DIMENSIONS): IndexedRows(records)}
+        for size in range(len(DIMENSIONS)):
+            for group_by in combinations(DIMENSIONS, size):
+                self.cube[frozenset(group_by)] = IndexedRows(roll_up(records, group_by))
+
+        # The default response is encoded up front; it also identifies the content, so an aggregation that
+        # changes nothing keeps the same hash (and `ETag`)
+        self.bodies = {}
+        self.bodies_lock = threading.Lock()
+        self.content_hash = hashlib.sha256(self.body()).hexdigest()
+        self.body(compressed=True)
+
+    def body(self, group_by=DIMENSIONS, output_format="json", compressed=False):
+        """The unfiltered `group_by` rollup encoded as `output_format` (see `result_encodings.encode`), built once."""
+        key = (frozenset(group_by), output_format, compressed)
+        with self.bodies_lock:
+            if key not in self.bodies:
+                self.bodies[key] = encode(self.cube[key[0]].rows, output_format, compressed)
+            return self.bodies[key]
+
+    def filter(self, values=None, year_from=None, year_to=None, group_by=DIMENSIONS):
+        """Records at the `group_by` grain matching the given filters (see `IndexedRows.filter`).
+
+        Filters on dimensions kept by `group_by` are answered from that rollup's posting lists. Filtering
+        on a rolled-up dimension (e.g. totals per year for one sex) filters the finest grain and rolls
+        the matches up, which only touches the matching rows.
+        """
+        group_by = frozenset(group_by)
+        filtered_dimensions = set(values or {})
+        if year_from is not None or year_to is not None:
+            filtered_dimensions.add("OccurrenceYear")
+
+        if filtered_dimensions <= group_by:
+            return self.cube[group_by].filter(values, year_from, year_to)
+
+        matches = self.cube[frozenset(DIMENSIONS)].filter(values, year_from, year_to)
+        return roll_up(matches, group_by)
@@ -9,55 +9,147 @@ various attributes and returned as a JSON response.
 
 ### 1. **Environment Variables Setup**:
    - `FHIR_URL`: The base URL of the FHIR server (default: `http://localhost:8080/fhir`).
-   - `AGGREGATION_INTERVAL`: Time interval (in seconds) for caching aggregated data.
-   - `PUBLIC_KEY_PATH`: Path to the public key used for JWT validation.
+   - `AGGREGATION_INTERVAL`: Time interval (in seconds) between background aggregation refreshes.
+   - `FIRST_RESULT_WAIT`: Seconds a worker with no result yet waits for its first aggregation before answering `503`
+     (default: `5`).
+   - `PUBLIC_KEY_PATH`: Path to the public key used for JWT validation, re-read when it changes (checked every
+     `PUBLIC_KEY_RELOAD_INTERVAL` seconds, default: `10`).
+   - `JWT_CACHE_SIZE`: Number of verified tokens remembered until they expire (default: `1024`; see `token_verifier.py`).
    - `IS_LOCAL_DEV`: Boolean flag to disable authentication for local development.
+   - `PATIENT_BATCH_SIZE`: Number of Patient ids resolved per batched search (default: `500`).
+   - `PATIENT_FETCH_MODE`: `batch` (default) or `include` to fetch Patients with `_include=Immunization:patient`.
+   - `FHIR_ELEMENTS_PROJECTION`: Boolean flag (default: `true`) to request only the needed elements with `_elements`.
+   - `FHIR_PREFETCH_PAGES`: Number of Immunization pages fetched ahead of processing (default: `2`, `0` disables).
+   - `FHIR_POOL_SIZE`, `FHIR_RETRIES`, `FHIR_RETRY_BACKOFF`: Connection pool size, and retries (with backoff in seconds)
+     on 429/5xx responses, for FHIR requests.
+   - `FHIR_FETCH_ENGINE`: `requests` (default, blocking) or `async` (an `httpx` client on an event-loop thread, which
+     sends independent requests concurrently); `FHIR_CONCURRENCY` caps its requests in flight, and count mode's
+     (default: `16`).
+   - `FHIR_PAGE_RETRIES`, `FHIR_PAGE_RETRY_BACKOFF`: Further attempts at a search page once those retries are spent
+     (default: `3`, backing off from `2` seconds), before the walk stops and the aggregation is marked partial.
+   - `AGGREGATION_RESUME_INTERVAL`: Seconds before a partial aggregation is resumed from its checkpoint (default: `30`).
+   - `AGGREGATION_CHECKPOINT_TTL`: Age (in seconds) past which a checkpoint is dropped and the walk starts over
+     (default: `3600`).
+   - `INCREMENTAL_AGGREGATION`: Boolean flag to refresh aggregated data from `_lastUpdated` deltas.
+   - `INCREMENTAL_REBUILD_INTERVAL`: Time interval (in seconds) between full rebuilds in incremental mode.
+   - `SHARED_CACHE_BACKEND`: `memory` (default, per worker), `sqlite` or `redis` to share results, patients and
+     the refresh lock between gunicorn workers (see `cache_backends.py` and the `SHARED_*`/`REDIS_*` variables).
+   - `PATIENT_CACHE_MEMORY_MB`: Approximate memory budget of the patient cache (default: `64`).
+   - `PATIENT_INDEX_PATH`: SQLite file for the persistent patient index (default: empty, disabled).
+   - `SNAPSHOT_HISTORY_PATH`, `SNAPSHOT_HISTORY_SIZE`: SQLite file of the versioned result history behind
+     `?since=<version>` (default: `/tmp/aggregator-snapshots.sqlite3`, shared by a pod's workers; the deployments
+     mount a volume for it), and the number of versions kept (default: `100`).
+   - `AGE_BANDS`: Comma-separated age bands such as `0-1,2-4,5-11,12-17,18+` (default: empty, one group per year).
+   - `AGE_REFERENCE_DATE`: `now` (default), `occurrence` (the end of the occurrence year, i.e. `ReferenceDate`) or a
+     fixed `YYYY-MM-DD` date to measure ages at.
+   - `FHIR_PARTITIONS`: Number of Immunization slices fetched and counted in parallel (default: `1`, a single walk).
+   - `FHIR_PARTITION_BY`: `date` (default, ranges of occurrence years) or `lastupdated` (`_lastUpdated` windows).
+   - `FHIR_INGESTION_MODE`: `search` (default, paged searches), `bulk` (Bulk Data `$export`), `ndjson` (the
+     NDJSON files in `NDJSON_DIRECTORY`; see `bulk_export.py`) or `count` (`_summary=count` searches per group,
+     see `count_pushdown.py`).
+   - `COUNT_DOSE_PARAMETER`, `COUNT_DOSES`, `COUNT_MAX_REQUESTS`: With `FHIR_INGESTION_MODE=count`, the Immunization
+     search parameter on the dose number (default: `dose-number`), the doses to count (default: `1,2`), and the most
+     searches an aggregation may make before falling back to downloading everything (default: `5000`).
+   - `BULK_EXPORT_POLL_INTERVAL`, `BULK_EXPORT_TIMEOUT`: Seconds between export status polls (unless the server
+     sends `Retry-After`), and to wait for an export before giving up.
+   - `PROMETHEUS_MULTIPROC_DIR`: Directory where gunicorn workers share Prometheus samples (set in the image).
 
 ### 2. **Flask API Initialization**:
    - Initializes a Flask application to serve aggregated immunization data.
-   - Supports **synchronous** data processing for stability.
+   - Aggregation runs on a **background refresh thread**, never on the request thread.
 
 ### 3. **Logging and Caching**:
    - Configures structured logging for debugging and monitoring.
-   - Implements an **LRU cache** for patient data retrieval to reduce redundant FHIR API calls.
+   - Implements an **LRU cache** for patient data retrieval to reduce redundant FHIR API calls. It holds only
+     each Patient's gender, birth date and version (`patient_cache.py`), bounded by `PATIENT_CACHE_MEMORY_MB`.
    - Uses an **in-memory cache** for aggregated data to avoid unnecessary recalculations.
+   - Refreshes it in the background (**stale-while-revalidate**), with a **single-flight** lock so only one
+     aggregation runs at a time per process, and a shared lock so only one worker computes when a shared
+     cache backend is configured; the others serve the result it publishes.
 
 ### 4. **FHIR Resource Fetching**:
+   - Every request goes through one transport (`fhir_transport.py`): a keep-alive connection pool of
+     `FHIR_POOL_SIZE`, `gzip` responses, `orjson` decoding when available, and retries with backoff on 429/5xx.
+     With `FHIR_FETCH_ENGINE=async` it is an `AsyncFhirTransport`, which runs requests on its own event loop,
+     at most `FHIR_CONCURRENCY` at a time; a refresh request cancels the requests of a refresh in progress.
    - `fetch_fhir_resources(resource_type)`: Retrieves **FHIR resources** synchronously (e.g., Immunization, Patient).
+   - `iter_fhir_resources(resource_type)`: Streams them **page by page** instead, so memory is bounded by page size.
    - **Handles pagination** safely to retrieve complete datasets.
+   - Requests only the elements aggregation reads (`_elements`), unless `FHIR_ELEMENTS_PROJECTION=false`.
+   - `prefetch_pages(pages, depth)`: Fetches up to `FHIR_PREFETCH_PAGES` Immunization pages ahead on a background
+     thread, so downloading the next page overlaps with processing the current one.
    - Implements **error handling** for network failures and malformed responses.
+   - With `FHIR_PARTITIONS` above 1, `count_checkpointed_immunization_records()` splits the Immunizations into
+     disjoint slices (`get_partition_searches`) and walks each slice's pages on its own thread, summing the
+     partial counts into the same result as a single walk.
+   - A page that still fails after retries raises `FhirPagingError` instead of ending the walk as if it were
+     done. Each walk's cursor and counts are checkpointed after every page (`AggregationCheckpoint`), so the
+     aggregation is published as **partial** (`X-Aggregation-Complete: false`) only if there is no complete
+     result to keep serving, and the next refresh resumes from the failed page rather than starting over.
+   - With `FHIR_INGESTION_MODE=bulk`, a full aggregation reads a Bulk Data `$export` instead: kick-off, status
+     polling, then the Patient and Immunization NDJSON files streamed line by line (`iter_bulk_immunization_records`),
+     joining Immunizations against an index built from the Patient file. `FHIR_INGESTION_MODE=ndjson` reads the
+     same files from `NDJSON_DIRECTORY`, for offline runs.
 
 ### 5. **Patient Data Caching**:
+   - `fetch_patients_batch(patient_ids)`:
+     - Resolves the distinct patients referenced on each Immunization page in **bulk**
+       (`Patient/_search?_id=a,b,c,...`, `PATIENT_BATCH_SIZE` ids per search).
+     - Fills the **LRU cache** so record processing rarely needs a per-patient request.
+   - With `PATIENT_FETCH_MODE=include`, Immunization pages are requested with `_include=Immunization:patient`
+     and joined against the Patients they carry; anything not included falls back to the batched lookup.
    - `fetch_patient_data(patient_reference)`:  
      - Fetches **FHIR Patient resource** synchronously.
-     - Uses an **LRU cache** to minimize duplicate API calls.
+     - Uses an **LRU cache** to minimize duplicate API calls, backed by the shared cache backend.
+   - With `PATIENT_INDEX_PATH` set, patient summaries also persist in a **SQLite index** on a mounted volume, so a
+     restarted pod doesn't re-fetch every Patient. `revalidate_persistent_patient_index()` keeps it current with one
+     `Patient?_lastUpdated=gt<watermark>` search per refresh.
 
 ### 6. **Processing Immunization Records**:
    - `process_immunization_record(immunization)`:  
      - Extracts structured attributes from **FHIR Immunization records**:
        - **Jurisdiction** (`BC` or `ON`) based on `FHIR_URL`.
        - **Occurrence year**, **patient sex**, and **age group**.
-     - Uses `calculate_age_group(birth_date)` to categorize patients into predefined **age groups**.
+     - Uses `calculate_age_group(birth_date, occurrence_year)` to categorize patients into **age groups**: one per
+       year of age by default, or the `AGE_BANDS` ranges. Ages are measured at `AGE_REFERENCE_DATE`, and each
+       distinct birth date is parsed and labelled once (`age_groups.py`).
      - Ensures missing fields **do not cause failures** by applying default values.
 
 ### 7. **Data Aggregation**:
    - `aggregate_data()`:  
-     - Fetches **FHIR Immunization records**.
-     - **Groups and counts records** by:
+     - Streams **FHIR Immunization records**, counting each page's records as it arrives.
+     - **Groups and counts records** (a `Counter` over group-key tuples, no DataFrame) by:
        - `OccurrenceYear`
        - `Jurisdiction`
        - `Sex`
        - `Age`
        - `Dose`
      - Ensures `ReferenceDate` is **always December 31st** of the `OccurrenceYear`.
+   - `refresh_incremental_aggregation()` (`INCREMENTAL_AGGREGATION=true`):
+     - Keeps **running group counts** and a per-Immunization contribution index (id → versionId, group).
+     - Each refresh fetches only `Immunization?_lastUpdated=gt<watermark>` plus deletes from `_history`,
+       applying them as **count deltas**; a full rebuild runs every `INCREMENTAL_REBUILD_INTERVAL` seconds.
 
 ### 8. **API Endpoints**:
    - `GET /aggregated-data`:
-     - Returns aggregated immunization data.
-     - Uses caching to **improve response time**.
+     - Returns the last completed aggregation immediately, with its age in the `X-Aggregation-Age` header.
+     - Optional filters (`year_from`, `year_to`, `jurisdiction`, `sex`, `age`, `dose`) are served from
+       per-dimension posting lists built once per aggregation (`aggregated_result.py`).
+     - `group_by` selects one of the 2^5 rollups precomputed per aggregation, with `ALL` for rolled-up
+       dimensions.
+     - `format=json|csv|arrow|parquet`, gzipped for clients that accept it; unfiltered bodies are encoded
+       once per aggregation. An `ETag` of the content and query answers `If-None-Match` with `304`.
+     - Every distinct result gets a version (`X-Aggregation-Version`, see `snapshot_history.py`), and
+       `since=<version>` returns only the rows changed and removed since that version.
      - Requires **JWT authentication** unless `IS_LOCAL_DEV = true`.
+   - `POST /aggregated-data/refresh`:
+     - Requests a background refresh ahead of the next `AGGREGATION_INTERVAL`.
+   - `GET /metrics`:
+     - **Prometheus metrics**: FHIR page, Patient fetch and aggregation latency histograms, records
+       processed/dropped and patient cache hit/miss/eviction counters, and the served result's age.
    - `GET /health`:  
-     - **Health check endpoint** to verify API availability.
+     - **Health check endpoint** to verify API availability; also reports patient cache hits/misses/evictions
+       and FHIR request counts and timings.
 
 ### 9. **Security & JWT Authentication**:
    - **JWT verification** is enforced in production.
@@ -77,13 +169,33 @@ various attributes and returned as a JSON response.
 """
 
 import requests
-import pandas as pd
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from operator import itemgetter
+from urllib.parse import quote
+import hashlib
 import logging
 import os
-from cachetools import LRUCache
-import jwt
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+from age_groups import AgeGrouper, parse_age_bands, parse_age_reference
+from aggregated_result import DIMENSIONS, AggregatedResult
+from bulk_export import BulkExport, NdjsonDirectory
+from count_pushdown import CountBudgetExceeded, CountPlan, StaleCountPlan
+from cache_backends import create_cache_backend
+from fhir_transport import FetchCancelled, create_fhir_transport
+from patient_cache import PatientCache, PatientSummary
+from patient_index import PatientIndex
+from result_encodings import FORMATS, encode
+from snapshot_history import SnapshotHistory
+from token_verifier import TokenVerifier
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -94,118 +206,443 @@ app = Flask(__name__)
 # Environment variables
 FHIR_URL = os.getenv("FHIR_URL", "http://localhost:8080/fhir")
 AGGREGATION_INTERVAL = int(os.getenv("AGGREGATION_INTERVAL", 60))  # Default to 60 seconds
+FIRST_RESULT_WAIT = int(os.getenv("FIRST_RESULT_WAIT", 5))  # Seconds a cold worker waits for its first result
 IS_LOCAL_DEV = os.getenv("IS_LOCAL_DEV", "false").lower() == "true"
 PUBLIC_KEY_PATH = os.getenv("PUBLIC_KEY_PATH", "/secrets/public_key.pem")
+PUBLIC_KEY_RELOAD_INTERVAL = int(os.getenv("PUBLIC_KEY_RELOAD_INTERVAL", 10))  # Seconds between key file change checks
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", 1024))  # Verified tokens remembered until they expire
+PATIENT_BATCH_SIZE = int(os.getenv("PATIENT_BATCH_SIZE", 500))  # Patient ids per `_id` search
+PATIENT_FETCH_MODE = os.getenv("PATIENT_FETCH_MODE", "batch").lower()  # "batch" or "include"
+FHIR_ELEMENTS_PROJECTION = os.getenv("FHIR_ELEMENTS_PROJECTION", "true").lower() == "true"
+FHIR_PREFETCH_PAGES = int(os.getenv("FHIR_PREFETCH_PAGES", 2))  # Immunization pages fetched ahead, 0 to disable
+FHIR_POOL_SIZE = int(os.getenv("FHIR_POOL_SIZE", 10))  # Keep-alive connections, at least the number of concurrent fetches
+FHIR_FETCH_ENGINE = os.getenv("FHIR_FETCH_ENGINE", "requests").lower()  # "requests" or "async"
+FHIR_CONCURRENCY = int(os.getenv("FHIR_CONCURRENCY", 16))  # Requests in flight at once with the async engine or count mode
+FHIR_RETRIES = int(os.getenv("FHIR_RETRIES", 3))  # Retries on 429/5xx and connection errors
+FHIR_RETRY_BACKOFF = float(os.getenv("FHIR_RETRY_BACKOFF", 0.5))  # Seconds, doubled on each retry
+FHIR_PAGE_RETRIES = int(os.getenv("FHIR_PAGE_RETRIES", 3))  # Further attempts at a page once the transport gives up
+FHIR_PAGE_RETRY_BACKOFF = float(os.getenv("FHIR_PAGE_RETRY_BACKOFF", 2))  # Seconds, doubled on each page retry
+AGGREGATION_RESUME_INTERVAL = int(os.getenv("AGGREGATION_RESUME_INTERVAL", 30))  # Seconds before resuming a partial walk
+AGGREGATION_CHECKPOINT_TTL = int(os.getenv("AGGREGATION_CHECKPOINT_TTL", 3600))  # Oldest checkpoint worth resuming
+INCREMENTAL_AGGREGATION = os.getenv("INCREMENTAL_AGGREGATION", "false").lower() == "true"
+INCREMENTAL_REBUILD_INTERVAL = int(os.getenv("INCREMENTAL_REBUILD_INTERVAL", 86400))  # Default to daily
+SHARED_CACHE_BACKEND = os.getenv("SHARED_CACHE_BACKEND", "memory").lower()  # "memory", "sqlite" or "redis"
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "/tmp/aggregator-cache.sqlite3")
+SHARED_CACHE_POLL_INTERVAL = int(os.getenv("SHARED_CACHE_POLL_INTERVAL", 5))
+SHARED_PATIENT_TTL = int(os.getenv("SHARED_PATIENT_TTL", 86400))
+SHARED_LOCK_TIMEOUT = int(os.getenv("SHARED_LOCK_TIMEOUT", 900))  # Frees the lock if its holder dies mid-aggregation
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+PATIENT_CACHE_MEMORY_MB = int(os.getenv("PATIENT_CACHE_MEMORY_MB", 64))  # Memory budget of the patient cache
+PATIENT_INDEX_PATH = os.getenv("PATIENT_INDEX_PATH", "")  # SQLite file for the persistent patient index, empty to disable
+SNAPSHOT_HISTORY_PATH = os.getenv("SNAPSHOT_HISTORY_PATH", "/tmp/aggregator-snapshots.sqlite3")  # Versioned result history
+SNAPSHOT_HISTORY_SIZE = int(os.getenv("SNAPSHOT_HISTORY_SIZE", 100))  # Versions `since` can catch up from
+FHIR_INGESTION_MODE = os.getenv("FHIR_INGESTION_MODE", "search").lower()  # "search", "bulk", "ndjson" or "count"
+COUNT_DOSE_PARAMETER = os.getenv("COUNT_DOSE_PARAMETER", "dose-number")  # Custom SearchParameter on protocolApplied.doseNumber
+COUNT_DOSES = [int(dose) for dose in os.getenv("COUNT_DOSES", "1,2").split(",") if dose.strip()]  # Doses counted separately
+COUNT_MAX_REQUESTS = int(os.getenv("COUNT_MAX_REQUESTS", 5000))  # `_summary=count` searches per aggregation at most
+NDJSON_DIRECTORY = os.getenv("NDJSON_DIRECTORY", "")  # Source of `FHIR_INGESTION_MODE=ndjson`
+BULK_EXPORT_POLL_INTERVAL = int(os.getenv("BULK_EXPORT_POLL_INTERVAL", 5))  # Seconds, when the server sends no Retry-After
+BULK_EXPORT_TIMEOUT = int(os.getenv("BULK_EXPORT_TIMEOUT", 3600))  # Seconds to wait for an export to complete
+AGE_BANDS = os.getenv("AGE_BANDS", "")  # e.g. "0-1,2-4,5-11,12-17,18+"; empty for one group per year of age
+AGE_REFERENCE_DATE = os.getenv("AGE_REFERENCE_DATE", "now")  # "now", "occurrence" or a fixed YYYY-MM-DD
+FHIR_PARTITIONS = int(os.getenv("FHIR_PARTITIONS", 1))  # Immunization slices fetched in parallel, 1 for a single walk
+FHIR_PARTITION_BY = os.getenv("FHIR_PARTITION_BY", "date").lower()  # "date" (occurrence years) or "lastupdated"
 
-def load_public_key():
-    """Loads the public key from the mounted secret synchronously."""
-    try:
-        with open(PUBLIC_KEY_PATH, "r") as key_file:
-            public_key = key_file.read().strip()
-            if not public_key:
-                raise ValueError("Public key file is empty!")
-            return public_key
-    except (FileNotFoundError, ValueError) as e:
-        if IS_LOCAL_DEV:
-            logging.error(f"Error loading public key: {e}")
-            return None
-        else:
-            raise e
+# Elements of each resource that aggregation reads (`id` and `meta` are always returned)
+IMMUNIZATION_ELEMENTS = ("patient", "occurrenceDateTime", "protocolApplied")
+PATIENT_ELEMENTS = ("gender", "birthDate")
+
+# Columns aggregated records are grouped by, in output order
+GROUP_COLUMNS = ("OccurrenceYear", "Jurisdiction", "Sex", "Age", "Dose")
 
-PUBLIC_KEY = load_public_key()
-is_auth_required = not IS_LOCAL_DEV or (IS_LOCAL_DEV and PUBLIC_KEY is not None)
+# Parsed public key, reloaded when the mounted secret rotates, and the tokens it has verified
+token_verifier = TokenVerifier(
+    PUBLIC_KEY_PATH, required=not IS_LOCAL_DEV, max_tokens=JWT_CACHE_SIZE, reload_interval=PUBLIC_KEY_RELOAD_INTERVAL
+)
 
 # Cache variables for aggregation
-cached_data = None
-last_aggregation_time = None
+cached_result = None  # AggregatedResult of the last completed aggregation
+
+# Background refresh state; `refresh_lock` makes sure only one aggregation runs at a time per process
+refresh_lock = threading.Lock()
+refresh_requested = threading.Event()
+first_refresh_done = threading.Event()
+refresh_scheduler = None
+refresh_scheduler_lock = threading.Lock()
+
+# Pooled, gzip-negotiating, retrying HTTP client used for every FHIR request
+# Each partition can have a page prefetch and a Patient search in flight at once, and count mode runs
+# up to `FHIR_CONCURRENCY` searches at a time
+fhir_transport = create_fhir_transport(
+    FHIR_FETCH_ENGINE,
+    pool_size=max(FHIR_POOL_SIZE, 2 * FHIR_PARTITIONS, FHIR_CONCURRENCY if FHIR_INGESTION_MODE == "count" else 0),
+    concurrency=FHIR_CONCURRENCY,
+    retries=FHIR_RETRIES,
+    backoff_factor=FHIR_RETRY_BACKOFF,
+)
+
+# Memoized age groups; `reset()` at the start of every aggregation
+age_grouper = AgeGrouper(parse_age_bands(AGE_BANDS), parse_age_reference(AGE_REFERENCE_DATE))
 
-# Patient cache with LRU eviction policy
-patient_cache = LRUCache(maxsize=1000)
+# Patient cache with LRU eviction policy, holding only the fields aggregation uses
+patient_cache = PatientCache(max_bytes=PATIENT_CACHE_MEMORY_MB * 1024 * 1024)
+
+# Patient summaries persisted across restarts, revalidated at the start of each refresh
+persistent_patient_index = PatientIndex(PATIENT_INDEX_PATH) if PATIENT_INDEX_PATH else None
+
+# Versions of the results served, and each one's changes from the version before, for `?since=<version>`
+snapshot_history = SnapshotHistory(SNAPSHOT_HISTORY_PATH, max_versions=SNAPSHOT_HISTORY_SIZE)
+
+# Result, patient and lock storage shared by the gunicorn workers (per-process with the default "memory" backend)
+cache_backend = create_cache_backend(
+    SHARED_CACHE_BACKEND,
+    path=SHARED_CACHE_PATH,
+    redis_host=REDIS_HOST,
+    redis_port=REDIS_PORT,
+    redis_password=REDIS_PASSWORD,
+    namespace="bc" if "bc" in FHIR_URL.lower() else "on",
+    patient_ttl=SHARED_PATIENT_TTL,
+    lock_timeout=SHARED_LOCK_TIMEOUT,
+)
 
 def verify_jwt(token):
-    """Verifies JWT using the public key."""
-    if not PUBLIC_KEY:
-        logging.error("Public key is not loaded, cannot verify JWT!")
-        return None
+    """Verifies JWT using the public key; tokens already verified are answered from `token_verifier`'s cache."""
+    return token_verifier.verify(token)
+
+def request_fhir_page(url, data=None, elements=None):
+    """Request one FHIR search page, `POST`ing `data` if given, asking only for `elements` if given."""
+    if elements:
+        if data is not None:
+            data = {**data, "_elements": elements}
+        else:
+            url = f"{url}{'&' if '?' in url else '?'}_elements={elements}"
+    if data is not None:
+        return fhir_transport.post(url, data=data)
+    return fhir_transport.get(url)
+
+def request_projected(url, resource_type, data=None, elements=None):
+    """`request_fhir_page`, asked again without `_elements` if the server rejects it with a 400.
+
+    Returns the response and the `elements` to keep asking for: `None` once the server has rejected them.
+    """
+    response = request_fhir_page(url, data, elements)
+    if elements and response.status_code == 400:
+        logging.warning(f"FHIR server rejected _elements for {resource_type}, fetching full resources.")
+        return request_fhir_page(url, data), None
+    return response, elements
+
+class FhirPagingError(Exception):
+    """A search page could not be fetched, even after retries; `url` is the page to resume from."""
+
+    def __init__(self, message, url, retryable):
+        super().__init__(message)
+        self.url = url
+        self.retryable = retryable
+
+def get_next_page_url(page):
+    """The `next` link of a search Bundle, or `None` on the last page."""
+    return next((link["url"] for link in page.get("link", []) if link.get("relation") == "next"), None)
+
+def iter_fhir_pages(url, resource_type, data=None, elements=None):
+    """Yield each Bundle page of a FHIR search, following `next` links.
+
+    When `data` is given the first page is requested as a form-encoded `POST` (FHIR `_search`),
+    which keeps long parameter lists out of the URL; `next` links are always plain `GET`s.
+
+    When `elements` is given (and `FHIR_ELEMENTS_PROJECTION` is on) only those elements are requested
+    with `_elements`. A server that ignores `_elements` simply returns full resources; one that rejects
+    it gets the search again without it.
+
+    A page that still fails once the transport's own retries are spent is tried `FHIR_PAGE_RETRIES` more
+    times, backing off from `FHIR_PAGE_RETRY_BACKOFF` seconds, unless the server answered with a 4xx other
+    than 429. Then `FhirPagingError` is raised rather than ending the walk early as if it were complete.
+    """
+    elements = ",".join(elements) if elements and FHIR_ELEMENTS_PROJECTION else None
+    while url:
+        for attempt in range(FHIR_PAGE_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                response, elements = request_projected(url, resource_type, data, elements)
+                response.raise_for_status()
+                page = fhir_transport.decode_json(response)
+                break
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                retryable = status is None or status == 429 or status >= 500
+                logging.error(f"Error fetching {resource_type} data from FHIR server (attempt {attempt + 1}): {e}")
+                if not retryable or attempt == FHIR_PAGE_RETRIES:
+                    raise FhirPagingError(f"Could not fetch {resource_type} page {url}: {e}", url, retryable) from e
+                time.sleep(FHIR_PAGE_RETRY_BACKOFF * 2 ** attempt)
+
+        metrics.FHIR_PAGE_FETCH_SECONDS.labels(resource_type).observe(time.perf_counter() - started)
+        # `next` links already carry the first request's parameters
+        data = elements = None
+        yield page
+        url = get_next_page_url(page)
+
+def iter_fhir_searches(url, resource_type, searches, elements=None):
+    """Yield each Bundle page of several `_search`es of `url`, one form of parameters per search.
+
+    The first pages of all the searches are requested together with `fhir_transport.request_all`, which
+    with `FHIR_FETCH_ENGINE=async` sends them concurrently. A search whose first request failed is
+    fetched again through `iter_fhir_pages`, with its retries and `_elements` fallback, as are any
+    further pages.
+    """
+    projected = ",".join(elements) if elements and FHIR_ELEMENTS_PROJECTION else None
+    responses = fhir_transport.request_all([
+        ("POST", url, {"data": {**search, "_elements": projected} if projected else search}) for search in searches
+    ])
+    for search, response in zip(searches, responses):
+        page = None
+        if isinstance(response, requests.Response) and response.ok:
+            try:
+                page = fhir_transport.decode_json(response)
+            except requests.RequestException:
+                pass
+        if page is None:
+            yield from iter_fhir_pages(url, resource_type, data=search, elements=elements)
+            continue
+
+        yield page
+        next_url = get_next_page_url(page)
+        if next_url:
+            yield from iter_fhir_pages(next_url, resource_type)
+
+def prefetch_pages(pages, depth):
+    """Iterate `pages` on a background thread, keeping up to `depth` pages fetched ahead of the consumer.
+
+    Downloading and decoding the next page then overlaps with processing the current one. A `depth`
+    of 0 iterates `pages` on the calling thread instead.
+    """
+    if depth <= 0:
+        yield from pages
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Give up once the consumer has stopped iterating, rather than blocking on a full buffer forever
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(finished)
+
+    producer = threading.Thread(target=produce, name="fhir-page-prefetch", daemon=True)
+    producer.start()
     try:
-        return jwt.decode(token, PUBLIC_KEY, algorithms=["RS256"])
-    except jwt.ExpiredSignatureError:
-        logging.error("JWT has expired.")
-    except jwt.InvalidSignatureError:
-        logging.error("JWT signature verification failed!")
-    except jwt.DecodeError:
-        logging.error("JWT decode failed, invalid format!")
-    except Exception as e:
-        logging.error(f"Unexpected JWT error: {e}")
-    return None
+        while True:
+            item = buffer.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+def iter_fhir_resources(resource_type):
+    """Yield entries of the specified type from the FHIR server as each page arrives.
+
+    Only the page being consumed is held in memory, however many resources the search matches.
+    """
+    fetched_count = 0
+    for page in iter_fhir_pages(f"{FHIR_URL}/{resource_type}?_count=1000", resource_type):
+        entries = page.get("entry", [])
+        fetched_count += len(entries)
+        yield from entries
+
+    logging.info(f"Fetched {fetched_count} {resource_type} records.")
 
 def fetch_fhir_resources(resource_type):
     """Fetch resources of the specified type from the FHIR server, handling pagination."""
-    url = f"{FHIR_URL}/{resource_type}?_count=1000"
-    results = []
-    
-    while url:
+    return list(iter_fhir_resources(resource_type))
+
+def get_patient_id(patient_reference):
+    """Extract the logical Patient id from a reference such as `Patient/123`."""
+    return patient_reference.split("/")[-1]
+
+def load_stored_patients(patient_ids):
+    """Fill `patient_cache` from the persistent patient index, then the shared cache backend.
+
+    Returns the ids found in neither, which still need fetching from the FHIR server.
+    """
+    missing = list(patient_ids)
+
+    if persistent_patient_index is not None and missing:
+        indexed_patients = persistent_patient_index.get_many(missing)
+        for patient_id, summary in indexed_patients.items():
+            patient_cache[patient_id] = summary
+        missing = [patient_id for patient_id in missing if patient_id not in indexed_patients]
+
+    # Patients another worker already fetched
+    if missing:
+        shared_patients = cache_backend.get_patients(missing)
+        for patient_id, summary in shared_patients.items():
+            patient_cache[patient_id] = PatientSummary(**summary)
+        missing = [patient_id for patient_id in missing if patient_id not in shared_patients]
+
+    return missing
+
+def store_patients(summaries):
+    """Save freshly fetched `{patient id: PatientSummary}` to the persistent patient index and shared cache backend."""
+    if persistent_patient_index is not None:
+        persistent_patient_index.put_many(summaries)
+    cache_backend.set_patients({patient_id: summary.as_dict() for patient_id, summary in summaries.items()})
+
+def revalidate_persistent_patient_index():
+    """Bring the persistent patient index up to date with the Patients changed since its watermark.
+
+    One `Patient?_lastUpdated=gt<watermark>` search revalidates every stored summary at once. The new
+    watermark is the time the FHIR server ran that search (the search Bundle's `meta.lastUpdated`), so
+    changes made while it pages are picked up next time. A new index starts from a `_summary=count`
+    search, which costs one request and only establishes the watermark.
+    """
+    if persistent_patient_index is None:
+        return
+
+    watermark = persistent_patient_index.get_watermark()
+    if watermark is None:
+        url = f"{FHIR_URL}/Patient?_summary=count"
+    else:
+        url = f"{FHIR_URL}/Patient?_lastUpdated=gt{quote(watermark)}&_count=1000"
+
+    new_watermark = None
+    changed_patients = {}
+    try:
+        for page in iter_fhir_pages(url, "Patient", elements=PATIENT_ELEMENTS):
+            new_watermark = new_watermark or page.get("meta", {}).get("lastUpdated")
+            for entry in page.get("entry", []):
+                patient = entry.get("resource", {})
+                if patient.get("id"):
+                    changed_patients[patient["id"]] = PatientSummary.from_resource(patient)
+    except FhirPagingError as e:
+        # Keep what was revalidated, but not the watermark, so the rest is searched again next time
+        logging.error(f"Could not finish revalidating the persistent patient index: {e}")
+        new_watermark = None
+
+    if changed_patients:
+        persistent_patient_index.put_many(changed_patients)
+        for patient_id, summary in changed_patients.items():
+            if patient_id in patient_cache:
+                patient_cache[patient_id] = summary
+    if new_watermark:
+        persistent_patient_index.set_watermark(new_watermark)
+    logging.info(f"Revalidated persistent patient index: {len(changed_patients)} Patients changed since {watermark}.")
+
+def fetch_patients_batch(patient_ids):
+    """Resolve Patients in bulk, filling `patient_cache` with their summaries.
+
+    Ids already cached are skipped; the rest are looked up `PATIENT_BATCH_SIZE` at a time with
+    `Patient/_search?_id=a,b,c,...`, so a page of Immunizations costs a handful of round trips
+    instead of one per patient, sent concurrently with the async engine (see `iter_fhir_searches`).
+    Ids the server doesn't return, or whose search fails, are left for `fetch_patient_data`.
+    """
+    # `get` (unlike `in`) marks cached patients as recently used, so the inserts below can't evict them
+    missing = [patient_id for patient_id in dict.fromkeys(patient_ids) if patient_cache.get(patient_id) is None]
+    if not missing:
+        return
+
+    with metrics.PATIENT_FETCH_SECONDS.labels("batch").time():
+        missing = load_stored_patients(missing)
+
+        fetched_patients = {}
+        chunks = [missing[start:start + PATIENT_BATCH_SIZE] for start in range(0, len(missing), PATIENT_BATCH_SIZE)]
+        searches = [{"_id": ",".join(chunk), "_count": len(chunk)} for chunk in chunks]
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            if "entry" in data:
-                results.extend(data["entry"])
-            url = next((link["url"] for link in data.get("link", []) if link.get("relation") == "next"), None)
-        except requests.RequestException as e:
-            logging.error(f"Error fetching {resource_type} data from FHIR server: {e}")
-            break
-
-    logging.info(f"Fetched {len(results)} {resource_type} records.")
-    return results
+            for page in iter_fhir_searches(f"{FHIR_URL}/Patient/_search", "Patient", searches, elements=PATIENT_ELEMENTS):
+                for entry in page.get("entry", []):
+                    patient = entry.get("resource", {})
+                    if patient.get("id"):
+                        summary = PatientSummary.from_resource(patient)
+                        patient_cache[patient["id"]] = summary
+                        fetched_patients[patient["id"]] = summary
+        except FhirPagingError as e:
+            # A failed batch costs its patients' records, not the Immunization walk
+            logging.error(f"Batched Patient lookup failed, falling back to single lookups: {e}")
+
+        if fetched_patients:
+            store_patients(fetched_patients)
+
+def split_included_patients(page):
+    """Split an Immunization search page into its Immunizations and an index of included Patients' summaries.
+
+    Pages requested with `_include=Immunization:patient` carry the referenced Patients alongside the
+    matches; on any other page the returned index is simply empty.
+    """
+    immunizations = []
+    patient_index = {}
+    for entry in page.get("entry", []):
+        resource = entry.get("resource", {})
+        if resource.get("resourceType") == "Patient":
+            if resource.get("id"):
+                patient_index[resource["id"]] = PatientSummary.from_resource(resource)
+        else:
+            immunizations.append(resource)
+    return immunizations, patient_index
 
 def fetch_patient_data(patient_reference):
-    """Fetch Patient resource based on reference, with caching."""
-    patient_id = patient_reference.split("/")[-1]
-    if patient_id in patient_cache:
+    """Fetch the `PatientSummary` of a Patient resource based on reference, with caching."""
+    patient_id = get_patient_id(patient_reference)
+    summary = patient_cache.get(patient_id)
+    if summary is not None:
+        return summary
+
+    if not load_stored_patients([patient_id]):
         return patient_cache[patient_id]
     
     url = f"{FHIR_URL}/Patient/{patient_id}"
     try:
-        response = requests.get(url, timeout=10)
+        with metrics.PATIENT_FETCH_SECONDS.labels("single").time():
+            response, _ = request_projected(
+                url, "Patient", elements=",".join(PATIENT_ELEMENTS) if FHIR_ELEMENTS_PROJECTION else None
+            )
         response.raise_for_status()
-        patient = response.json()
-        patient_cache[patient_id] = patient
-        return patient
+        summary = patient_cache[patient_id] = PatientSummary.from_resource(fhir_transport.decode_json(response))
+        store_patients({patient_id: summary})
+        return summary
     except requests.RequestException as e:
         logging.error(f"Error fetching Patient data for {patient_id}: {e}")
         return None
 
-def calculate_age_group(birth_date):
-    """Calculate age group based on birthDate."""
-    try:
-        if not birth_date:
-            return "Unknown"
-
-        birth_date = datetime.strptime(birth_date, "%Y-%m-%d")
-        today = datetime.now()
+def calculate_age_group(birth_date, occurrence_year="Unknown"):
+    """Calculate age group based on birthDate (see `age_groups.py` for bands and the reference date)."""
+    return age_grouper.label(birth_date, occurrence_year)
 
-        if birth_date > today:
-            return "Unknown"
-
-        age = (today - birth_date).days // 365
-
-        return "1 year" if age <= 1 else f"{age} years"
-    except ValueError:
-        return "Unknown"
+def process_immunization_record(immunization, patient_index=None, fetch_missing=True):
+    """Process a single Immunization record and return data for aggregation.
 
-def process_immunization_record(immunization):
-    """Process a single Immunization record and return data for aggregation."""
+    Patients found in `patient_index` (e.g. from an `_include`d page) are used without any lookup; others
+    are fetched unless `fetch_missing` is off (when `patient_index` already holds every Patient there is).
+    """
     patient_ref = immunization.get("patient", {}).get("reference")
     if not patient_ref:
         return None
 
-    patient = fetch_patient_data(patient_ref)
+    patient = (patient_index or {}).get(get_patient_id(patient_ref))
+    if patient is None and fetch_missing:
+        patient = fetch_patient_data(patient_ref)
     if not patient:
         return None
 
     occurrence_date = immunization.get("occurrenceDateTime", "")
-    birth_date = patient.get("birthDate", "")
+    birth_date = patient.birth_date
     occurrence_year = occurrence_date[:4] if occurrence_date else "Unknown"
 
     dose_info = immunization.get("protocolApplied", [{}])
@@ -214,77 +651,773 @@ def process_immunization_record(immunization):
     return {
         "Jurisdiction": "BC" if "bc" in FHIR_URL.lower() else "ON",
         "OccurrenceYear": occurrence_year.strip(),
-        "Sex": patient.get("gender", "Unknown").capitalize(),
-        "Age": calculate_age_group(birth_date).strip(),
+        "Sex": patient.gender.capitalize(),
+        "Age": calculate_age_group(birth_date, occurrence_year.strip()),
         "Dose": int(dose_number) if dose_number.isdigit() else 1,
     }
 
+def iter_immunization_pages(url, resume=False):
+    """Yield `(next page url, [(immunization, record), ...])` for every page of Immunizations matched by `url`.
+
+    Patients are resolved a page at a time (from `_include`d entries, then batched lookups) before the
+    page's records are processed. `record` is `None` for Immunizations that can't be aggregated. With
+    `resume`, `url` is a `next` link from an earlier walk, which already carries the search parameters.
+    """
+    include_patients = PATIENT_FETCH_MODE == "include"
+    elements = IMMUNIZATION_ELEMENTS
+    if include_patients:
+        if not resume:
+            url += "&_include=Immunization:patient"
+        # Qualify the elements by type, so the included Patients aren't projected down to Immunization fields
+        elements = [f"Immunization.{element}" for element in IMMUNIZATION_ELEMENTS] + [
+            f"Patient.{element}" for element in PATIENT_ELEMENTS
+        ]
+    if resume:
+        elements = None
+
+    for page in prefetch_pages(iter_fhir_pages(url, "Immunization", elements=elements), FHIR_PREFETCH_PAGES):
+        immunizations, patient_index = split_included_patients(page)
+
+        if include_patients and immunizations and not patient_index:
+            logging.warning("FHIR server returned no _include'd Patients, falling back to batched Patient lookups.")
+            include_patients = False  # only warn once per walk
+
+        # Resolve every patient referenced on this page (and not already included) up front, rather than one GET per record
+        patient_ids = (
+            get_patient_id(ref)
+            for ref in (immunization.get("patient", {}).get("reference") for immunization in immunizations)
+            if ref
+        )
+        fetch_patients_batch(patient_id for patient_id in patient_ids if patient_id not in patient_index)
+        pairs = [(immunization, process_immunization_record(immunization, patient_index)) for immunization in immunizations]
+        metrics.RECORDS_PROCESSED.inc(len(pairs))
+        metrics.RECORDS_DROPPED.inc(sum(record is None for _, record in pairs))
+        yield get_next_page_url(page), pairs
+
+def iter_immunization_records(url):
+    """Yield `(immunization, record)` for every Immunization matched by `url` (see `iter_immunization_pages`)."""
+    for _, pairs in iter_immunization_pages(url):
+        yield from pairs
+
+def open_bulk_source():
+    """The NDJSON source for `FHIR_INGESTION_MODE`: a completed `$export`, or a local directory."""
+    if FHIR_INGESTION_MODE == "ndjson":
+        return NdjsonDirectory(NDJSON_DIRECTORY)
+    return BulkExport.run(
+        fhir_transport, FHIR_URL, ("Patient", "Immunization"), BULK_EXPORT_POLL_INTERVAL, BULK_EXPORT_TIMEOUT
+    )
+
+def iter_bulk_immunization_records():
+    """Yield `(immunization, record)` for every Immunization in a Bulk Data export (or NDJSON directory).
+
+    The Patient file is read first into an index of `PatientSummary`s, then the Immunization file is
+    streamed line by line and joined against it, without any per-page or per-patient requests.
+    """
+    source = open_bulk_source()
+    try:
+        patient_index = {}
+        for patient in source.iter_resources("Patient"):
+            if patient.get("id"):
+                patient_index[patient["id"]] = PatientSummary.from_resource(patient)
+        logging.info(f"Indexed {len(patient_index)} Patients from NDJSON.")
+
+        processed_count = dropped_count = 0
+        try:
+            for immunization in source.iter_resources("Immunization"):
+                record = process_immunization_record(immunization, patient_index, fetch_missing=False)
+                processed_count += 1
+                dropped_count += record is None
+                yield immunization, record
+        finally:
+            metrics.RECORDS_PROCESSED.inc(processed_count)
+            metrics.RECORDS_DROPPED.inc(dropped_count)
+    finally:
+        source.close()
+
+def iter_all_immunization_records():
+    """Yield `(immunization, record)` for every Immunization, read as `FHIR_INGESTION_MODE` says."""
+    if FHIR_INGESTION_MODE in ("bulk", "ndjson"):
+        return iter_bulk_immunization_records()
+    return iter_immunization_records(f"{FHIR_URL}/Immunization?_count=1000")
+
+def find_immunization_bound(search, sort, get_value):
+    """`get_value` of the first Immunization matching `search` in `sort` order, or `None` if there are none."""
+    url = f"{FHIR_URL}/Immunization?" + "&".join(filter(None, [search, f"_sort={sort}", "_count=1"]))
+    for page in iter_fhir_pages(url, "Immunization", elements=IMMUNIZATION_ELEMENTS):
+        for entry in page.get("entry", []):
+            return get_value(entry.get("resource", {}))
+        return None
+    return None
+
+def get_occurrence_year(immunization):
+    year = immunization.get("occurrenceDateTime", "")[:4]
+    return int(year) if year.isdigit() else None
+
+def find_occurrence_years():
+    """The first and last occurrence years of any Immunization, or `(None, None)` if none has a date."""
+    first = find_immunization_bound("date:missing=false", "date", get_occurrence_year)
+    last = find_immunization_bound("date:missing=false", "-date", get_occurrence_year)
+    return first, last
+
+def get_partition_searches(partitions):
+    """Search parameters splitting the Immunization set into up to `partitions` disjoint slices that cover all of it.
+
+    With `FHIR_PARTITION_BY=date` the slices are ranges of whole occurrence years, so every occurrence, however
+    precise, falls in exactly one, plus a slice of Immunizations without an occurrence date. With `lastupdated`
+    they are equal `_lastUpdated` windows, which suits data loaded over time but not data loaded all at once.
+    The first and last slices are open-ended, so nothing is missed if the bounds move while the slices are
+    fetched. Returns `[""]` (one unpartitioned search) when the set can't be split.
+    """
+    if FHIR_PARTITION_BY == "lastupdated":
+        def get_last_updated(immunization):
+            last_updated = immunization.get("meta", {}).get("lastUpdated")
+            return datetime.fromisoformat(last_updated.replace("Z", "+00:00")) if last_updated else None
+
+        first = find_immunization_bound("", "_lastUpdated", get_last_updated)
+        last = find_immunization_bound("", "-_lastUpdated", get_last_updated)
+        if first is None or last is None or first >= last:
+            return [""]
+        step = (last - first) / partitions
+        bounds = [
+            quote((first + step * index).isoformat(timespec="milliseconds"))
+            for index in range(1, partitions)
+        ]
+        return [
+            "&".join(([f"_lastUpdated=ge{lower}"] if lower else []) + ([f"_lastUpdated=lt{upper}"] if upper else []))
+            for lower, upper in zip([None, *bounds], [*bounds, None])
+        ]
+
+    first, last = find_occurrence_years()
+    if first is None or last is None:
+        return [""]
+    # Each slice starts on a whole year, so partial dates (`2021`, `2021-05`) can't straddle two slices;
+    # one partition is kept for the Immunizations without a date
+    year_count = last - first + 1
+    slice_count = max(1, min(partitions - 1, year_count))
+    bounds = [first + round(index * year_count / slice_count) for index in range(1, slice_count)]
+    if not bounds:
+        return ["date:missing=false", "date:missing=true"]
+    return [
+        "&".join(([f"date=ge{lower}-01-01"] if lower else []) + ([f"date=lt{upper}-01-01"] if upper else []))
+        for lower, upper in zip([None, *bounds], [*bounds, None])
+    ] + ["date:missing=true"]
+
+def count_immunization_records(records):
+    """Count `(immunization, record)` pairs by group key; returns the number seen and the group counts.
+
+    Records are counted as their page streams in, so memory is bounded by the page size and the number
+    of groups rather than by the number of Immunizations.
+    """
+    fetched_count = 0
+    group_counts = Counter()
+    for _, record in records:
+        fetched_count += 1
+        if record:
+            group_counts[get_group_key(record)] += 1
+    return fetched_count, group_counts
+
+class ImmunizationWalk:
+    """Progress through the pages of one Immunization search: where it started, where it got to, what it counted."""
+
+    def __init__(self, search):
+        separator = f"{search}&" if search else ""
+        self.start_url = f"{FHIR_URL}/Immunization?{separator}_count=1000"
+        self.next_url = self.start_url
+        self.resumed = False  # `next_url` is a `next` link, not `start_url`
+        self.fetched_count = 0
+        self.group_counts = Counter()
+
+    @property
+    def complete(self):
+        return self.next_url is None
+
+    def restart(self):
+        self.next_url = self.start_url
+        self.resumed = False
+        self.fetched_count = 0
+        self.group_counts = Counter()
+
+    def run(self):
+        """Count pages until the search is exhausted or a page can't be fetched, saving progress after each page.
+
+        A page is only counted once all of it has been processed, so a walk stopped mid-page resumes from
+        that page's own URL and counts it exactly once. A resumed `next` link the server no longer accepts
+        (an expired paging cursor) restarts the walk from its first page, at most once per run.
+        """
+        restarted = False
+        while not self.complete:
+            try:
+                for next_url, pairs in iter_immunization_pages(self.next_url, resume=self.resumed):
+                    self.fetched_count += len(pairs)
+                    self.group_counts.update(get_group_key(record) for _, record in pairs if record)
+                    self.next_url = next_url
+                    self.resumed = next_url is not None
+                return
+            except FhirPagingError as e:
+                # Only the Immunization page itself failing means the cursor expired
+                if self.resumed and not e.retryable and e.url == self.next_url and not restarted:
+                    logging.warning(f"FHIR server no longer accepts {self.next_url}, restarting from {self.start_url}.")
+                    self.restart()
+                    restarted = True
+                    continue
+                logging.error(f"Immunization walk stopped after {self.fetched_count} records: {e}")
+                return
+
+class AggregationCheckpoint:
+    """The walks of an aggregation, kept between attempts so an interrupted one resumes instead of starting over."""
+
+    def __init__(self, searches):
+        self.created_at = datetime.now().timestamp()
+        self.walks = [ImmunizationWalk(search) for search in searches]
+
+    @property
+    def complete(self):
+        return all(walk.complete for walk in self.walks)
+
+    @property
+    def fetched_count(self):
+        return sum(walk.fetched_count for walk in self.walks)
+
+    def group_counts(self):
+        group_counts = Counter()
+        for walk in self.walks:
+            group_counts.update(walk.group_counts)
+        return group_counts
+
+    def run(self):
+        """Run every unfinished walk, in parallel when there are several."""
+        walks = [walk for walk in self.walks if not walk.complete]
+        if len(walks) == 1:
+            walks[0].run()
+        elif walks:
+            with ThreadPoolExecutor(max_workers=len(walks), thread_name_prefix="fhir-partition") as executor:
+                list(executor.map(ImmunizationWalk.run, walks))
+
+aggregation_checkpoint = None  # AggregationCheckpoint of an aggregation that stopped part way, if any
+
+def count_checkpointed_immunization_records():
+    """Count every Immunization as `count_immunization_records` does, resuming the last attempt's checkpoint if any.
+
+    With `FHIR_PARTITIONS` above 1 the set is split into slices (see `get_partition_searches`) whose
+    pagination cursors are walked in parallel; since the slices are disjoint and cover the whole set, the
+    result is the same as a single walk's. If a page still fails after retries, the walks that reached
+    it stop and the checkpoint is kept: the counts returned are then partial (`aggregation_checkpoint` is
+    not `None`), and the next attempt carries on from the failed pages. Checkpoints older than
+    `AGGREGATION_CHECKPOINT_TTL` seconds are dropped and the walk starts over.
+    """
+    global aggregation_checkpoint
+
+    checkpoint = aggregation_checkpoint
+    if checkpoint is not None and datetime.now().timestamp() - checkpoint.created_at >= AGGREGATION_CHECKPOINT_TTL:
+        logging.warning("Aggregation checkpoint expired, starting over.")
+        checkpoint = None
+    if checkpoint is None:
+        searches = get_partition_searches(FHIR_PARTITIONS) if FHIR_PARTITIONS > 1 else [""]
+        logging.info(f"Fetching Immunizations in {len(searches)} partitions: {searches}")
+        checkpoint = AggregationCheckpoint(searches)
+    else:
+        pending = sum(not walk.complete for walk in checkpoint.walks)
+        logging.info(f"Resuming aggregation: {pending} of {len(checkpoint.walks)} partitions unfinished, {checkpoint.fetched_count} records counted.")
+
+    checkpoint.run()
+    aggregation_checkpoint = None if checkpoint.complete else checkpoint
+    if aggregation_checkpoint is not None:
+        logging.warning(f"Aggregation is partial: {checkpoint.fetched_count} records counted, will resume.")
+    return checkpoint.fetched_count, checkpoint.group_counts()
+
+count_plan = None  # CountPlan reused between count aggregations while its years still add up
+
+def count_immunization_searches(searches):
+    """`_summary=count` totals of Immunization searches (query strings), up to `FHIR_CONCURRENCY` at a time."""
+    def count_search(search):
+        separator = f"{search}&" if search else ""
+        page = next(iter_fhir_pages(f"{FHIR_URL}/Immunization?{separator}_summary=count", "Immunization"))
+        return page.get("total", 0)
+
+    with ThreadPoolExecutor(max_workers=min(FHIR_CONCURRENCY, len(searches)), thread_name_prefix="fhir-count") as executor:
+        return list(executor.map(count_search, searches))
+
+def count_groups_on_server():
+    """Group counts from `_summary=count` searches (see `count_pushdown.py`), planning the grid again if it's out of date."""
+    global count_plan
+
+    for _ in range(2):
+        if count_plan is None:
+            first, last = find_occurrence_years()
+            years = list(range(first, last + 1)) if first is not None and last is not None else []
+            jurisdiction = "BC" if "bc" in FHIR_URL.lower() else "ON"
+            count_plan = CountPlan(years, COUNT_DOSES, COUNT_DOSE_PARAMETER, age_grouper, jurisdiction)
+        try:
+            group_counts = count_plan.count(count_immunization_searches, COUNT_MAX_REQUESTS)
+            logging.info(f"Counted {len(group_counts)} groups with {count_plan.request_count} _summary=count searches.")
+            return group_counts
+        except StaleCountPlan as e:
+            logging.info(f"Planning the count grid again: {e}")
+            count_plan = None
+    raise StaleCountPlan("Counts kept changing while the grid was being counted")
+
 def aggregate_data():
-    """Fetch and aggregate data from the FHIR server synchronously."""
+    """Fetch and aggregate data from the FHIR server synchronously.
+
+    The result is partial if `aggregation_checkpoint` is set afterwards (see `count_checkpointed_immunization_records`).
+    With `FHIR_INGESTION_MODE=count` the FHIR server does the counting; if it can't (an unknown search
+    parameter, more than `COUNT_MAX_REQUESTS` searches), every Immunization is downloaded as usual.
+    """
+    if FHIR_INGESTION_MODE == "count":
+        try:
+            group_counts = count_groups_on_server()
+            if not group_counts:
+                logging.warning("No Immunization records found.")
+            return counts_to_records(group_counts)
+        except (CountBudgetExceeded, StaleCountPlan, FhirPagingError, ValueError) as e:
+            logging.error(f"Count aggregation failed, downloading every Immunization instead: {e}")
+
     logging.info("Fetching Immunization resources...")
-    immunizations = fetch_fhir_resources("Immunization")
+    if FHIR_INGESTION_MODE in ("search", "count"):
+        fetched_count, group_counts = count_checkpointed_immunization_records()
+    else:
+        fetched_count, group_counts = count_immunization_records(iter_all_immunization_records())
 
-    if not immunizations:
+    logging.info(f"Fetched {fetched_count} Immunization records.")
+    if not fetched_count:
         logging.warning("No Immunization records found.")
         return []
 
-    records = [process_immunization_record(entry.get("resource", {})) for entry in immunizations]
-    records = [r for r in records if r]
-
-    if not records:
+    if not group_counts:
         logging.warning("No valid records processed.")
         return []
 
-    df = pd.DataFrame(records)
-    if df.empty:
-        logging.warning("Empty DataFrame after processing immunization records.")
-        return []
+    return counts_to_records(group_counts)
 
-    df["OccurrenceYear"] = df["OccurrenceYear"].astype(str).str.strip()
-    df["Sex"] = df["Sex"].str.capitalize()
-    df["Age"] = df["Age"].str.strip()
+# The `GROUP_COLUMNS` values of a processed record, as a tuple
+get_group_key = itemgetter(*GROUP_COLUMNS)
 
-    aggregated = df.groupby([
-        "OccurrenceYear", "Jurisdiction", "Sex", "Age", "Dose"
-    ], as_index=False).agg(
-        Count=("Dose", "count")
-    )
+def get_reference_date(occurrence_year):
+    """The ReferenceDate of a group: December 31st of its OccurrenceYear."""
+    return f"{occurrence_year}-12-31" if occurrence_year.isnumeric() and occurrence_year != "Unknown" else "Unknown"
 
-    aggregated["ReferenceDate"] = aggregated["OccurrenceYear"].apply(
-        lambda year: f"{year}-12-31" if year.isnumeric() and year != "Unknown" else "Unknown"
-    )
+def counts_to_records(group_counts):
+    """Render `{group key: count}` as aggregated records, ordered by group key.
 
-    return aggregated.to_dict(orient="records")
+    Equivalent to grouping the processed records by `GROUP_COLUMNS` and counting each group, without
+    building a DataFrame: the keys are already normalized by `process_immunization_record`.
+    """
+    return [
+        {**dict(zip(GROUP_COLUMNS, key)), "Count": count, "ReferenceDate": get_reference_date(key[0])}
+        for key, count in sorted(group_counts.items())
+    ]
 
-@app.route("/aggregated-data", methods=["GET"])
-def get_aggregated_data():
-    """API endpoint to return aggregated data with JWT authentication."""
-    global cached_data, last_aggregation_time
+class IncrementalAggregation:
+    """Running group counts kept up to date from Immunization changes instead of full re-aggregation.
+
+    `counts` maps a group key `(OccurrenceYear, Jurisdiction, Sex, Age, Dose)` to its count, and
+    `contributions` maps each Immunization id to the `(versionId, group key)` it currently contributes,
+    so an update or delete can take back exactly what the previous version added.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.contributions = {}
+        self.watermark = None  # Latest `meta.lastUpdated` applied
+        self.last_rebuild_time = None
+
+    def apply(self, immunization, record):
+        """Add, or replace, the contribution of one Immunization version."""
+        immunization_id = immunization.get("id")
+        if not immunization_id:
+            return
+
+        meta = immunization.get("meta", {})
+        version_id = meta.get("versionId")
+        previous = self.contributions.get(immunization_id)
+        if previous is not None and version_id is not None and previous[0] == version_id:
+            return  # Already applied
+
+        self.remove(immunization_id)
+        key = get_group_key(record) if record else None
+        self.contributions[immunization_id] = (version_id, key)
+        if key is not None:
+            self.counts[key] += 1
+
+        last_updated = meta.get("lastUpdated")
+        if last_updated and (self.watermark is None or last_updated > self.watermark):
+            self.watermark = last_updated
+
+    def remove(self, immunization_id):
+        """Take back the contribution of a deleted (or superseded) Immunization."""
+        _, key = self.contributions.pop(immunization_id, (None, None))
+        if key is not None:
+            self.counts[key] -= 1
+            if self.counts[key] <= 0:
+                del self.counts[key]
+
+    def to_records(self):
+        """Render the running counts in the same shape as `aggregate_data()`."""
+        return counts_to_records(self.counts)
+
+incremental_aggregation = IncrementalAggregation()
+
+def refresh_incremental_aggregation():
+    """Bring `incremental_aggregation` up to date and return its records.
 
-    if is_auth_required:
+    The first call, and one every `INCREMENTAL_REBUILD_INTERVAL` seconds, rebuilds from the full Immunization
+    set; that also picks up Patient edits and ages rolling over, which don't touch any Immunization. In between,
+    only Immunizations changed since the watermark are fetched, and deletes are read from `_history`.
+    """
+    global incremental_aggregation
+
+    current_time = datetime.now().timestamp()
+    state = incremental_aggregation
+    if state.watermark is None or current_time - state.last_rebuild_time >= INCREMENTAL_REBUILD_INTERVAL:
+        logging.info("Rebuilding incremental aggregation from all Immunization records...")
+        state = IncrementalAggregation()
+        for immunization, record in iter_all_immunization_records():
+            state.apply(immunization, record)
+        state.last_rebuild_time = current_time
+        incremental_aggregation = state
+        logging.info(f"Aggregated {len(state.contributions)} Immunization records into {len(state.counts)} groups.")
+        return state.to_records()
+
+    since = quote(state.watermark)
+    deleted_count = 0
+    for page in iter_fhir_pages(f"{FHIR_URL}/Immunization/_history?_since={since}&_count=1000", "Immunization"):
+        for entry in page.get("entry", []):
+            request_info = entry.get("request", {})
+            url_parts = request_info.get("url", "").split("/")  # Immunization/<id>[/_history/<version>]
+            if request_info.get("method") == "DELETE" and len(url_parts) > 1:
+                state.remove(url_parts[1])
+                deleted_count += 1
+
+    changed_count = 0
+    try:
+        for immunization, record in iter_immunization_records(f"{FHIR_URL}/Immunization?_lastUpdated=gt{since}&_count=1000"):
+            state.apply(immunization, record)
+            changed_count += 1
+    except (FhirPagingError, FetchCancelled):
+        # Changes don't arrive in `lastUpdated` order, so the watermark may now be past some that were never
+        # applied; rebuild next time rather than miss them
+        state.watermark = None
+        raise
+
+    logging.info(f"Applied {changed_count} changed and {deleted_count} deleted Immunization records incrementally.")
+    return state.to_records()
+
+def load_result(data, aggregated_at, complete):
+    """Build the `AggregatedResult` to serve, numbered by `snapshot_history` (unchanged content keeps its version)."""
+    result = AggregatedResult(data, aggregated_at, complete)
+    try:
+        result.version = snapshot_history.record(data, aggregated_at, result.content_hash)
+    except sqlite3.Error as e:
+        logging.error(f"Could not record the result in the snapshot history: {e}")
+    return result
+
+def adopt_shared_result():
+    """Pick up a newer result published by another worker; returns `True` if the result held is still fresh.
+
+    If the shared cache backend can't be read, the result this worker already holds is kept.
+    """
+    global cached_result
+
+    try:
+        shared_time = cache_backend.get_result_time()
+        if shared_time is not None and (cached_result is None or shared_time > cached_result.aggregated_at):
+            data, shared_time, complete = cache_backend.get_result()
+            if shared_time is not None:
+                cached_result = load_result(data, shared_time, complete)
+                first_refresh_done.set()
+    except Exception as e:
+        logging.error(f"Could not read the shared result, keeping this worker's own: {e}")
+
+    return cached_result is not None and datetime.now().timestamp() - cached_result.aggregated_at < AGGREGATION_INTERVAL
+
+def refresh_aggregated_data(force=False):
+    """Recompute the aggregated data, unless a refresh is already running.
+
+    Only one aggregation runs at a time per process (`refresh_lock`) and, with a shared cache backend,
+    across worker processes (`cache_backend.refresh_lock()`): the other workers serve the published result
+    instead of recomputing it. Unless `force` is set, a result that is still fresh isn't recomputed.
+    Returns `True` if this call ran the refresh. Readers keep getting the previous result until the new
+    one is complete. If the shared cache backend fails, this worker aggregates and serves its result on
+    its own rather than stop refreshing.
+
+    A partial aggregation (see `count_checkpointed_immunization_records`) is only published when there is
+    no complete result to keep serving; either way its checkpoint is resumed on the next refresh, which
+    the scheduler runs after `AGGREGATION_RESUME_INTERVAL` seconds rather than a whole interval.
+    """
+    global cached_result, aggregation_checkpoint
+
+    if not refresh_lock.acquire(blocking=False):
+        logging.info("Aggregation already in progress, not starting another.")
+        return False
+
+    try:
+        if adopt_shared_result() and not force and aggregation_checkpoint is None:
+            return False
+
+        with ExitStack() as shared_lock:
+            try:
+                is_lock_holder = shared_lock.enter_context(cache_backend.refresh_lock())
+            except Exception as e:
+                logging.error(f"Could not take the shared refresh lock, aggregating in this worker: {e}")
+                is_lock_holder = True
+            if not is_lock_holder:
+                logging.info("Another worker is aggregating, waiting for its result.")
+                return False
+
+            started_time = datetime.now().timestamp()
+            fhir_transport.reset()
+            try:
+                revalidate_persistent_patient_index()
+                age_grouper.reset()
+                logging.info("Calculating new aggregated data...")
+                with metrics.AGGREGATION_SECONDS.labels("incremental" if INCREMENTAL_AGGREGATION else "full").time():
+                    data = refresh_incremental_aggregation() if INCREMENTAL_AGGREGATION else aggregate_data()
+                complete = aggregation_checkpoint is None
+                if complete or cached_result is None or not cached_result.complete:
+                    try:
+                        cache_backend.set_result(data, started_time, complete)
+                    except Exception as e:
+                        logging.error(f"Could not publish the result to the shared cache: {e}")
+                    cached_result = load_result(data, started_time, complete)
+                else:
+                    logging.warning("Aggregation is partial, keeping the previous complete result.")
+                logging.info(f"Aggregation finished in {datetime.now().timestamp() - started_time:.2f} seconds.")
+                logging.info(f"Patient cache: {patient_cache.stats()}")
+                logging.info(f"FHIR requests: {fhir_transport.stats()}")
+            except FetchCancelled:
+                # Superseded by a refresh request; the next one starts over rather than resuming
+                aggregation_checkpoint = None
+                logging.info("Aggregation cancelled by a newer refresh request, keeping previous result.")
+            except Exception as e:
+                logging.error(f"Aggregation failed, keeping previous result: {e}")
+            finally:
+                metrics.record_patient_cache_stats(patient_cache.stats())
+                first_refresh_done.set()
+            return True
+    finally:
+        refresh_lock.release()
+
+def run_refresh_scheduler():
+    """Refresh aggregated data whenever it goes stale (every `AGGREGATION_INTERVAL` seconds), or as soon as one is requested.
+
+    While another worker holds the shared refresh lock, check back for its result every `SHARED_CACHE_POLL_INTERVAL` seconds;
+    after a partial aggregation, resume it in `AGGREGATION_RESUME_INTERVAL` seconds.
+    """
+    while True:
+        try:
+            refresh_aggregated_data(force=refresh_requested.is_set())
+        except Exception:
+            # Nothing restarts this thread, so an unexpected error must not end it
+            logging.exception("Refresh failed unexpectedly, retrying on schedule.")
+        refresh_requested.clear()
+
+        wait = SHARED_CACHE_POLL_INTERVAL
+        if aggregation_checkpoint is not None:
+            wait = AGGREGATION_RESUME_INTERVAL
+        elif cached_result is not None:
+            wait = max(AGGREGATION_INTERVAL - (datetime.now().timestamp() - cached_result.aggregated_at), SHARED_CACHE_POLL_INTERVAL)
+        refresh_requested.wait(timeout=wait)
+
+@app.before_request
+def start_refresh_scheduler():
+    """Start the background refresh thread on the first request this worker sees (usually a health probe)."""
+    global refresh_scheduler
+
+    with refresh_scheduler_lock:
+        if refresh_scheduler is None:
+            refresh_scheduler = threading.Thread(target=run_refresh_scheduler, name="aggregation-refresh", daemon=True)
+            refresh_scheduler.start()
+
+def check_authorization():
+    """Return an error response if the request lacks a valid JWT (when auth is required), else `None`."""
+    if token_verifier.is_auth_required:
         auth_header = request.headers.get("Authorization", "").strip()
         if not auth_header.startswith("Bearer "):
             return jsonify({"error": "Unauthorized"}), 401
         token = auth_header.split(" ", 1)[-1]
         if not verify_jwt(token):
             return jsonify({"error": "Invalid token"}), 403
+    return None
 
-    current_time = datetime.now().timestamp()
+def parse_filters(args):
+    """Read `/aggregated-data` filter parameters into `AggregatedResult.filter` arguments.
 
-    if cached_data and last_aggregation_time and (current_time - last_aggregation_time < AGGREGATION_INTERVAL):
-        remaining_time = AGGREGATION_INTERVAL - (current_time - last_aggregation_time)
-        logging.info(f"Returning cached data. Next aggregation in {remaining_time:.2f} seconds.")
-        return jsonify(cached_data)
-    
-    logging.info("Calculating new aggregated data...")
-    cached_data = aggregate_data()
-    last_aggregation_time = current_time
-    return jsonify(cached_data)
+    `jurisdiction`, `sex`, `age` and `dose` take comma-separated values (or repeat); `year_from` and
+    `year_to` bound OccurrenceYear inclusively. Raises `ValueError` on malformed numbers.
+    """
+    def get_values(name):
+        return [value.strip() for arg in args.getlist(name) for value in arg.split(",") if value.strip()]
+
+    values = {}
+    if get_values("jurisdiction"):
+        values["Jurisdiction"] = {value.upper() for value in get_values("jurisdiction")}
+    if get_values("sex"):
+        values["Sex"] = {value.capitalize() for value in get_values("sex")}
+    if get_values("age"):
+        values["Age"] = set(get_values("age"))
+    if get_values("dose"):
+        values["Dose"] = {int(value) for value in get_values("dose")}
+
+    year_from = int(args["year_from"]) if args.get("year_from") else None
+    year_to = int(args["year_to"]) if args.get("year_to") else None
+    return values, year_from, year_to
+
+def parse_group_by(args):
+    """Read the `/aggregated-data` `group_by` parameter into the dimensions to keep.
+
+    `group_by` takes comma-separated dimension names, matched case-insensitively; the others are rolled
+    up to `ALL`. Without the parameter every dimension is kept, and `group_by=` alone gives the grand
+    total. Raises `ValueError` on an unknown dimension.
+    """
+    if "group_by" not in args:
+        return DIMENSIONS
+
+    names = {dimension.lower(): dimension for dimension in DIMENSIONS}
+    requested = [value.strip().lower() for arg in args.getlist("group_by") for value in arg.split(",") if value.strip()]
+    unknown = [value for value in requested if value not in names]
+    if unknown:
+        raise ValueError(f"Unknown group_by dimension(s) {', '.join(unknown)}; expected any of {', '.join(DIMENSIONS)}")
+    return {names[value] for value in requested}
+
+def get_changes_since(result, since):
+    """The `?since=<version>` response: the rows of `result` changed and removed since version `since`.
+
+    If that version is no longer in `snapshot_history`, is from another epoch of it (a history lost in a restart),
+    or the result has no version, `full` is `true` and `changed` holds every row instead, to replace the client's copy.
+    """
+    changes = None
+    if result.version is not None:
+        try:
+            changes = snapshot_history.changes(since, result.version)
+        except sqlite3.Error as e:
+            logging.error(f"Could not read the snapshot history, sending the whole result: {e}")
+    changed, removed = changes if changes is not None else (result.records, [])
+    return {
+        "version": result.version,
+        "since": since,
+        "complete": result.complete,
+        "full": changes is None,
+        "changed": changed,
+        "removed": removed,
+    }
+
+@app.route("/aggregated-data", methods=["GET"])
+def get_aggregated_data():
+    """API endpoint to return the last completed aggregation, with its age in seconds in `X-Aggregation-Age`.
+
+    `X-Aggregation-Complete: false` marks a partial result, served only until a complete one exists, and
+    `X-Aggregation-Version` its version. `since=<version>` returns only the changes since that version
+    (see `get_changes_since`) rather than the whole result.
+
+    Optional filter parameters (see `parse_filters`) are answered from the result's posting lists, and
+    `group_by` (see `parse_group_by`) selects one of its precomputed rollups. `format` picks the
+    representation (see `result_encodings.FORMATS`), gzipped when the client accepts it. Responses carry
+    an `ETag` derived from the result's content and the query, and `If-None-Match` gets a `304`.
+    """
+    auth_error = check_authorization()
+    if auth_error:
+        return auth_error
+
+    try:
+        values, year_from, year_to = parse_filters(request.args)
+    except ValueError:
+        return jsonify({"error": "year_from, year_to and dose must be integers"}), 400
+    try:
+        group_by = parse_group_by(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    output_format = request.args.get("format", "json").lower()
+    if output_format not in FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(FORMATS)}"}), 400
+    mimetype, _, compressible = FORMATS[output_format]
+    compressed = compressible and "gzip" in request.accept_encodings
+    since = request.args.get("since")
+    if since is not None:
+        filtered = values or year_from is not None or year_to is not None
+        if filtered or "group_by" in request.args or output_format != "json":
+            return jsonify({"error": "since can't be combined with filters, group_by or format"}), 400
+
+    # Only a cold worker waits, and only briefly: a gunicorn worker blocked past its timeout would be killed,
+    # taking the refresh it's waiting for with it
+    first_refresh_done.wait(timeout=FIRST_RESULT_WAIT)
+    result = cached_result
+    if result is None:
+        response = jsonify({"error": "Aggregated data is not available yet"})
+        response.headers["Retry-After"] = str(max(FIRST_RESULT_WAIT, 1))
+        return response, 503
+
+    age = datetime.now().timestamp() - result.aggregated_at
+    etag = hashlib.sha256(f"{result.content_hash}?{request.query_string.decode()}|{compressed}".encode()).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        logging.info(f"Cached data aggregated {age:.2f} seconds ago is unchanged for this client.")
+        response = Response(status=304)
+    else:
+        logging.info(f"Returning cached data aggregated {age:.2f} seconds ago.")
+        try:
+            if since is not None:
+                body = encode(get_changes_since(result, since), output_format, compressed)
+            elif values or year_from is not None or year_to is not None:
+                body = encode(result.filter(values, year_from, year_to, group_by), output_format, compressed)
+            else:
+                body = result.body(group_by, output_format, compressed)
+        except RuntimeError as e:
+            logging.error(f"Could not encode aggregated data as {output_format}: {e}")
+            return jsonify({"error": str(e)}), 501
+        response = Response(body, mimetype=mimetype)
+        if compressed:
+            response.headers["Content-Encoding"] = "gzip"
+
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["X-Aggregation-Age"] = str(int(age))
+    response.headers["X-Aggregation-Complete"] = "true" if result.complete else "false"
+    if result.version is not None:
+        response.headers["X-Aggregation-Version"] = str(result.version)
+    return response
+
+@app.route("/aggregated-data/refresh", methods=["POST"])
+def request_refresh():
+    """API endpoint to trigger a background refresh without waiting for the next interval.
+
+    A refresh already running in this worker is superseded: its FHIR requests are cancelled (see
+    `FhirTransport.cancel`) and the requested one starts as soon as it has stopped.
+    """
+    auth_error = check_authorization()
+    if auth_error:
+        return auth_error
+
+    if refresh_lock.locked():
+        fhir_transport.cancel()
+    refresh_requested.set()
+    return jsonify({"status": "refresh requested"}), 202
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus metrics endpoint: fetch and aggregation latencies, record and patient cache counters, result age."""
+    result = cached_result
+    if result is not None:
+        metrics.CACHED_RESULT_AGE_SECONDS.set(datetime.now().timestamp() - result.aggregated_at)
+        metrics.RESULT_COMPLETE.set(result.complete)
+        if result.version is not None:
+            metrics.RESULT_VERSION.set(snapshot_history.parse_version(result.version) or 0)
+    body, content_type = metrics.render_metrics()
+    return Response(body, content_type=content_type)
 
 @app.route("/health", methods=["GET"])
 def health_check():
-    """Health check endpoint to verify API is running."""
-    return jsonify({"status": "ok"}), 200
+    """Health check endpoint to verify API is running, with patient cache and FHIR request counters.
+
+    `complete` is `false` while the result served is partial, and `version` is its snapshot version; both
+    are `null` before there is one.
+    """
+    result = cached_result
+    return jsonify({
+        "status": "ok",
+        "complete": result.complete if result is not None else None,
+        "version": result.version if result is not None else None,
+        "patient_cache": patient_cache.stats(),
+        "fhir_requests": fhir_transport.stats(),
+    }), 200
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""
+End-to-end benchmark for `aggregate_data()`.
+
+For each size, starts the stand-in FHIR server (`fake_fhir_server.py`) with that many synthetic
+Immunizations, then runs one aggregation in a fresh aggregator process and reports wall time,
+records/sec, FHIR request count and the aggregator process's peak RSS. Each size gets its own process,
+so caches start cold and peak RSS isn't carried over from a smaller run.
+
+The aggregator is configured from the environment as usual (`PATIENT_FETCH_MODE`, `FHIR_PREFETCH_PAGES`,
+`PATIENT_CACHE_MEMORY_MB`, ...), so the same run can be repeated with different settings. `--output`
+writes the results as JSON, with the git commit and settings they were measured with, for tracking
+regressions between runs.
+
+Usage:
+    python benchmarks/aggregation.py [--sizes 10000 100000 1000000] [--latency 0.02] [--output results.json]
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from fake_fhir_server import start_server
+
+AGGREGATOR_PATH = Path(__file__).resolve().parents[1]
+
+# Aggregator settings recorded with each run, since they change what is being measured
+SETTINGS = (
+    "PATIENT_FETCH_MODE", "PATIENT_BATCH_SIZE", "FHIR_ELEMENTS_PROJECTION", "FHIR_PREFETCH_PAGES",
+    "FHIR_POOL_SIZE", "PATIENT_CACHE_MEMORY_MB", "SHARED_CACHE_BACKEND", "PATIENT_INDEX_PATH",
+    "FHIR_PARTITIONS", "FHIR_PARTITION_BY",
+)
+
+
+def run_aggregation(fhir_url, results):
+    """Run one `aggregate_data()` against `fhir_url` in this (fresh) process and send back its measurements."""
+    import resource
+
+    os.environ["FHIR_URL"] = fhir_url
+    os.environ.setdefault("IS_LOCAL_DEV", "true")
+    sys.path.insert(0, str(AGGREGATOR_PATH))
+    import aggregator
+
+    started = time.perf_counter()
+    records = aggregator.aggregate_data()
+    seconds = time.perf_counter() - started
+
+    # `ru_maxrss` is in kilobytes on Linux
+    results.send({
+        "seconds": seconds,
+        "groups": len(records),
+        "aggregated_records": sum(record["Count"] for record in records),
+        "records_sha256": hashlib.sha256(json.dumps(records, sort_keys=True).encode()).hexdigest(),
+        "fhir_requests": aggregator.fhir_transport.stats()["requests"],
+        "fhir_bytes": aggregator.fhir_transport.stats()["bytes"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def benchmark(size, server_options):
+    server, fhir_url = start_server(size, **server_options)
+    try:
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_aggregation, args=(fhir_url, sender))
+        process.start()
+        process.join()
+        if process.exitcode != 0 or not receiver.poll():
+            raise RuntimeError(f"Aggregation of {size} records failed (exit code {process.exitcode})")
+        result = receiver.recv()
+    finally:
+        server.terminate()
+
+    return {"immunizations": size, **result, "records_per_second": size / result["seconds"]}
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=AGGREGATOR_PATH, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Immunization counts to run")
+    parser.add_argument("--patients-per-immunization", type=float, default=1.0, help="Patients served per Immunization")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server adds to every response")
+    parser.add_argument("--max-page-size", type=int, default=1000, help="Largest page the fake server returns")
+    parser.add_argument("--pool", type=int, default=1000, help="Distinct synthetic Patient/Immunization pairs")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    runs = []
+    for size in args.sizes:
+        server_options = {
+            "patient_count": max(1, int(size * args.patients_per_immunization)),
+            "pool_size": args.pool,
+            "latency": args.latency,
+            "max_page_size": args.max_page_size,
+        }
+        run = benchmark(size, server_options)
+        runs.append(run)
+        print(
+            f"{size:>9,} immunizations: {run['seconds']:8.2f}s, {run['records_per_second']:9,.0f} records/s, "
+            f"{run['fhir_requests']:6,} requests, peak RSS {run['peak_rss_mb']:7.1f} MB"
+        )
+
+    if args.output:
+        results = {
+            "benchmark": "aggregate_data",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server": {
+                "latency": args.latency,
+                "max_page_size": args.max_page_size,
+                "pool": args.pool,
+                "patients_per_immunization": args.patients_per_immunization,
+            },
+            "settings": {name: os.environ[name] for name in SETTINGS if name in os.environ},
+            "runs": runs,
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark of count aggregation (`FHIR_INGESTION_MODE=count`) against downloading every Immunization.
+
+For each size, runs `aggregation.benchmark` twice against the same synthetic data, first with
+`FHIR_INGESTION_MODE=search` and then with `count`, and reports each run's wall time, FHIR requests and
+response bytes, and whether both produced the same records. Age groups come from `--age-bands` (one group per
+year of age when empty); the other aggregator settings are read from the environment as usual.
+
+Usage:
+    python benchmarks/count_pushdown.py [--sizes 10000 100000] [--latency 0.02] [--age-bands 0-4,5-17,18+]
+        [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+from datetime import datetime, timezone
+
+from aggregation import SETTINGS, benchmark, get_git_commit
+
+MODES = ("search", "count")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Immunization counts to run")
+    parser.add_argument("--patients-per-immunization", type=float, default=1.0, help="Patients served per Immunization")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server adds to every response")
+    parser.add_argument("--max-page-size", type=int, default=1000, help="Largest page the fake server returns")
+    parser.add_argument("--pool", type=int, default=1000, help="Distinct synthetic Patient/Immunization pairs")
+    parser.add_argument("--age-bands", default="0-4,5-11,12-17,18-64,65+", help="AGE_BANDS for both runs")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    os.environ["AGE_BANDS"] = args.age_bands
+    runs = []
+    for size in args.sizes:
+        server_options = {
+            "patient_count": max(1, int(size * args.patients_per_immunization)),
+            "pool_size": args.pool,
+            "latency": args.latency,
+            "max_page_size": args.max_page_size,
+        }
+        # The aggregator is spawned fresh for each run, so it reads the mode from the environment
+        results = {}
+        for mode in MODES:
+            os.environ["FHIR_INGESTION_MODE"] = mode
+            results[mode] = benchmark(size, server_options)
+            print(
+                f"{size:>9,} immunizations, {mode:>6}: {results[mode]['seconds']:8.2f}s, "
+                f"{results[mode]['fhir_requests']:6,} requests, {results[mode]['fhir_bytes'] / 1e6:9.2f} MB"
+            )
+        identical = results["search"]["records_sha256"] == results["count"]["records_sha256"]
+        print(f"{size:>9,} immunizations: results {'identical' if identical else 'DIFFER'}")
+        runs.append({"immunizations": size, "identical": identical, **results})
+
+    if args.output:
+        results = {
+            "benchmark": "count_pushdown",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server": {
+                "latency": args.latency,
+                "max_page_size": args.max_page_size,
+                "pool": args.pool,
+                "patients_per_immunization": args.patients_per_immunization,
+            },
+            "settings": {name: os.environ[name] for name in SETTINGS + ("AGE_BANDS",) if name in os.environ},
+            "runs": runs,
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Payload benchmark for `_elements` projection.
+
+Fetches the same pages of Immunization and Patient resources from a FHIR server with and without the
+`_elements` projection the aggregator requests, and reports bytes over the wire (as sent, and
+uncompressed) and JSON decode time per page.
+
+Usage:
+    FHIR_URL=http://localhost:8080/fhir python benchmarks/elements_payload.py [--pages 5] [--count 1000]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import time
+
+import requests
+
+FHIR_URL = os.getenv("FHIR_URL", "http://localhost:8080/fhir")
+
+# Kept in step with IMMUNIZATION_ELEMENTS and PATIENT_ELEMENTS in aggregator.py
+ELEMENTS = {
+    "Immunization": "patient,occurrenceDateTime,protocolApplied",
+    "Patient": "gender,birthDate",
+}
+
+
+def measure(resource_type, count, pages, elements=None):
+    """Walk up to `pages` search pages, totalling wire bytes, decoded bytes and decode time."""
+    url = f"{FHIR_URL}/{resource_type}?_count={count}"
+    if elements:
+        url += f"&_elements={elements}"
+
+    totals = {"pages": 0, "resources": 0, "wire_bytes": 0, "body_bytes": 0, "decode_seconds": 0.0}
+    with requests.Session() as session:
+        while url and totals["pages"] < pages:
+            response = session.get(url, headers={"Accept-Encoding": "gzip"}, timeout=60, stream=True)
+            response.raise_for_status()
+            wire = response.raw.read(decode_content=False)
+            body = gzip.decompress(wire) if response.headers.get("Content-Encoding") == "gzip" else wire
+            started = time.perf_counter()
+            page = json.loads(body)
+            totals["decode_seconds"] += time.perf_counter() - started
+
+            totals["pages"] += 1
+            totals["resources"] += len(page.get("entry", []))
+            totals["wire_bytes"] += len(wire)
+            totals["body_bytes"] += len(body)
+            url = next((link["url"] for link in page.get("link", []) if link.get("relation") == "next"), None)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=5, help="Pages to fetch per resource type and mode")
+    parser.add_argument("--count", type=int, default=1000, help="Page size (_count)")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for resource_type, elements in ELEMENTS.items():
+        full = measure(resource_type, args.count, args.pages)
+        projected = measure(resource_type, args.count, args.pages, elements)
+        results[resource_type] = {
+            "full": full,
+            "projected": projected,
+            "wire_reduction": full["wire_bytes"] / max(projected["wire_bytes"], 1),
+            "body_reduction": full["body_bytes"] / max(projected["body_bytes"], 1),
+        }
+        print(
+            f"{resource_type}: {full['body_bytes']:,} -> {projected['body_bytes']:,} bytes decoded "
+            f"({results[resource_type]['body_reduction']:.1f}x), "
+            f"{full['wire_bytes']:,} -> {projected['wire_bytes']:,} bytes on the wire "
+            f"({results[resource_type]['wire_reduction']:.1f}x), "
+            f"decode {full['decode_seconds']:.3f}s -> {projected['decode_seconds']:.3f}s"
+        )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Local stand-in FHIR server for aggregator benchmarks.
+
+Serves `size` synthetic Immunizations, and the Patients they reference, built with the resource
+builders in `synthesizer/script.py`, so payloads look like what the synthesizer uploads to HAPI. Only a
+pool of `pool_size` Patient/Immunization pairs is actually built (the builders are slow); resource `n`
+is a copy of pool entry `n % pool_size` with its own id, so a million-record server starts in seconds
+and serves pages straight from the pool.
+
+Supports the searches the aggregator makes:
+- `GET Immunization?_count=` paged with `next` links, with optional `_include=Immunization:patient`
+- `POST Patient/_search` with `_id=a,b,c`, and `GET Patient/<id>`
+- `_elements` on all of the above, and gzip for clients that accept it
+- `GET Immunization?_summary=count` and `_sort=date|-date&_count=1`, as count aggregation searches
+- Immunization filters on `date` (`ge`/`lt`, `:missing`), `_lastUpdated` (`ge`/`gt`/`le`/`lt`),
+  `patient:missing`, `dose-number:exact`, `patient.gender` and `patient.birthdate` (`gt`/`le`), on paged
+  searches (so `FHIR_PARTITIONS` slices are disjoint) as well as count and `_sort` searches
+
+Each response is delayed by `latency` seconds, and page sizes are capped at `max_page_size`.
+
+Usage (standalone):
+    python benchmarks/fake_fhir_server.py --size 100000 --port 8080 [--latency 0.05]
+"""
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import random
+import sys
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+
+SYNTHESIZER_PATH = Path(__file__).resolve().parents[2] / "synthesizer"
+
+# Timestamp every served resource carries as `meta.lastUpdated`
+LAST_UPDATED = "2024-01-01T00:00:00Z"
+
+
+def build_pool(pool_size, seed):
+    """Build `pool_size` (Patient, Immunization) pairs with the synthesizer's resource builders."""
+    sys.path.insert(0, str(SYNTHESIZER_PATH))
+    import script
+
+    random.seed(seed)
+    script.faker.seed_instance(seed)
+    pool = []
+    for index in range(pool_size):
+        patient = script.create_patient_resource(f"patient-{index}")
+        immunization = script.create_immunization_resource(patient["id"], patient["birthDate"])
+        pool.append((patient, immunization))
+    return pool
+
+
+def project(resource, elements):
+    """Apply `_elements`: keep the listed elements, plus the ones FHIR always returns."""
+    if not elements:
+        return resource
+    resource_type = resource["resourceType"]
+    # Elements may be qualified by type (`Immunization.patient`) when a search `_include`s other types
+    wanted = {element.split(".")[-1] for element in elements if "." not in element or element.startswith(f"{resource_type}.")}
+    return {key: value for key, value in resource.items() if key in wanted or key in ("resourceType", "id", "meta")}
+
+
+def parse_instant(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def matches_last_updated(value):
+    """Whether the served resources' `LAST_UPDATED` matches one `_lastUpdated` filter, e.g. `gt2024-01-01T00:00:00Z`."""
+    prefix, bound = (value[:2], value[2:]) if value[:2] in ("ge", "gt", "le", "lt") else ("eq", value)
+    last_updated, bound = parse_instant(LAST_UPDATED), parse_instant(bound)
+    return {
+        "ge": last_updated >= bound, "gt": last_updated > bound, "le": last_updated <= bound,
+        "lt": last_updated < bound, "eq": last_updated == bound,
+    }[prefix]
+
+
+def matches_filters(patient, immunization, query):
+    """Whether a Patient/Immunization pair matches the Immunization search filters in `query`."""
+    occurrence = immunization.get("occurrenceDateTime")
+    if not all(matches_last_updated(value) for value in query.get("_lastUpdated", [])):
+        return False
+    doses = [protocol.get("doseNumberString") for protocol in immunization.get("protocolApplied", [])]
+    for value in query.get("patient:missing", []):
+        if ("reference" not in immunization.get("patient", {})) != (value == "true"):
+            return False
+    for value in query.get("date:missing", []):
+        if (occurrence is None) != (value == "true"):
+            return False
+    for value in query.get("date", []):
+        if occurrence is None or not (occurrence >= value[2:] if value[:2] == "ge" else occurrence < value[2:]):
+            return False
+    for value in query.get("dose-number:exact", []):
+        if value not in doses:
+            return False
+    for value in query.get("patient.gender", []):
+        if patient.get("gender") != value:
+            return False
+    for value in query.get("patient.birthdate", []):
+        birth_date = patient.get("birthDate")
+        if birth_date is None or not (birth_date > value[2:] if value[:2] == "gt" else birth_date <= value[2:]):
+            return False
+    return True
+
+
+class FakeFhirServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, size, patient_count, pool, latency, max_page_size):
+        super().__init__(address, FakeFhirHandler)
+        self.size = size
+        self.patient_count = patient_count
+        self.pool = pool
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.base_url = f"http://{self.server_address[0]}:{self.server_address[1]}/fhir"
+
+    def pool_counts(self):
+        """How many served Immunizations copy each pool entry, and the first of them, built on first use."""
+        if not hasattr(self, "multiplicity"):
+            self.multiplicity = [0] * len(self.pool)
+            self.first_index = [None] * len(self.pool)
+            for index in range(self.size):
+                entry = self.pool_entry(index)
+                self.multiplicity[entry] += 1
+                if self.first_index[entry] is None:
+                    self.first_index[entry] = index
+        return self.multiplicity, self.first_index
+
+    def patient(self, patient_index):
+        patient = dict(self.pool[patient_index % len(self.pool)][0])
+        patient["id"] = f"patient-{patient_index}"
+        patient["meta"] = {"versionId": "1", "lastUpdated": LAST_UPDATED}
+        return patient
+
+    def pool_entry(self, index):
+        """The pool entry served Immunization `index` copies."""
+        return (index % self.patient_count) % len(self.pool)
+
+    def immunization(self, index):
+        # Immunizations are spread round-robin over the patients
+        patient_index = index % self.patient_count
+        immunization = dict(self.pool[patient_index % len(self.pool)][1])
+        immunization["id"] = f"immunization-{index}"
+        immunization["meta"] = {"versionId": "1", "lastUpdated": LAST_UPDATED}
+        immunization["patient"] = {"reference": f"Patient/patient-{patient_index}"}
+        return immunization
+
+
+class FakeFhirHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.route(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        query.update(parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()))
+        self.route(url.path, query)
+
+    def route(self, path, query):
+        time.sleep(self.server.latency)
+        elements = query["_elements"][0].split(",") if "_elements" in query else None
+        parts = path.strip("/").split("/")[1:]  # drop the `fhir` prefix
+
+        if parts == ["Immunization"]:
+            return self.send(self.immunization_page(query, elements))
+        if parts == ["Patient", "_search"]:
+            patients = [
+                self.server.patient(int(patient_id.rsplit("-", 1)[1]))
+                for patient_id in query.get("_id", [""])[0].split(",")
+                if patient_id.startswith("patient-") and int(patient_id.rsplit("-", 1)[1]) < self.server.patient_count
+            ]
+            return self.send(self.bundle([project(patient, elements) for patient in patients], []))
+        if len(parts) == 2 and parts[0] == "Patient" and parts[1].startswith("patient-"):
+            return self.send(project(self.server.patient(int(parts[1].rsplit("-", 1)[1])), elements))
+        self.send({"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-supported"}]}, 400)
+
+    def immunization_page(self, query, elements):
+        if query.get("_summary") == ["count"] or "_sort" in query:
+            return self.filtered_immunizations(query, elements)
+
+        count = min(int(query.get("_count", ["20"])[0]), self.server.max_page_size)
+        # `_offset` is the index to scan on from, so pages of a filtered search skip the Immunizations it excludes
+        offset = int(query.get("_offset", ["0"])[0])
+        matching = [matches_filters(patient, immunization, query) for patient, immunization in self.server.pool]
+        indexes, index = [], offset
+        while index < self.server.size and len(indexes) < count:
+            if matching[self.server.pool_entry(index)]:
+                indexes.append(index)
+            index += 1
+        immunizations = [self.server.immunization(index) for index in indexes]
+        resources = [project(immunization, elements) for immunization in immunizations]
+
+        if "Immunization:patient" in query.get("_include", []):
+            patient_indexes = dict.fromkeys(int(i["patient"]["reference"].rsplit("-", 1)[1]) for i in immunizations)
+            resources += [project(self.server.patient(index), elements) for index in patient_indexes]
+
+        links = []
+        if index < self.server.size:
+            next_query = {**query, "_offset": [str(index)]}
+            links.append({"relation": "next", "url": f"{self.server.base_url}/Immunization?{urlencode(next_query, doseq=True)}"})
+        return self.bundle(resources, links)
+
+    def filtered_immunizations(self, query, elements):
+        """Answer a `_summary=count` or `_sort` search by matching pool entries, weighted by how often each is served."""
+        multiplicity, first_index = self.server.pool_counts()
+        matches = [
+            entry for entry, (patient, immunization) in enumerate(self.server.pool)
+            if multiplicity[entry] and matches_filters(patient, immunization, query)
+        ]
+        if query.get("_summary") == ["count"]:
+            return {"resourceType": "Bundle", "type": "searchset", "total": sum(multiplicity[entry] for entry in matches)}
+
+        sort = query["_sort"][0]
+        matches.sort(key=lambda entry: self.server.pool[entry][1].get("occurrenceDateTime", ""), reverse=sort.startswith("-"))
+        immunizations = [self.server.immunization(first_index[entry]) for entry in matches[:1]]
+        return self.bundle([project(immunization, elements) for immunization in immunizations], [])
+
+    def bundle(self, resources, links):
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "meta": {"lastUpdated": LAST_UPDATED},
+            "link": links,
+            "entry": [
+                {
+                    "fullUrl": f"{self.server.base_url}/{resource['resourceType']}/{resource['id']}",
+                    "resource": resource,
+                    "search": {"mode": "match" if resource["resourceType"] == "Immunization" else "include"},
+                }
+                for resource in resources
+            ],
+        }
+
+    def send(self, body, status=200):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(size, patient_count=None, pool_size=1000, latency=0.0, max_page_size=1000, port=0, seed=0, ready=None):
+    """Build the resource pool and serve until killed; sends the base URL to `ready` once listening."""
+    pool = build_pool(pool_size, seed)
+    server = FakeFhirServer(("127.0.0.1", port), size, patient_count or size, pool, latency, max_page_size)
+    if ready is not None:
+        ready.send(server.base_url)
+    server.serve_forever()
+
+
+def start_server(size, **options):
+    """Run `serve` in a child process, so serving doesn't compete with the benchmarked code for the GIL.
+
+    Returns the process (terminate it when done) and the server's FHIR base URL.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=serve, args=(size,), kwargs={**options, "ready": sender}, daemon=True)
+    process.start()
+    if not receiver.poll(timeout=300):
+        process.terminate()
+        raise RuntimeError("Fake FHIR server did not start")
+    return process, receiver.recv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=10000, help="Number of Immunizations to serve")
+    parser.add_argument("--patients", type=int, help="Number of Patients (default: one per Immunization)")
+    parser.add_argument("--pool", type=int, default=1000, help="Distinct Patient/Immunization pairs to build")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--max-page-size", type=int, default=1000, help="Largest page served, whatever `_count` asks")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    print(f"Serving {args.size:,} Immunizations at http://127.0.0.1:{args.port}/fhir")
+    serve(args.size, args.patients, args.pool, args.latency, args.max_page_size, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+FHIR Bulk Data sources for the aggregator.
+
+Paging through searches fetches a whole jurisdiction's data a thousand resources at a time, with a
+round trip per page and more for the Patients. With `FHIR_INGESTION_MODE=bulk` the aggregator instead
+asks the FHIR server for a Bulk Data export (https://hl7.org/fhir/uv/bulkdata/export.html):
+1. kick off `GET [base]/$export?_type=Patient,Immunization` with `Prefer: respond-async`;
+2. poll the status URL from `Content-Location` until the export is complete;
+3. stream each NDJSON output file from the completion manifest line by line.
+
+With `FHIR_INGESTION_MODE=ndjson` the same NDJSON is read from a local directory instead (files named
+after their resource type, e.g. `Patient.ndjson`, `Immunization-1.ndjson.gz`), so the pipeline can run
+offline against a saved export.
+
+Both sources implement:
+- `iter_resources(resource_type)`: every resource of that type, one line at a time;
+- `close()`: release the source (for an export, ask the server to delete its files).
+"""
+
+import gzip
+import json
+import logging
+import time
+from pathlib import Path
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+loads = orjson.loads if orjson is not None else json.loads
+
+
+class BulkExportError(Exception):
+    """The FHIR server refused, failed or didn't finish a Bulk Data export."""
+
+
+class BulkExport:
+    """A completed system-level `$export`, whose NDJSON output files are streamed on demand."""
+
+    def __init__(self, transport, status_url, manifest):
+        self.transport = transport
+        self.status_url = status_url
+        self.manifest = manifest
+
+    @classmethod
+    def run(cls, transport, fhir_url, resource_types, poll_interval, timeout):
+        """Kick off an export of `resource_types` and wait (up to `timeout` seconds) for it to complete."""
+        try:
+            response = transport.get(
+                f"{fhir_url}/$export",
+                params={"_type": ",".join(resource_types), "_outputFormat": "application/fhir+ndjson"},
+                headers={"Accept": "application/fhir+json", "Prefer": "respond-async"},
+            )
+        except requests.RequestException as e:
+            raise BulkExportError(f"Could not start bulk export: {e}") from e
+        if response.status_code != 202 or "Content-Location" not in response.headers:
+            raise BulkExportError(f"FHIR server did not accept the bulk export: {response.status_code} {response.text[:500]}")
+
+        status_url = response.headers["Content-Location"]
+        logging.info(f"Bulk export started, polling {status_url}")
+        return cls(transport, status_url, cls.wait_for_manifest(transport, status_url, poll_interval, timeout))
+
+    @staticmethod
+    def wait_for_manifest(transport, status_url, poll_interval, timeout):
+        """Poll the export's status URL until it returns the completion manifest."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                response = transport.get(status_url, headers={"Accept": "application/json"})
+            except requests.RequestException as e:
+                raise BulkExportError(f"Could not poll bulk export status: {e}") from e
+
+            if response.status_code == 200:
+                manifest = transport.decode_json(response)
+                for error in manifest.get("error", []):
+                    logging.warning(f"Bulk export reported errors in {error.get('url')}")
+                return manifest
+            if response.status_code != 202:
+                raise BulkExportError(f"Bulk export failed: {response.status_code} {response.text[:500]}")
+
+            if time.monotonic() >= deadline:
+                raise BulkExportError(f"Bulk export did not complete within {timeout} seconds")
+            # Servers pace polling with `Retry-After` (in seconds) and report progress in `X-Progress`
+            retry_after = response.headers.get("Retry-After", "")
+            logging.info(f"Bulk export in progress: {response.headers.get('X-Progress', 'no progress reported')}")
+            time.sleep(int(retry_after) if retry_after.isdigit() else poll_interval)
+
+    def iter_resources(self, resource_type):
+        for output in self.manifest.get("output", []):
+            if output.get("type") == resource_type:
+                for line in self.transport.iter_lines(output["url"], headers={"Accept": "application/fhir+ndjson"}):
+                    if line:
+                        yield loads(line)
+
+    def close(self):
+        # Lets the server delete the output files now rather than whenever they expire
+        try:
+            self.transport.request("DELETE", self.status_url)
+        except requests.RequestException as e:
+            logging.warning(f"Could not delete bulk export {self.status_url}: {e}")
+
+
+class NdjsonDirectory:
+    """NDJSON files in a local directory, e.g. a saved `$export`, named after the resource type they hold."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not self.path.is_dir():
+            raise BulkExportError(f"NDJSON directory {path} does not exist")
+
+    def iter_resources(self, resource_type):
+        for file_path in sorted(self.path.glob(f"{resource_type}*.ndjson*")):
+            opener = gzip.open if file_path.suffix == ".gz" else open
+            with opener(file_path, "rb") as ndjson_file:
+                for line in ndjson_file:
+                    if line.strip():
+                        resource = loads(line)
+                        if resource.get("resourceType") == resource_type:
+                            yield resource
+
+    def close(self):
+        pass
@@ -0,0 +1,214 @@
+"""
+Shared cache backends for the aggregator.
+
+Gunicorn runs several aggregator workers per pod, each with its own memory. A cache backend lets those
+workers share one aggregated result, the Patients fetched for it, and a lock deciding which worker
+recomputes the result when it goes stale.
+
+- `MemoryCacheBackend`: per-process only, the default and the previous behaviour.
+- `SQLiteCacheBackend`: a SQLite file shared by every worker in the pod (point it at `/dev/shm` to keep
+  it in shared memory), with an `flock` on a sibling lock file as the cross-process lock.
+- `RedisCacheBackend`: the PT namespace's Redis, shared by every worker in every pod. Needs `redis`.
+
+Every backend implements:
+- `get_result()` / `get_result_time()` / `set_result(data, aggregated_at, complete)`, where `complete` is
+  `False` for a result counted from part of the Immunizations (see `aggregation_checkpoint`)
+- `get_patients(patient_ids)` / `set_patients(patients)`
+- `refresh_lock()`: a non-blocking context manager yielding whether this worker holds the lock, which it keeps
+  for as long as the context lasts.
+"""
+
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import sqlite_store
+
+
+class MemoryCacheBackend:
+    """Keeps the result in this process only; patients are left to the worker's own `patient_cache`."""
+
+    def __init__(self):
+        self.result = (None, None, True)
+
+    def get_result(self):
+        return self.result
+
+    def get_result_time(self):
+        return self.result[1]
+
+    def set_result(self, data, aggregated_at, complete=True):
+        self.result = (data, aggregated_at, complete)
+
+    def get_patients(self, patient_ids):
+        return {}
+
+    def set_patients(self, patients):
+        pass
+
+    @contextmanager
+    def refresh_lock(self):
+        yield True
+
+
+class SQLiteCacheBackend:
+    """Shares the result and patients between the workers of one pod through a SQLite file."""
+
+    def __init__(self, path, patient_ttl):
+        self.path = path
+        self.patient_ttl = patient_ttl
+        self.connection_lock = threading.Lock()
+        self.connection = sqlite_store.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS result (id INTEGER PRIMARY KEY CHECK (id = 0), aggregated_at REAL, data TEXT)"
+        )
+        try:
+            # Result tables created before partial results existed
+            self.connection.execute("ALTER TABLE result ADD COLUMN complete INTEGER NOT NULL DEFAULT 1")
+        except sqlite3.OperationalError:
+            pass
+        self.connection.execute("CREATE TABLE IF NOT EXISTS patients (id TEXT PRIMARY KEY, stored_at REAL, data TEXT)")
+        # Expired patients are pruned on every `set_patients`, which shouldn't scan the whole table
+        self.connection.execute("CREATE INDEX IF NOT EXISTS patients_stored_at ON patients (stored_at)")
+
+    def get_result(self):
+        with self.connection_lock:
+            row = self.connection.execute("SELECT data, aggregated_at, complete FROM result WHERE id = 0").fetchone()
+        return (json.loads(row[0]), row[1], bool(row[2])) if row else (None, None, True)
+
+    def get_result_time(self):
+        with self.connection_lock:
+            row = self.connection.execute("SELECT aggregated_at FROM result WHERE id = 0").fetchone()
+        return row[0] if row else None
+
+    def set_result(self, data, aggregated_at, complete=True):
+        with self.connection_lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO result (id, aggregated_at, data, complete) VALUES (0, ?, ?, ?)",
+                (aggregated_at, json.dumps(data), int(complete)),
+            )
+
+    def get_patients(self, patient_ids):
+        oldest = time.time() - self.patient_ttl
+        with self.connection_lock:
+            rows = sqlite_store.select_in(
+                self.connection,
+                "SELECT id, data FROM patients WHERE stored_at >= ? AND id IN ({ids})",
+                patient_ids,
+                parameters=(oldest,),
+            )
+        return {patient_id: json.loads(data) for patient_id, data in rows}
+
+    def set_patients(self, patients):
+        now = time.time()
+        with self.connection_lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO patients (id, stored_at, data) VALUES (?, ?, ?)",
+                ((patient_id, now, json.dumps(patient)) for patient_id, patient in patients.items()),
+            )
+            self.connection.execute("DELETE FROM patients WHERE stored_at < ?", (now - self.patient_ttl,))
+            self.connection.execute("COMMIT")
+
+    @contextmanager
+    def refresh_lock(self):
+        with open(f"{self.path}.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class RedisCacheBackend:
+    """Shares the result and patients between every aggregator worker and pod through Redis."""
+
+    def __init__(self, host, port, password, namespace, patient_ttl, lock_timeout):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("SHARED_CACHE_BACKEND=redis requires the `redis` package") from e
+
+        self.client = redis.Redis(host=host, port=port, password=password)
+        self.prefix = f"aggregator:{namespace}"
+        self.patient_ttl = patient_ttl
+        self.lock_timeout = lock_timeout
+
+    def get_result(self):
+        data, aggregated_at, complete = self.client.hmget(f"{self.prefix}:result", "data", "aggregated_at", "complete")
+        if data is None:
+            return None, None, True
+        return json.loads(data), float(aggregated_at), complete != b"0"
+
+    def get_result_time(self):
+        aggregated_at = self.client.hget(f"{self.prefix}:result", "aggregated_at")
+        return float(aggregated_at) if aggregated_at is not None else None
+
+    def set_result(self, data, aggregated_at, complete=True):
+        self.client.hset(
+            f"{self.prefix}:result",
+            mapping={"data": json.dumps(data), "aggregated_at": aggregated_at, "complete": int(complete)},
+        )
+
+    def get_patients(self, patient_ids):
+        patient_ids = list(patient_ids)
+        if not patient_ids:
+            return {}
+        values = self.client.mget([f"{self.prefix}:patient:{patient_id}" for patient_id in patient_ids])
+        return {
+            patient_id: json.loads(value) for patient_id, value in zip(patient_ids, values) if value is not None
+        }
+
+    def set_patients(self, patients):
+        pipeline = self.client.pipeline(transaction=False)
+        for patient_id, patient in patients.items():
+            pipeline.set(f"{self.prefix}:patient:{patient_id}", json.dumps(patient), ex=self.patient_ttl)
+        pipeline.execute()
+
+    def extend_lock(self, lock, stop):
+        """Reset `lock`'s expiry every third of `lock_timeout` until `stop` is set, so it outlives long aggregations."""
+        while not stop.wait(self.lock_timeout / 3):
+            try:
+                lock.reacquire()
+            except Exception as e:
+                logging.warning(f"Could not extend the shared refresh lock: {e}")
+
+    @contextmanager
+    def refresh_lock(self):
+        # The timeout frees the lock if the worker holding it dies mid-aggregation; while it's alive, a
+        # heartbeat keeps extending it
+        lock = self.client.lock(f"{self.prefix}:refresh-lock", timeout=self.lock_timeout)
+        if not lock.acquire(blocking=False):
+            yield False
+            return
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.extend_lock, args=(lock, stop), name="refresh-lock-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            yield True
+        finally:
+            stop.set()
+            heartbeat.join()
+            try:
+                lock.release()
+            except Exception as e:
+                logging.warning(f"Could not release the shared refresh lock: {e}")
+
+
+def create_cache_backend(name, path, redis_host, redis_port, redis_password, namespace, patient_ttl, lock_timeout):
+    """Build the cache backend selected by `SHARED_CACHE_BACKEND`."""
+    if name == "memory":
+        return MemoryCacheBackend()
+    if name == "sqlite":
+        return SQLiteCacheBackend(path, patient_ttl)
+    if name == "redis":
+        return RedisCacheBackend(redis_host, redis_port, redis_password, namespace, patient_ttl, lock_timeout)
+    raise ValueError(f"Unknown SHARED_CACHE_BACKEND: {name}")
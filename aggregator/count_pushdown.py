@@ -0,0 +1,191 @@
+"""
+Count aggregation: group counts from FHIR `_summary=count` searches instead of downloading every resource.
+
+With `FHIR_INGESTION_MODE=count` the aggregator never sees an Immunization or Patient. It asks the FHIR
+server how many Immunizations match each cell of the OccurrenceYear × Dose × Sex × Age grid, and a few
+dozen to a few hundred tiny responses replace downloading the whole jurisdiction. Every search has
+`patient:missing=false`, since Immunizations without a patient aren't aggregated, and filters on:
+- OccurrenceYear: `date=ge{year}-01-01&date=lt{year + 1}-01-01` per year, and `date:missing=true`;
+- Dose: `{COUNT_DOSE_PARAMETER}:exact={dose}` per dose other than 1 (a custom SearchParameter on
+  `Immunization.protocolApplied.doseNumber`, which FHIR doesn't define);
+- Sex: `patient.gender=male|female|other`, chained through the Immunization's patient;
+- Age: `patient.birthdate=gt{date}&patient.birthdate=le{date}`, the birth dates that make up each age
+  group at the group's reference date (see `age_groups.birth_date_range`).
+
+Every search filters on positive values only. The groups full aggregation puts everything else in (Dose 1
+for missing or unlisted doses, Sex `Unknown`, Age `Other` and `Unknown`) are the difference between a
+count without that dimension's filter and the sum of its listed values. The grid is counted a dimension at a
+time, one parallel round of searches per level. A cell that counts zero isn't split any further, and nor is
+a remainder that is empty, so the number of searches follows the cells that actually hold data.
+"""
+
+from collections import Counter
+from itertools import islice, product
+
+from age_groups import birth_date_range
+
+# A dimension not filtered on, in a searched cell
+ANY = None
+
+# Marks an option whose cell has no remainder group (the listed options add up to the whole cell)
+EXACT = "exact"
+
+# The Age option of Immunizations whose patient has an age at all (born on or before the reference date)
+KNOWN = "known"
+
+SEXES = (("Male", "male"), ("Female", "female"), ("Other", "other"))
+
+# Every search's base filter: full aggregation drops Immunizations without a patient reference
+BASE_FILTER = "patient:missing=false"
+
+# Ages, in years, beyond which one-group-per-year ranges stop being searched
+MAX_AGE = 150
+
+# Age ranges searched per cell and round
+AGE_RANGES_PER_ROUND = 10
+
+
+class CountBudgetExceeded(Exception):
+    """Counting the grid would take more searches than allowed."""
+
+
+class StaleCountPlan(Exception):
+    """The counts don't add up (the plan's years are out of date, or data changed while counting)."""
+
+
+class CountPlan:
+    """The `_summary=count` searches of a count aggregation, and how their totals combine into group counts.
+
+    A plan holds what's worth reusing between aggregations: the occurrence years to split on, the doses
+    and the age groups. `count` raises `StaleCountPlan` when the year totals no longer add up to the total,
+    e.g. once Immunizations from a new year exist, and a new plan is needed.
+    """
+
+    def __init__(self, years, doses, dose_parameter, age_grouper, jurisdiction):
+        self.years = years
+        self.doses = [dose for dose in doses if dose != 1]
+        self.dose_parameter = dose_parameter
+        self.age_grouper = age_grouper
+        self.jurisdiction = jurisdiction
+        self.request_count = 0
+
+    def count(self, count_searches, max_requests):
+        """Count every group as `{group key: count}`, keyed like `aggregator.get_group_key`.
+
+        `count_searches(searches)` returns the `_summary=count` total of each Immunization search (a list of
+        query strings), ideally searching in parallel. Raises `CountBudgetExceeded` past `max_requests` searches.
+        """
+        self.request_count = 0
+
+        def run(searches):
+            self.request_count += len(searches)
+            if self.request_count > max_requests:
+                raise CountBudgetExceeded(f"Counting needs more than COUNT_MAX_REQUESTS={max_requests} searches")
+            return count_searches(["&".join(params) for params in searches]) if searches else []
+
+        year_options = [
+            (str(year), [BASE_FILTER, f"date=ge{year}-01-01", f"date=lt{year + 1}-01-01"]) for year in self.years
+        ]
+        year_options.append(("Unknown", [BASE_FILTER, "date:missing=true"]))
+        total, *year_counts = run([[BASE_FILTER]] + [params for _, params in year_options])
+        if sum(year_counts) != total:
+            raise StaleCountPlan(f"Occurrence years add up to {sum(year_counts)} of {total} Immunizations")
+
+        cells = [((label,), params, n) for (label, params), n in zip(year_options, year_counts) if n]
+        dose_options = [(dose, [f"{self.dose_parameter}:exact={dose}"]) for dose in self.doses]
+        cells = self.split(cells, dose_options, run)
+        cells = self.split(cells, [(sex, [f"patient.gender={code}"]) for sex, code in SEXES], run)
+        return self.combine(self.split_ages(cells, run))
+
+    def split(self, cells, options, run):
+        """Split each cell into one per non-empty option, plus its `ANY` cell (the cell itself) if it has a remainder."""
+        searches = [(cell, label, cell[1] + option_params) for cell in cells for label, option_params in options]
+        counts = iter(run([params for _, _, params in searches]))
+
+        split_cells = []
+        for labels, params, n in cells:
+            children = [(label, option_params, next(counts)) for _, label, option_params in searches[:len(options)]]
+            searches = searches[len(options):]
+            remainder = n - sum(count for _, _, count in children)
+            if remainder < 0:
+                raise StaleCountPlan("Counts changed while the grid was being counted")
+            if remainder:
+                split_cells.append((labels + (ANY,), params, n))
+            split_cells += [
+                (labels + (label if remainder else (EXACT, label),), option_params, count)
+                for label, option_params, count in children if count
+            ]
+        return split_cells
+
+    def split_ages(self, cells, run):
+        """Count each cell's patients born by its reference date (`KNOWN`), then by age group until they're all placed."""
+        leaves = [(labels + (ANY,), n) for labels, _, n in cells]
+
+        dated_cells = []
+        for labels, params, n in cells:
+            reference_date = self.age_grouper.get_reference_date(labels[0])
+            if reference_date is not None:
+                dated_cells.append((labels, params + [f"patient.birthdate=le{reference_date.isoformat()}"], reference_date))
+        known_counts = run([params for _, params, _ in dated_cells])
+
+        # [labels, params, reference date, age ranges left, patients not yet placed in a group]
+        pending = []
+        for (labels, params, reference_date), known in zip(dated_cells, known_counts):
+            if known:
+                leaves.append((labels + (KNOWN,), known))
+                pending.append([labels, params[:-1], reference_date, self.age_grouper.iter_age_ranges(), known])
+
+        while pending:
+            searches = []
+            for cell in pending:
+                labels, params, reference_date, ranges, _ = cell
+                for label, low, high in islice(ranges, AGE_RANGES_PER_ROUND):
+                    if low > MAX_AGE:
+                        break
+                    after, until = birth_date_range(low, high, reference_date)
+                    birth_dates = [f"patient.birthdate=le{until.isoformat()}"]
+                    if after is not None:
+                        birth_dates.append(f"patient.birthdate=gt{after.isoformat()}")
+                    searches.append((cell, label, params + birth_dates))
+            counts = run([params for _, _, params in searches])
+
+            searched = set()
+            for (cell, label, _), n in zip(searches, counts):
+                searched.add(id(cell))
+                if n:
+                    leaves.append((cell[0] + (label,), n))
+                    cell[4] -= n
+            # Done once every patient is placed, or the ranges have run out (the rest are `Other`)
+            pending = [cell for cell in pending if cell[4] > 0 and id(cell) in searched]
+        return leaves
+
+    def combine(self, leaves):
+        """Turn the searched cells' counts into group counts, filling in each dimension's remainder group.
+
+        A searched option contributes to its own group and, negatively, to the remainder; an `ANY` cell
+        contributes to the remainder. Summed over a cell's options, the remainder gets what's left over.
+        """
+        def remainder_groups(option, remainder):
+            if option is ANY:
+                return [(remainder, 1)]
+            if isinstance(option, tuple):
+                return [(option[1], 1)]
+            return [(option, 1), (remainder, -1)]
+
+        def age_groups(option):
+            if option is ANY:
+                return [("Unknown", 1)]
+            if option == KNOWN:
+                return [("Other", 1), ("Unknown", -1)]
+            return [(option, 1), ("Other", -1)]
+
+        group_counts = Counter()
+        for (year, dose, sex, age), n in leaves:
+            for (dose_group, dose_sign), (sex_group, sex_sign), (age_group, age_sign) in product(
+                remainder_groups(dose, 1), remainder_groups(sex, "Unknown"), age_groups(age)
+            ):
+                group_counts[(year, self.jurisdiction, sex_group, age_group, dose_group)] += n * dose_sign * sex_sign * age_sign
+
+        if any(n < 0 for n in group_counts.values()):
+            raise StaleCountPlan("Counts changed while the grid was being counted")
+        return Counter({key: n for key, n in group_counts.items() if n})
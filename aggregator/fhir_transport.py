@@ -0,0 +1,335 @@
+"""
+HTTP transport for the aggregator's FHIR requests.
+
+All FHIR calls go through one transport, selected by `FHIR_FETCH_ENGINE`, which provides:
+- connections to the FHIR server that are kept alive and pooled;
+- `Accept-Encoding: gzip`, so bundles travel compressed;
+- retries with exponential backoff on 429 and 5xx responses (honouring `Retry-After`);
+- `request_all()`, for independent requests such as the Patient searches of one Immunization page;
+- line-by-line streaming of large bodies, such as Bulk Data NDJSON files;
+- JSON decoding with `orjson` when it is installed, falling back to the standard library;
+- `cancel()`, which fails the requests of a refresh that has been superseded with `FetchCancelled`;
+- per-request timing counters, reported by `stats()`.
+
+- `FhirTransport` (`requests`, the default): a `requests.Session` whose pool is sized to the number of
+  threads fetching at once. Each request blocks its thread, so `request_all()` sends one at a time.
+- `AsyncFhirTransport` (`async`): an `httpx.AsyncClient` on a dedicated event-loop thread, driven by the
+  same blocking calls from any thread. `request_all()` sends its requests concurrently, and at most
+  `concurrency` requests are in flight at once across every thread. Needs `httpx`.
+
+Responses are `requests.Response`s and failures `requests.RequestException`s with either transport.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class FetchCancelled(Exception):
+    """The transport was cancelled (see `cancel()`) while, or before, this request was sent."""
+
+
+class FhirTransport:
+    """Pooled, retrying, timed HTTP client for a FHIR server."""
+
+    def __init__(self, pool_size, retries, backoff_factor, timeout=10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/fhir+json", "Accept-Encoding": "gzip"})
+
+        retry_strategy = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=list(RETRY_STATUSES),
+            # POSTs here are `_search`es, which are as safe to repeat as GETs
+            allowed_methods=["GET", "POST"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry_strategy)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.cancelled = threading.Event()
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.request_seconds = 0.0
+        self.response_bytes = 0
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pooled session, recording its timing."""
+        self.check_cancelled()
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            self.record(time.perf_counter() - started, 0, failed=True)
+            raise
+        self.record(time.perf_counter() - started, len(response.content), failed=not response.ok)
+        return response
+
+    def request_all(self, requests_to_send):
+        """Send `(method, url, kwargs)` requests one after another; failed ones give their exception instead of a response."""
+        responses = []
+        for method, url, kwargs in requests_to_send:
+            try:
+                responses.append(self.request(method, url, **kwargs))
+            except requests.RequestException as e:
+                responses.append(e)
+        return responses
+
+    def iter_lines(self, url, **kwargs):
+        """Stream a `GET` response body line by line (e.g. NDJSON), without holding the whole body in memory."""
+        self.check_cancelled()
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout, stream=True, **kwargs)
+            response.raise_for_status()
+        except requests.RequestException:
+            self.record(time.perf_counter() - started, 0, failed=True)
+            raise
+
+        size = 0
+        with response:
+            for line in response.iter_lines():
+                size += len(line) + 1
+                yield line
+        self.record(time.perf_counter() - started, size, failed=False)
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise FetchCancelled("FHIR requests were cancelled")
+
+    def cancel(self):
+        """Fail every request from now until `reset()` with `FetchCancelled`."""
+        self.cancelled.set()
+
+    def reset(self):
+        """Accept requests again after `cancel()`; called as each refresh starts."""
+        self.cancelled.clear()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    @staticmethod
+    def decode_json(response):
+        """Decode a response body, raising `requests.exceptions.InvalidJSONError` if it isn't JSON."""
+        if orjson is None:
+            return response.json()
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError as e:
+            raise requests.exceptions.InvalidJSONError(f"Invalid JSON from {response.url}: {e}") from e
+
+    def record(self, seconds, size, failed):
+        with self.stats_lock:
+            self.request_count += 1
+            self.error_count += failed
+            self.request_seconds += seconds
+            self.response_bytes += size
+
+    def stats(self):
+        """Request count, failures, total and mean latency, and decompressed bytes received."""
+        with self.stats_lock:
+            return {
+                "requests": self.request_count,
+                "errors": self.error_count,
+                "seconds": round(self.request_seconds, 3),
+                "mean_seconds": round(self.request_seconds / self.request_count, 4) if self.request_count else 0,
+                "bytes": self.response_bytes,
+                "json_decoder": "orjson" if orjson is not None else "json",
+            }
+
+
+class AsyncFhirTransport(FhirTransport):
+    """`FhirTransport`'s interface over an `httpx.AsyncClient` running on its own event-loop thread.
+
+    Every request runs as a task on the loop; calling threads block on its result. `cancel()` also
+    cancels the tasks in flight, so a superseded refresh stops waiting on the FHIR server at once.
+    """
+
+    def __init__(self, concurrency, retries, backoff_factor, timeout=10):
+        try:
+            import httpx
+        except ImportError as e:
+            raise RuntimeError("FHIR_FETCH_ENGINE=async requires the `httpx` package") from e
+
+        self.httpx = httpx
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.cancelled = threading.Event()
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.request_seconds = 0.0
+        self.response_bytes = 0
+
+        self.tasks = set()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="fhir-event-loop", daemon=True).start()
+        self.client, self.semaphore = asyncio.run_coroutine_threadsafe(self.open(concurrency), self.loop).result()
+
+    async def open(self, concurrency):
+        # One keep-alive pool per host, as large as the number of requests allowed in flight
+        client = self.httpx.AsyncClient(
+            headers={"Accept": "application/fhir+json", "Accept-Encoding": "gzip"},
+            limits=self.httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            timeout=self.timeout,
+        )
+        return client, asyncio.Semaphore(concurrency)
+
+    def run(self, coroutine):
+        """Run `coroutine` on the event loop and wait for its result, raising `FetchCancelled` if it's cancelled."""
+        self.check_cancelled()
+        future = asyncio.run_coroutine_threadsafe(self.track(coroutine), self.loop)
+        try:
+            return future.result()
+        except (concurrent.futures.CancelledError, asyncio.CancelledError) as e:
+            raise FetchCancelled("FHIR requests were cancelled") from e
+
+    async def track(self, coroutine):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await coroutine
+        finally:
+            self.tasks.discard(task)
+
+    async def send(self, method, url, **kwargs):
+        """Send one request, retrying 429/5xx responses and connection errors; returns a `requests.Response`."""
+        started = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    response = await self.client.request(method, url, **kwargs)
+                    content = await response.aread()
+            except self.httpx.HTTPError as e:
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+                    continue
+                self.record(time.perf_counter() - started, 0, failed=True)
+                raise self.to_requests_error(e, method, url) from e
+
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                retry_after = response.headers.get("Retry-After", "")
+                await asyncio.sleep(int(retry_after) if retry_after.isdigit() else self.backoff_factor * 2 ** attempt)
+                continue
+            break
+
+        converted = self.to_requests_response(response, content)
+        self.record(time.perf_counter() - started, len(content), failed=not converted.ok)
+        return converted
+
+    def to_requests_response(self, response, content):
+        converted = requests.Response()
+        converted.status_code = response.status_code
+        converted.reason = response.reason_phrase
+        converted.headers = requests.structures.CaseInsensitiveDict(response.headers)
+        converted.url = str(response.url)
+        converted.encoding = response.encoding
+        converted._content = content
+        return converted
+
+    def to_requests_error(self, error, method, url):
+        message = f"{method} {url} failed: {error!r}"
+        if isinstance(error, self.httpx.TimeoutException):
+            return requests.Timeout(message)
+        if isinstance(error, self.httpx.TransportError):
+            return requests.ConnectionError(message)
+        return requests.RequestException(message)
+
+    def request(self, method, url, **kwargs):
+        """Send a request on the event loop and wait for it, recording its timing."""
+        return self.run(self.send(method, url, **kwargs))
+
+    def request_all(self, requests_to_send):
+        """Send `(method, url, kwargs)` requests concurrently; failed ones give their exception instead of a response."""
+        async def send_all():
+            responses = await asyncio.gather(
+                *(self.send(method, url, **kwargs) for method, url, kwargs in requests_to_send), return_exceptions=True
+            )
+            for response in responses:
+                if isinstance(response, BaseException) and not isinstance(response, requests.RequestException):
+                    raise response
+            return responses
+
+        return self.run(send_all())
+
+    def iter_lines(self, url, **kwargs):
+        """Stream a `GET` response body line by line, a thousand lines per hop from the event loop."""
+        started = time.perf_counter()
+        stream = self.client.stream("GET", url, **kwargs)
+
+        async def open_stream():
+            try:
+                response = await stream.__aenter__()
+            except self.httpx.HTTPError as e:
+                raise self.to_requests_error(e, "GET", url) from e
+            if response.is_error:
+                await stream.__aexit__(None, None, None)
+                self.to_requests_response(response, b"").raise_for_status()
+            return response.aiter_lines()
+
+        async def read_lines(lines):
+            batch = []
+            async for line in lines:
+                batch.append(line.encode())
+                if len(batch) == 1000:
+                    break
+            return batch
+
+        try:
+            lines = self.run(open_stream())
+        except requests.RequestException:
+            self.record(time.perf_counter() - started, 0, failed=True)
+            raise
+
+        size = 0
+        try:
+            while True:
+                batch = self.run(read_lines(lines))
+                if not batch:
+                    break
+                for line in batch:
+                    size += len(line) + 1
+                    yield line
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.__aexit__(None, None, None), self.loop).result()
+        self.record(time.perf_counter() - started, size, failed=False)
+
+    def cancel(self):
+        """Fail every request from now until `reset()` with `FetchCancelled`, and cancel those in flight."""
+        self.cancelled.set()
+
+        def cancel_tasks():
+            for task in list(self.tasks):
+                task.cancel()
+
+        self.loop.call_soon_threadsafe(cancel_tasks)
+
+
+def create_fhir_transport(engine, pool_size, concurrency, retries, backoff_factor):
+    """Build the transport selected by `FHIR_FETCH_ENGINE`."""
+    if engine == "requests":
+        return FhirTransport(pool_size, retries, backoff_factor)
+    if engine == "async":
+        return AsyncFhirTransport(concurrency, retries, backoff_factor)
+    raise ValueError(f"Unknown FHIR_FETCH_ENGINE: {engine}")
@@ -0,0 +1,8 @@
+"""Gunicorn settings picked up from the working directory, alongside the command-line flags in the Dockerfile."""
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauge samples from the combined `/metrics` output."""
+    multiprocess.mark_process_dead(worker.pid)
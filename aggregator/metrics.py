@@ -0,0 +1,98 @@
+"""
+Prometheus metrics for the aggregator, served at `/metrics`.
+
+Gunicorn runs several workers per pod and a scrape reaches only one of them, so when
+`PROMETHEUS_MULTIPROC_DIR` is set (as it is in the image) every worker writes its samples there and
+`/metrics` reports all workers combined (see `gunicorn.conf.py`). Without it, as in local development,
+`/metrics` reports the serving process only.
+
+Counters that would otherwise be bumped once per record or per cache lookup are added in bulk: records
+once per page, and patient cache events from `PatientCache.stats()` once per aggregation.
+"""
+
+import os
+import threading
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Latency buckets, in seconds, for single FHIR requests and for whole aggregations
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+AGGREGATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+FHIR_PAGE_FETCH_SECONDS = Histogram(
+    "aggregator_fhir_page_fetch_seconds",
+    "Time to fetch and decode one FHIR search page",
+    ["resource_type"],
+    buckets=REQUEST_BUCKETS,
+)
+PATIENT_FETCH_SECONDS = Histogram(
+    "aggregator_patient_fetch_seconds",
+    "Time to resolve the Patients of one Immunization page (batch) or one uncached Patient (single)",
+    ["mode"],
+    buckets=REQUEST_BUCKETS,
+)
+AGGREGATION_SECONDS = Histogram(
+    "aggregator_aggregation_seconds",
+    "Duration of an aggregation",
+    ["mode"],
+    buckets=AGGREGATION_BUCKETS,
+)
+RECORDS_PROCESSED = Counter(
+    "aggregator_records_processed_total",
+    "Immunization records processed",
+)
+RECORDS_DROPPED = Counter(
+    "aggregator_records_dropped_total",
+    "Immunization records process_immunization_record could not aggregate",
+)
+PATIENT_CACHE_EVENTS = Counter(
+    "aggregator_patient_cache_events_total",
+    "Patient cache lookups and evictions",
+    ["event"],
+)
+CACHED_RESULT_AGE_SECONDS = Gauge(
+    "aggregator_cached_result_age_seconds",
+    "Age of the aggregated result being served, as of the last scrape",
+    multiprocess_mode="mostrecent",
+)
+RESULT_COMPLETE = Gauge(
+    "aggregator_result_complete",
+    "1 if the aggregated result being served counted every Immunization, 0 if it is partial",
+    multiprocess_mode="mostrecent",
+)
+RESULT_VERSION = Gauge(
+    "aggregator_result_version",
+    "Number of the aggregated result being served in its snapshot history epoch",
+    multiprocess_mode="mostrecent",
+)
+
+# `PatientCache.stats()` counters already added to `PATIENT_CACHE_EVENTS`
+reported_patient_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+reported_patient_cache_stats_lock = threading.Lock()
+
+
+def record_patient_cache_stats(stats):
+    """Add the patient cache hits, misses and evictions counted since the previous call."""
+    with reported_patient_cache_stats_lock:
+        for name, event in (("hits", "hit"), ("misses", "miss"), ("evictions", "eviction")):
+            # A count below the one reported is from a replaced cache, which counts from zero again
+            reported = reported_patient_cache_stats[name] if stats[name] >= reported_patient_cache_stats[name] else 0
+            PATIENT_CACHE_EVENTS.labels(event).inc(stats[name] - reported)
+            reported_patient_cache_stats[name] = stats[name]
+
+
+def render_metrics():
+    """The `/metrics` body and content type, combining every worker's samples in multiprocess mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,99 @@
+"""
+Compact, memory-bounded patient cache for the aggregator.
+
+Aggregation only needs a Patient's gender and birth date (plus its version, to tell when a cached copy
+is out of date), so rather than whole Patient resources, with their names, addresses, identifiers and
+extensions, the cache holds a `PatientSummary` of just those fields. Capacity is a memory budget in
+bytes rather than an entry count, and hit/miss/eviction counters are kept for monitoring. Lookups and
+inserts are locked, so partitions fetched on parallel threads can share one cache.
+"""
+
+import sys
+import threading
+
+from cachetools import LRUCache
+
+
+class PatientSummary:
+    """The fields of a FHIR Patient that aggregation uses."""
+
+    __slots__ = ("gender", "birth_date", "version_id")
+
+    def __init__(self, gender, birth_date, version_id=None):
+        # Genders, birth dates and versions repeat across many patients, so share one copy of each
+        self.gender = sys.intern(gender)
+        self.birth_date = sys.intern(birth_date)
+        self.version_id = sys.intern(version_id) if version_id is not None else None
+
+    @classmethod
+    def from_resource(cls, patient):
+        """Summarize a FHIR Patient resource."""
+        return cls(
+            gender=patient.get("gender", "Unknown"),
+            birth_date=patient.get("birthDate", ""),
+            version_id=patient.get("meta", {}).get("versionId"),
+        )
+
+    def as_dict(self):
+        """JSON-serializable form, accepted back by `PatientSummary(**data)`."""
+        return {"gender": self.gender, "birth_date": self.birth_date, "version_id": self.version_id}
+
+
+# Rough per-entry cost of the patient id key and the LRU bookkeeping (dict slots, linked-list node)
+ENTRY_OVERHEAD_BYTES = 230
+
+
+def get_entry_size(summary):
+    """Approximate memory held by one cache entry; interned field values are shared and not counted."""
+    return sys.getsizeof(summary) + ENTRY_OVERHEAD_BYTES
+
+
+class PatientCache(LRUCache):
+    """LRU cache of `PatientSummary` by patient id, bounded by an approximate memory budget in bytes."""
+
+    def __init__(self, max_bytes):
+        super().__init__(maxsize=max_bytes, getsizeof=get_entry_size)
+        # Reentrant, since inserts evict (`popitem`) while holding it
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        with self.lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+
+    def get(self, key, default=None):
+        # Hits and misses are counted here rather than in `__getitem__`, which evictions (`popitem`) also go through
+        with self.lock:
+            if key in self:
+                self.hits += 1
+                return self[key]
+            self.misses += 1
+            return default
+
+    def popitem(self):
+        with self.lock:
+            item = super().popitem()
+            self.evictions += 1
+            return item
+
+    def stats(self):
+        """Hit/miss/eviction counters and current size, for monitoring."""
+        with self.lock:
+            return {
+                "entries": len(self),
+                "bytes": self.currsize,
+                "max_bytes": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,62 @@
+"""
+Persistent on-disk patient index for the aggregator.
+
+The in-memory patient cache starts empty whenever a pod restarts, so without this index the first
+aggregation after every deploy re-fetches every Patient. `PatientIndex` keeps each Patient's
+`PatientSummary` in a SQLite file on a mounted volume instead, along with a watermark: the FHIR server
+time up to which the stored summaries are known to be current. The aggregator revalidates the whole
+index with one `Patient?_lastUpdated=gt<watermark>` search per refresh rather than re-downloading it.
+"""
+
+import threading
+
+import sqlite_store
+from patient_cache import PatientSummary
+
+
+class PatientIndex:
+    """`PatientSummary` by patient id in a SQLite file, with the watermark it was last revalidated at."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite_store.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS patients (id TEXT PRIMARY KEY, gender TEXT, birth_date TEXT, version_id TEXT)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+
+    def get_many(self, patient_ids):
+        """Summaries of the given patients that are in the index."""
+        with self.lock:
+            rows = sqlite_store.select_in(
+                self.connection,
+                "SELECT id, gender, birth_date, version_id FROM patients WHERE id IN ({ids})",
+                patient_ids,
+            )
+        return {row[0]: PatientSummary(*row[1:]) for row in rows}
+
+    def put_many(self, summaries):
+        """Insert or replace the given `{patient id: PatientSummary}`."""
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO patients (id, gender, birth_date, version_id) VALUES (?, ?, ?, ?)",
+                (
+                    (patient_id, summary.gender, summary.birth_date, summary.version_id)
+                    for patient_id, summary in summaries.items()
+                ),
+            )
+            self.connection.execute("COMMIT")
+
+    def get_watermark(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, watermark):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('watermark', ?)", (watermark,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
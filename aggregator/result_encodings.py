@@ -0,0 +1,84 @@
+"""
+Serialized representations of aggregated records for `/aggregated-data`.
+
+- `json`: the list of records, as before (encoded with `orjson` when it is installed).
+- `csv`: one header row, then one row per record.
+- `arrow`: an Arrow IPC stream. Needs `pyarrow` (`requirements-arrow.txt`).
+- `parquet`: a Parquet file. Needs `pyarrow` (`requirements-arrow.txt`).
+
+Every representation except Parquet, which compresses its own column chunks, can also be gzipped.
+"""
+
+import csv
+import gzip
+import io
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns of every record, in output order: the `aggregated_result.DIMENSIONS`, then the count and its reference date
+COLUMNS = ("OccurrenceYear", "Jurisdiction", "Sex", "Age", "Dose", "Count", "ReferenceDate")
+
+
+def encode_json(records):
+    if orjson is None:
+        return json.dumps(records, sort_keys=True, separators=(",", ":")).encode()
+    return orjson.dumps(records, option=orjson.OPT_SORT_KEYS)
+
+
+def encode_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue().encode()
+
+
+def to_arrow_table(records):
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise RuntimeError("format=arrow and format=parquet require the `pyarrow` package") from e
+
+    return pyarrow.table({column: [record[column] for record in records] for column in COLUMNS})
+
+
+def encode_arrow(records):
+    import pyarrow
+
+    table = to_arrow_table(records)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_parquet(records):
+    import pyarrow.parquet
+
+    table = to_arrow_table(records)
+    sink = io.BytesIO()
+    pyarrow.parquet.write_table(table, sink)
+    return sink.getvalue()
+
+
+# Format name: (MIME type, encoder, whether gzipping the body helps)
+FORMATS = {
+    "json": ("application/json", encode_json, True),
+    "csv": ("text/csv", encode_csv, True),
+    "arrow": ("application/vnd.apache.arrow.stream", encode_arrow, True),
+    "parquet": ("application/vnd.apache.parquet", encode_parquet, False),
+}
+
+
+def encode(records, output_format, compressed=False):
+    """Records serialized as `output_format`, gzipped if `compressed`.
+
+    Raises `RuntimeError` if the format needs a package that isn't installed.
+    """
+    body = FORMATS[output_format][1](records)
+    # A fixed mtime keeps the same records encoding to the same bytes
+    return gzip.compress(body, compresslevel=6, mtime=0) if compressed else body
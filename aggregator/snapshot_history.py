@@ -0,0 +1,151 @@
+"""
+Versioned history of aggregated results, so `/aggregated-data?since=<version>` can send only what changed.
+
+Every refresh replaces the whole result, and the federator used to pull the whole table on every poll
+without knowing what, if anything, had changed. `SnapshotHistory` numbers each distinct result instead:
+- a new version is recorded only when the content changes (by its `AggregatedResult.content_hash`), so
+  refreshes that change nothing keep the version the federator already has;
+- each version is stored as its changes from the previous one: per group row, the values before and
+  after, zlib-compressed JSON. Only the latest version's rows are stored in full;
+- the `max_versions` most recent versions are kept, and the changes since any of them are those
+  versions' changes combined, leaving out rows that changed and then changed back.
+
+It lives in a SQLite file (`SNAPSHOT_HISTORY_PATH`), so versions survive restarts when the file is on a
+mounted volume, and the gunicorn workers of a pod that share the file number versions the same way.
+Versions are `<epoch>.<number>`, where the epoch is drawn when the file is created: a lost file starts
+numbering from 1 again, and its epoch keeps the new numbers from being mistaken for the old ones.
+"""
+
+import json
+import secrets
+import threading
+import zlib
+
+import sqlite_store
+from aggregated_result import DIMENSIONS
+from result_encodings import COLUMNS
+
+# Columns of a record that aren't dimensions, i.e. its values
+VALUE_COLUMNS = tuple(column for column in COLUMNS if column not in DIMENSIONS)
+
+
+def pack(rows):
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode())
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+def to_rows(records):
+    """`{dimension values: record values}` of aggregated records."""
+    return {
+        tuple(record[dimension] for dimension in DIMENSIONS): tuple(record[column] for column in VALUE_COLUMNS)
+        for record in records
+    }
+
+
+def to_record(key, values=None):
+    """An aggregated record from its dimension values and, unless it was removed, its values."""
+    record = dict(zip(DIMENSIONS, key))
+    if values is not None:
+        record.update(zip(VALUE_COLUMNS, values))
+    return record
+
+
+class SnapshotHistory:
+    """The last `max_versions` versions of the aggregated result, each stored as its changes from the one before."""
+
+    def __init__(self, path, max_versions=100):
+        self.max_versions = max_versions
+        self.lock = threading.Lock()
+        self.connection = sqlite_store.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS versions (version INTEGER PRIMARY KEY, aggregated_at REAL, content_hash TEXT, changes BLOB)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS latest (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER, rows BLOB)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        # Every worker sharing the file reads back whichever epoch was stored first
+        self.connection.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('epoch', ?)", (secrets.token_hex(4),))
+        self.epoch = self.connection.execute("SELECT value FROM state WHERE key = 'epoch'").fetchone()[0]
+
+    def format_version(self, number):
+        return f"{self.epoch}.{number}"
+
+    def parse_version(self, version):
+        """The number of a version of this history, or `None` for another epoch's (or a malformed) version."""
+        epoch, _, number = str(version).rpartition(".")
+        return int(number) if epoch == self.epoch and number.isdigit() else None
+
+    def record(self, records, aggregated_at, content_hash):
+        """The version of a result: the latest one if its content is unchanged, else a newly recorded one."""
+        with self.lock:
+            # `IMMEDIATE` so workers sharing the file can't both number a new version
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                latest = self.connection.execute(
+                    "SELECT version, content_hash FROM versions ORDER BY version DESC LIMIT 1"
+                ).fetchone()
+                if latest is not None and latest[1] == content_hash:
+                    self.connection.execute("COMMIT")
+                    return self.format_version(latest[0])
+
+                row = self.connection.execute("SELECT rows FROM latest WHERE id = 0").fetchone()
+                previous = {tuple(key): tuple(values) for key, values in unpack(row[0])} if row else {}
+                rows = to_rows(records)
+                changes = [
+                    [key, previous.get(key), rows.get(key)]
+                    for key in previous.keys() | rows.keys()
+                    if previous.get(key) != rows.get(key)
+                ]
+
+                version = latest[0] + 1 if latest is not None else 1
+                self.connection.execute(
+                    "INSERT INTO versions (version, aggregated_at, content_hash, changes) VALUES (?, ?, ?, ?)",
+                    (version, aggregated_at, content_hash, pack(changes)),
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO latest (id, version, rows) VALUES (0, ?, ?)",
+                    (version, pack(list(rows.items()))),
+                )
+                self.connection.execute("DELETE FROM versions WHERE version <= ?", (version - self.max_versions,))
+                self.connection.execute("COMMIT")
+                return self.format_version(version)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def changes(self, since, until):
+        """Records changed and removed between versions `since` and `until`, as `(changed, removed)`.
+
+        `removed` holds only the dimensions of each removed row. Returns `None` if `since` is no longer
+        (or not yet) in the history, or is from another epoch, in which case the client needs the whole result.
+        """
+        since, until = self.parse_version(since), self.parse_version(until)
+        if since is None or until is None:
+            return None
+        with self.lock:
+            oldest = self.connection.execute("SELECT MIN(version) FROM versions").fetchone()[0]
+            # The oldest version's changes are from the version before it, so that one can still be caught up
+            if oldest is None or not oldest - 1 <= since <= until:
+                return None
+            rows = self.connection.execute(
+                "SELECT changes FROM versions WHERE version > ? AND version <= ? ORDER BY version", (since, until)
+            ).fetchall()
+
+        # Each row's value at `since` (before its first change) and at `until` (after its last)
+        combined = {}
+        for (blob,) in rows:
+            for key, before, after in unpack(blob):
+                key = tuple(key)
+                combined[key] = (combined[key][0] if key in combined else before, after)
+
+        changed, removed = [], []
+        for key, (before, after) in sorted(combined.items()):
+            if after is None and before is not None:
+                removed.append(to_record(key))
+            elif after is not None and after != before:
+                changed.append(to_record(key, after))
+        return changed, removed
@@ -0,0 +1,34 @@
+"""
+SQLite plumbing shared by the aggregator's on-disk stores (`SQLiteCacheBackend`, `PatientIndex`, `SnapshotHistory`).
+
+Each store holds one connection to a file that every gunicorn worker of a pod may have open, shared by the
+store's threads under its own lock:
+- `connect()` opens it in autocommit mode (the stores issue their own `BEGIN`/`COMMIT`), with write-ahead
+  logging so readers don't block the writer, and waits up to 30 seconds on other workers' writes;
+- `select_in()` runs an `id IN (...)` lookup over any number of ids.
+"""
+
+import sqlite3
+
+# Ids bound per `IN (...)` lookup, well under SQLite's bound-parameter limit (999 before SQLite 3.32)
+IN_CHUNK_SIZE = 500
+
+
+def connect(path):
+    """Open the SQLite file at `path` for a store shared between threads and worker processes."""
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+def select_in(connection, query, ids, parameters=()):
+    """All rows of `query` for `ids`, whose `{ids}` placeholder is filled with one `?` per id of a chunk.
+
+    `parameters` are bound before the ids of every chunk.
+    """
+    ids = list(ids)
+    rows = []
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[start:start + IN_CHUNK_SIZE]
+        rows += connection.execute(query.format(ids=",".join("?" * len(chunk))), (*parameters, *chunk))
+    return rows
@@ -0,0 +1,46 @@
+from datetime import date, datetime
+
+import pytest
+
+from age_groups import AgeGrouper, parse_age_bands, parse_age_reference
+
+
+def legacy_age_group(birth_date):
+    """`calculate_age_group` as it was, reading the clock per record."""
+    try:
+        if not birth_date:
+            return "Unknown"
+        birth_date = datetime.strptime(birth_date, "%Y-%m-%d")
+        today = datetime.now()
+        if birth_date > today:
+            return "Unknown"
+        age = (today - birth_date).days // 365
+        return "1 year" if age <= 1 else f"{age} years"
+    except ValueError:
+        return "Unknown"
+
+
+@pytest.mark.parametrize("birth_date", ["2015-06-01", "2024-02-29", "2099-01-01", "", "2015", "not a date", "1950-12-31"])
+def test_default_labels_match_the_per_record_calculation(birth_date):
+    assert AgeGrouper().label(birth_date, "2023") == legacy_age_group(birth_date)
+
+
+def test_bands_and_occurrence_reference_date():
+    grouper = AgeGrouper(parse_age_bands("0-1,2-4,5-11,12-17,18+"), parse_age_reference("occurrence"))
+
+    assert grouper.label("2015-06-01", "2020") == "5-11"
+    assert grouper.label("2015-06-01", "2033") == "18+"
+    assert grouper.label("2020-06-01", "2021") == "0-1"
+    # No occurrence year, or born after it: no age to measure
+    assert grouper.label("2015-06-01", "Unknown") == "Unknown"
+    assert grouper.label("2022-06-01", "2021") == "Unknown"
+
+
+def test_fixed_reference_date_and_gaps_between_bands():
+    grouper = AgeGrouper(parse_age_bands("0-4,12-17"), parse_age_reference("2024-12-31"))
+
+    assert grouper.reference == date(2024, 12, 31)
+    assert grouper.label("2016-01-01") == "Other"
+    assert grouper.label("2010-01-01") == "12-17"
+    with pytest.raises(ValueError):
+        parse_age_bands("0-1,teens")
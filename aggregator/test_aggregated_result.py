@@ -0,0 +1,66 @@
+import itertools
+
+from aggregated_result import AggregatedResult
+
+
+def make_records():
+    return [
+        {
+            "OccurrenceYear": year, "Jurisdiction": "BC", "Sex": sex, "Age": age, "Dose": dose, "Count": 1,
+            "ReferenceDate": f"{year}-12-31" if year.isnumeric() else "Unknown",
+        }
+        for year, sex, age, dose in itertools.product(
+            ["2021", "2022", "2023", "Unknown"], ["Female", "Male"], ["1 year", "5 years"], [1, 2]
+        )
+    ]
+
+
+def test_filter_matches_a_scan():
+    records = make_records()
+    result = AggregatedResult(records, aggregated_at=0)
+
+    filtered = result.filter({"Sex": {"Female"}, "Dose": {2}}, year_from=2022, year_to=2023)
+
+    assert filtered == [
+        record for record in records
+        if record["Sex"] == "Female" and record["Dose"] == 2 and record["OccurrenceYear"] in ("2022", "2023")
+    ]
+
+
+def test_filter_without_filters_returns_the_records_uncopied():
+    records = make_records()
+    result = AggregatedResult(records, aggregated_at=0)
+
+    assert result.filter() is records
+    assert result.filter({"Age": {"12 years"}}) == []
+    assert result.filter({"Age": {"5 years"}})[0] is records[2]
+
+
+def test_rollups_sum_the_finest_grain():
+    records = make_records()
+    result = AggregatedResult(records, aggregated_at=0)
+
+    per_year = result.filter(group_by={"OccurrenceYear"})
+    assert [(row["OccurrenceYear"], row["Sex"], row["Count"], row["ReferenceDate"]) for row in per_year] == [
+        ("2021", "ALL", 8, "2021-12-31"),
+        ("2022", "ALL", 8, "2022-12-31"),
+        ("2023", "ALL", 8, "2023-12-31"),
+        ("Unknown", "ALL", 8, "Unknown"),
+    ]
+    assert result.filter(group_by=()) == [
+        {"OccurrenceYear": "ALL", "Jurisdiction": "ALL", "Sex": "ALL", "Age": "ALL", "Dose": "ALL",
+         "Count": 32, "ReferenceDate": "ALL"}
+    ]
+    assert len(result.cube) == 32
+
+
+def test_rollups_filter_on_kept_and_rolled_up_dimensions():
+    records = make_records()
+    result = AggregatedResult(records, aggregated_at=0)
+
+    assert result.filter({"Dose": {2}}, year_from=2023, group_by={"OccurrenceYear", "Dose"}) == [
+        {"OccurrenceYear": "2023", "Jurisdiction": "ALL", "Sex": "ALL", "Age": "ALL", "Dose": 2,
+         "Count": 4, "ReferenceDate": "2023-12-31"}
+    ]
+    # Sex is rolled up, so only the female rows are summed
+    assert [row["Count"] for row in result.filter({"Sex": {"Female"}}, group_by={"Dose"})] == [8, 8]
@@ -0,0 +1,708 @@
+import gzip
+import json
+import os
+import random
+from collections import Counter
+from urllib.parse import unquote
+
+import pytest
+
+os.environ.setdefault("IS_LOCAL_DEV", "true")
+
+import aggregator  # noqa: E402
+from cache_backends import MemoryCacheBackend  # noqa: E402
+from fhir_transport import FetchCancelled, FhirTransport  # noqa: E402
+
+
+def make_records(count, seed=0):
+    """Processed records shaped like `process_immunization_record`'s output."""
+    rng = random.Random(seed)
+    return [
+        {
+            "Jurisdiction": rng.choice(["BC", "ON"]),
+            "OccurrenceYear": rng.choice(["2021", "2022", "2023", "Unknown"]),
+            "Sex": rng.choice(["Male", "Female", "Other", "Unknown"]),
+            "Age": rng.choice(["1 year", "5 years", "12 years", "Unknown"]),
+            "Dose": rng.choice([1, 2, 3]),
+        }
+        for _ in range(count)
+    ]
+
+
+def as_pages(pairs):
+    """`iter_immunization_pages` output serving `(immunization, record)` pairs as one last page."""
+    return iter([(None, list(pairs))])
+
+
+def aggregate_with_pandas(records):
+    """The DataFrame implementation `aggregate_data` used before the counting engine."""
+    pd = pytest.importorskip("pandas")
+
+    df = pd.DataFrame(records)
+    df["OccurrenceYear"] = df["OccurrenceYear"].astype(str).str.strip()
+    df["Sex"] = df["Sex"].str.capitalize()
+    df["Age"] = df["Age"].str.strip()
+
+    aggregated = df.groupby(["OccurrenceYear", "Jurisdiction", "Sex", "Age", "Dose"], as_index=False).agg(
+        Count=("Dose", "count")
+    )
+    aggregated["ReferenceDate"] = aggregated["OccurrenceYear"].apply(
+        lambda year: f"{year}-12-31" if year.isnumeric() and year != "Unknown" else "Unknown"
+    )
+    return aggregated.to_dict(orient="records")
+
+
+@pytest.mark.parametrize("count", [1, 50, 5000])
+def test_counting_engine_matches_pandas(count):
+    records = make_records(count, seed=count)
+    group_counts = Counter(aggregator.get_group_key(record) for record in records)
+
+    assert aggregator.counts_to_records(group_counts) == aggregate_with_pandas(records)
+
+
+def test_aggregate_data_counts_streamed_records(monkeypatch):
+    records = make_records(2000) + [None] * 10
+    monkeypatch.setattr(
+        aggregator, "iter_immunization_pages", lambda url, resume=False: as_pages(({}, record) for record in records)
+    )
+
+    assert aggregator.aggregate_data() == aggregate_with_pandas([record for record in records if record])
+
+
+def test_aggregate_data_without_records(monkeypatch):
+    monkeypatch.setattr(aggregator, "iter_immunization_pages", lambda url, resume=False: iter([]))
+
+    assert aggregator.aggregate_data() == []
+
+
+def test_aggregated_data_revalidates_with_etag(monkeypatch):
+    records = aggregator.counts_to_records(Counter(map(aggregator.get_group_key, make_records(200))))
+    monkeypatch.setattr(aggregator, "cached_result", aggregator.AggregatedResult(records, 0))
+    aggregator.first_refresh_done.set()
+    # Keep the background scheduler from replacing the result mid-test
+    monkeypatch.setattr(aggregator, "refresh_scheduler", object())
+    client = aggregator.app.test_client()
+
+    response = client.get("/aggregated-data", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.get_data() == aggregator.cached_result.body(compressed=True)
+
+    revalidated = client.get("/aggregated-data", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+
+    # Same content from a new aggregation keeps the ETag; another representation gets its own
+    monkeypatch.setattr(aggregator, "cached_result", aggregator.AggregatedResult(list(records), 60))
+    assert client.get("/aggregated-data", headers={"Accept-Encoding": "gzip"}).headers["ETag"] == response.headers["ETag"]
+    csv_response = client.get("/aggregated-data?format=csv&sex=female")
+    assert csv_response.headers["ETag"] != response.headers["ETag"]
+    assert csv_response.get_data(as_text=True).splitlines()[0] == "OccurrenceYear,Jurisdiction,Sex,Age,Dose,Count,ReferenceDate"
+    assert client.get("/aggregated-data?format=xml").status_code == 400
+
+
+def test_aggregated_data_since_a_version_returns_changes(monkeypatch, tmp_path):
+    monkeypatch.setattr(aggregator, "snapshot_history", aggregator.SnapshotHistory(str(tmp_path / "snapshots.sqlite3")))
+    monkeypatch.setattr(aggregator, "refresh_scheduler", object())
+    aggregator.first_refresh_done.set()
+    client = aggregator.app.test_client()
+
+    records = make_records(500)
+    old = aggregator.counts_to_records(Counter(map(aggregator.get_group_key, records)))
+    new = aggregator.counts_to_records(Counter(map(aggregator.get_group_key, records[:-20] + make_records(20, seed=1))))
+    monkeypatch.setattr(aggregator, "cached_result", aggregator.load_result(old, 0, True))
+    old_version = client.get("/aggregated-data").headers["X-Aggregation-Version"]
+    monkeypatch.setattr(aggregator, "cached_result", aggregator.load_result(new, 60, True))
+    new_version = aggregator.snapshot_history.format_version(2)
+
+    response = client.get(f"/aggregated-data?since={old_version}")
+    assert response.headers["X-Aggregation-Version"] == new_version
+    delta = response.get_json()
+    assert not delta["full"] and 0 < len(delta["changed"]) < len(new)
+
+    # Applying the changes to the old table gives the new one
+    def key(record):
+        return aggregator.get_group_key(record)
+
+    table = {key(record): record for record in old}
+    for record in delta["removed"]:
+        del table[key(record)]
+    table.update((key(record), record) for record in delta["changed"])
+    assert sorted(table.values(), key=key) == new
+
+    assert client.get(f"/aggregated-data?since={new_version}").get_json()["changed"] == []
+    # Versions from another epoch (a history lost in a restart) or the future get the whole table
+    assert client.get("/aggregated-data?since=0123abcd.1").get_json()["full"]
+    assert client.get(f"/aggregated-data?since={aggregator.snapshot_history.format_version(9)}").get_json()["full"]
+    assert client.get(f"/aggregated-data?since={old_version}&format=csv").status_code == 400
+
+
+def test_cold_worker_answers_503_without_waiting_for_the_first_aggregation(monkeypatch):
+    monkeypatch.setattr(aggregator, "refresh_scheduler", object())
+    monkeypatch.setattr(aggregator, "first_refresh_done", aggregator.threading.Event())
+    monkeypatch.setattr(aggregator, "cached_result", None)
+    monkeypatch.setattr(aggregator, "FIRST_RESULT_WAIT", 0)
+
+    response = aggregator.app.test_client().get("/aggregated-data")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_prefetched_pages_keep_their_order_and_errors():
+    assert list(aggregator.prefetch_pages(iter(range(100)), depth=2)) == list(range(100))
+
+    def failing_pages():
+        yield 1
+        yield 2
+        raise ValueError("bad page")
+
+    pages = aggregator.prefetch_pages(failing_pages(), depth=2)
+    assert [next(pages), next(pages)] == [1, 2]
+    with pytest.raises(ValueError, match="bad page"):
+        next(pages)
+
+
+def test_prefetch_stops_when_the_consumer_does():
+    threads = []
+
+    def endless_pages():
+        threads.append(aggregator.threading.current_thread())
+        page = 0
+        while True:
+            page += 1
+            yield page
+
+    pages = aggregator.prefetch_pages(endless_pages(), depth=2)
+    assert [next(pages) for _ in range(3)] == [1, 2, 3]
+    pages.close()
+
+    threads[0].join(timeout=2)
+    assert not threads[0].is_alive()
+
+
+def test_prefetch_depth_zero_stays_on_the_calling_thread():
+    threads = []
+
+    def pages():
+        threads.append(aggregator.threading.current_thread())
+        yield 1
+
+    assert list(aggregator.prefetch_pages(pages(), depth=0)) == [1]
+    assert threads == [aggregator.threading.current_thread()]
+
+
+def test_metrics_endpoint_reports_aggregator_metrics(monkeypatch):
+    monkeypatch.setattr(aggregator, "refresh_scheduler", object())
+    aggregator.metrics.record_patient_cache_stats({"hits": 3, "misses": 1, "evictions": 0})
+
+    response = aggregator.app.test_client().get("/metrics")
+
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'aggregator_patient_cache_events_total{event="hit"}' in body
+    assert "aggregator_fhir_page_fetch_seconds" in body
+
+
+def test_aggregate_data_from_ndjson_directory(monkeypatch, tmp_path):
+    patients = [
+        {"resourceType": "Patient", "id": "p1", "gender": "female", "birthDate": "2015-06-01"},
+        {"resourceType": "Patient", "id": "p2", "gender": "male", "birthDate": "2018-06-01"},
+    ]
+    immunizations = [
+        {"resourceType": "Immunization", "id": f"i{index}", "patient": {"reference": f"Patient/{patient_id}"},
+         "occurrenceDateTime": "2023-05-01", "protocolApplied": [{"doseNumberString": "1"}]}
+        for index, patient_id in enumerate(["p1", "p1", "p2", "missing"])
+    ]
+    (tmp_path / "Patient.ndjson").write_text("".join(json.dumps(patient) + "\n" for patient in patients))
+    with gzip.open(tmp_path / "Immunization-1.ndjson.gz", "wt") as ndjson_file:
+        ndjson_file.writelines(json.dumps(immunization) + "\n" for immunization in immunizations)
+
+    monkeypatch.setattr(aggregator, "FHIR_INGESTION_MODE", "ndjson")
+    monkeypatch.setattr(aggregator, "NDJSON_DIRECTORY", str(tmp_path))
+    # Every Patient is in the export, so an unknown one is dropped rather than fetched
+    monkeypatch.setattr(aggregator, "fetch_patient_data", lambda reference: pytest.fail("fetched a Patient"))
+
+    records = aggregator.aggregate_data()
+
+    assert sorted((record["Sex"], record["Count"]) for record in records) == [("Female", 2), ("Male", 1)]
+
+
+def make_dated_immunizations(count, seed=0):
+    """Immunizations with occurrence dates of varying precision, some missing, paired with processed records."""
+    rng = random.Random(seed)
+    dates = ["2019", "2020-07", "2021-01-01", "2021-12-31T23:59:59Z", "2022-03-04", "2023-06", "2024-01-01", None]
+    records = make_records(count, seed)
+    return [
+        ({"occurrenceDateTime": date} if date else {}, {**record, "OccurrenceYear": date[:4] if date else "Unknown"})
+        for date, record in ((rng.choice(dates), record) for record in records)
+    ]
+
+
+def matches_date_search(immunization, url):
+    """Whether an Immunization matches the `date` parameters of a search URL, comparing whole years as FHIR would."""
+    date = immunization.get("occurrenceDateTime")
+    for parameter in url.split("?", 1)[1].split("&"):
+        name, _, value = parameter.partition("=")
+        if name == "date:missing" and (date is None) != (value == "true"):
+            return False
+        if name == "date" and (date is None or not (date[:4] >= value[2:6] if value[:2] == "ge" else date[:4] < value[2:6])):
+            return False
+    return True
+
+
+@pytest.mark.parametrize("partitions", [2, 3, 8])
+def test_partitioned_fetch_matches_a_single_walk(monkeypatch, partitions):
+    immunizations = make_dated_immunizations(2000)
+    monkeypatch.setattr(
+        aggregator, "iter_immunization_pages",
+        lambda url, resume=False: as_pages(pair for pair in immunizations if matches_date_search(pair[0], url)),
+    )
+    years = sorted(int(immunization["occurrenceDateTime"][:4]) for immunization, _ in immunizations if immunization)
+    monkeypatch.setattr(
+        aggregator, "find_immunization_bound",
+        lambda search, sort, get_value: years[-1] if sort.startswith("-") else years[0],
+    )
+
+    serial = aggregator.aggregate_data()
+    monkeypatch.setattr(aggregator, "FHIR_PARTITIONS", partitions)
+    partitioned = aggregator.aggregate_data()
+
+    assert partitioned == serial
+    assert len(aggregator.get_partition_searches(partitions)) == min(partitions, 7)
+
+
+def test_failed_page_leaves_a_partial_result_that_resumes(monkeypatch):
+    records = make_records(300)
+    pages = [records[:100], records[100:200], records[200:]]
+    failures = {"page-2": 1}
+    calls = []
+
+    def iter_immunization_pages(url, resume=False):
+        calls.append(url)
+        index = int(url.rsplit("-", 1)[1]) if resume else 0
+        for index in range(index, len(pages)):
+            if failures.get(f"page-{index}"):
+                failures[f"page-{index}"] -= 1
+                raise aggregator.FhirPagingError("server unavailable", f"page-{index}", retryable=True)
+            next_url = f"page-{index + 1}" if index + 1 < len(pages) else None
+            yield next_url, [({}, record) for record in pages[index]]
+
+    monkeypatch.setattr(aggregator, "iter_immunization_pages", iter_immunization_pages)
+    monkeypatch.setattr(aggregator, "aggregation_checkpoint", None)
+
+    partial = aggregator.aggregate_data()
+    assert aggregator.aggregation_checkpoint is not None
+    assert sum(record["Count"] for record in partial) == 200
+
+    resumed = aggregator.aggregate_data()
+    assert aggregator.aggregation_checkpoint is None
+    assert resumed == aggregate_with_pandas(records)
+    assert calls[-1] == "page-2"
+
+
+class UnreachableCacheBackend:
+    """A shared cache backend whose store is down."""
+
+    def get_result_time(self):
+        raise ConnectionError("Connection refused")
+
+    get_result = get_patients = set_patients = refresh_lock = get_result_time
+
+    def set_result(self, data, aggregated_at, complete=True):
+        raise ConnectionError("Connection refused")
+
+
+def test_refresh_scheduler_survives_a_failing_cache_backend(monkeypatch, tmp_path):
+    records = make_records(100)
+    monkeypatch.setattr(aggregator, "cache_backend", UnreachableCacheBackend())
+    monkeypatch.setattr(aggregator, "snapshot_history", aggregator.SnapshotHistory(str(tmp_path / "snapshots.sqlite3")))
+    monkeypatch.setattr(aggregator, "aggregate_data", lambda: aggregate_with_pandas(records))
+    monkeypatch.setattr(aggregator, "cached_result", None)
+    monkeypatch.setattr(aggregator, "aggregation_checkpoint", None)
+    monkeypatch.setattr(aggregator, "first_refresh_done", aggregator.threading.Event())
+    monkeypatch.setattr(aggregator, "refresh_requested", aggregator.threading.Event())
+
+    scheduler = aggregator.threading.Thread(target=aggregator.run_refresh_scheduler, daemon=True)
+    scheduler.start()
+
+    # The worker aggregates and serves on its own, and keeps refreshing
+    assert aggregator.first_refresh_done.wait(timeout=5)
+    assert aggregator.cached_result.records == aggregate_with_pandas(records)
+    assert scheduler.is_alive()
+
+
+def test_concurrent_refreshes_run_one_aggregation(monkeypatch, tmp_path):
+    started, finish = aggregator.threading.Event(), aggregator.threading.Event()
+    calls = []
+
+    def aggregate_data():
+        calls.append(1)
+        started.set()
+        finish.wait(timeout=5)
+        return []
+
+    monkeypatch.setattr(aggregator, "cache_backend", MemoryCacheBackend())
+    monkeypatch.setattr(aggregator, "snapshot_history", aggregator.SnapshotHistory(str(tmp_path / "snapshots.sqlite3")))
+    monkeypatch.setattr(aggregator, "aggregate_data", aggregate_data)
+    monkeypatch.setattr(aggregator, "cached_result", None)
+    monkeypatch.setattr(aggregator, "aggregation_checkpoint", None)
+
+    results = []
+    first = aggregator.threading.Thread(target=lambda: results.append(aggregator.refresh_aggregated_data()))
+    first.start()
+    assert started.wait(timeout=5)
+
+    assert aggregator.refresh_aggregated_data(force=True) is False
+    finish.set()
+    first.join(timeout=5)
+    assert results == [True]
+    assert len(calls) == 1
+
+
+def test_refresh_scheduler_survives_unexpected_errors(monkeypatch):
+    calls = []
+    parked = aggregator.threading.Event()
+
+    def refresh_aggregated_data(force=False):
+        calls.append(force)
+        if len(calls) == 1:
+            raise RuntimeError("unexpected")
+        aggregator.first_refresh_done.set()
+        # Keep the scheduler from refreshing for real once the test is over
+        parked.wait()
+
+    monkeypatch.setattr(aggregator, "refresh_aggregated_data", refresh_aggregated_data)
+    monkeypatch.setattr(aggregator, "SHARED_CACHE_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(aggregator, "cached_result", None)
+    monkeypatch.setattr(aggregator, "aggregation_checkpoint", None)
+    monkeypatch.setattr(aggregator, "first_refresh_done", aggregator.threading.Event())
+    monkeypatch.setattr(aggregator, "refresh_requested", aggregator.threading.Event())
+
+    scheduler = aggregator.threading.Thread(target=aggregator.run_refresh_scheduler, daemon=True)
+    scheduler.start()
+
+    assert aggregator.first_refresh_done.wait(timeout=5)
+    assert scheduler.is_alive()
+
+
+class ChangingImmunizations:
+    """Immunizations that change between refreshes, served the way incremental aggregation reads them."""
+
+    def __init__(self, records):
+        self.clock = 0
+        self.current = {}  # id: (immunization, record)
+        self.deletes = []  # (lastUpdated, id)
+        for index, record in enumerate(records):
+            self.put(f"imm-{index}", record)
+
+    def tick(self):
+        self.clock += 1
+        return f"2024-01-01T{self.clock // 3600:02d}:{self.clock // 60 % 60:02d}:{self.clock % 60:02d}Z"
+
+    def put(self, immunization_id, record):
+        previous = self.current.get(immunization_id)
+        version = int(previous[0]["meta"]["versionId"]) + 1 if previous else 1
+        meta = {"versionId": str(version), "lastUpdated": self.tick()}
+        self.current[immunization_id] = ({"id": immunization_id, "meta": meta}, record)
+
+    def delete(self, immunization_id):
+        del self.current[immunization_id]
+        self.deletes.append((self.tick(), immunization_id))
+
+    def iter_all_immunization_records(self):
+        return iter(list(self.current.values()))
+
+    def iter_immunization_records(self, url):
+        since = unquote(url.split("_lastUpdated=gt", 1)[1].split("&", 1)[0])
+        return iter([pair for pair in self.current.values() if pair[0]["meta"]["lastUpdated"] > since])
+
+    def iter_fhir_pages(self, url, resource_type):
+        since = unquote(url.split("_since=", 1)[1].split("&", 1)[0])
+        entries = [
+            {"request": {"method": "DELETE", "url": f"Immunization/{immunization_id}/_history/2"}}
+            for last_updated, immunization_id in self.deletes if last_updated > since
+        ]
+        return iter([{"entry": entries}])
+
+    def full_aggregation(self):
+        return aggregator.counts_to_records(Counter(aggregator.get_group_key(record) for _, record in self.current.values()))
+
+
+def test_incremental_deltas_match_a_full_rebuild(monkeypatch):
+    records = make_records(300)
+    server = ChangingImmunizations(records[:200])
+    for name in ("iter_all_immunization_records", "iter_immunization_records", "iter_fhir_pages"):
+        monkeypatch.setattr(aggregator, name, getattr(server, name))
+    monkeypatch.setattr(aggregator, "incremental_aggregation", aggregator.IncrementalAggregation())
+    monkeypatch.setattr(aggregator, "INCREMENTAL_REBUILD_INTERVAL", 3600)
+
+    assert aggregator.refresh_incremental_aggregation() == server.full_aggregation()
+    rebuilt = aggregator.incremental_aggregation
+
+    # Updates (a new version in another group), deletes and adds, applied as deltas
+    for index in range(0, 40, 2):
+        server.put(f"imm-{index}", records[200 + index])
+    for index in range(1, 40, 4):
+        server.delete(f"imm-{index}")
+    for index in range(250, 260):
+        server.put(f"imm-{index}", records[index])
+    assert aggregator.refresh_incremental_aggregation() == server.full_aggregation()
+    assert aggregator.incremental_aggregation is rebuilt
+
+    # Versions already applied, served again (e.g. sharing the watermark's timestamp), change nothing
+    watermark = rebuilt.watermark
+    for immunization, record in list(server.current.values())[:50]:
+        rebuilt.apply(immunization, record)
+    assert rebuilt.to_records() == server.full_aggregation()
+    assert rebuilt.watermark == watermark
+
+    # A delta that fails part-way forces a rebuild on the next refresh
+    server.put("imm-100", records[299])
+
+    def fail(url):
+        raise aggregator.FhirPagingError("server unavailable", url, retryable=True)
+        yield
+
+    monkeypatch.setattr(aggregator, "iter_immunization_records", fail)
+    with pytest.raises(aggregator.FhirPagingError):
+        aggregator.refresh_incremental_aggregation()
+    assert rebuilt.watermark is None
+    monkeypatch.setattr(aggregator, "iter_immunization_records", server.iter_immunization_records)
+    assert aggregator.refresh_incremental_aggregation() == server.full_aggregation()
+    assert aggregator.incremental_aggregation is not rebuilt
+
+
+@pytest.mark.parametrize("failed_url,expected_calls", [("page-1", 2), ("Patient/_search", 1)])
+def test_rejected_pages_restart_a_walk_at_most_once(monkeypatch, failed_url, expected_calls):
+    calls = []
+
+    def iter_immunization_pages(url, resume=False):
+        calls.append(url)
+        yield "page-1", [({}, record) for record in make_records(10)]
+        raise aggregator.FhirPagingError("bad request", failed_url, retryable=False)
+
+    monkeypatch.setattr(aggregator, "iter_immunization_pages", iter_immunization_pages)
+    walk = aggregator.ImmunizationWalk("")
+    walk.run()
+
+    # Only an expired `next` link restarts the walk, and a page that keeps failing stops it
+    assert len(calls) == expected_calls
+    assert not walk.complete and walk.fetched_count == 10
+
+
+def test_failed_patient_batch_falls_back_to_single_lookups(monkeypatch):
+    def iter_fhir_searches(url, resource_type, searches, elements=None):
+        raise aggregator.FhirPagingError("bad request", url, retryable=False)
+        yield
+
+    monkeypatch.setattr(aggregator, "iter_fhir_searches", iter_fhir_searches)
+    monkeypatch.setattr(aggregator, "persistent_patient_index", None)
+    monkeypatch.setattr(aggregator, "patient_cache", aggregator.PatientCache(max_bytes=1024 * 1024))
+
+    aggregator.fetch_patients_batch(["a", "b"])
+    assert "a" not in aggregator.patient_cache
+
+
+def patient_search_page(last_updated, *patients):
+    return {
+        "meta": {"lastUpdated": last_updated},
+        "entry": [{"resource": {"id": patient_id, "gender": gender, "birthDate": "2015-06-01"}} for patient_id, gender in patients],
+    }
+
+
+def test_patient_index_revalidation_moves_the_watermark_to_the_search_time(monkeypatch, tmp_path):
+    index = aggregator.PatientIndex(str(tmp_path / "patients.sqlite3"))
+    index.put_many({"a": aggregator.PatientSummary("female", "2015-06-01"), "b": aggregator.PatientSummary("male", "2015-06-01")})
+    index.set_watermark("2024-01-01T00:00:00Z")
+    cache = aggregator.PatientCache(max_bytes=1024 * 1024)
+    cache["a"] = aggregator.PatientSummary("female", "2015-06-01")
+    monkeypatch.setattr(aggregator, "persistent_patient_index", index)
+    monkeypatch.setattr(aggregator, "patient_cache", cache)
+
+    urls = []
+
+    def iter_fhir_pages(url, resource_type, elements=None):
+        urls.append(url)
+        # Paging ends later than the search ran; the Bundle's own time is the one to resume from
+        yield patient_search_page("2024-02-01T00:00:00Z", ("a", "other"))
+        yield patient_search_page("2024-02-01T00:05:00Z", ("c", "female"))
+
+    monkeypatch.setattr(aggregator, "iter_fhir_pages", iter_fhir_pages)
+    aggregator.revalidate_persistent_patient_index()
+
+    assert "_lastUpdated=gt2024-01-01T00%3A00%3A00Z" in urls[0]
+    assert index.get_watermark() == "2024-02-01T00:00:00Z"
+    assert index.get_many(["a"])["a"].gender == "other"
+    assert set(index.get_many(["a", "b", "c"])) == {"a", "b", "c"}
+    # Cached patients that changed are refreshed; others aren't added to the cache
+    assert cache["a"].gender == "other"
+    assert "c" not in cache
+
+
+def test_patient_index_keeps_its_watermark_when_revalidation_fails(monkeypatch, tmp_path):
+    index = aggregator.PatientIndex(str(tmp_path / "patients.sqlite3"))
+    index.set_watermark("2024-01-01T00:00:00Z")
+    monkeypatch.setattr(aggregator, "persistent_patient_index", index)
+    monkeypatch.setattr(aggregator, "patient_cache", aggregator.PatientCache(max_bytes=1024 * 1024))
+
+    def iter_fhir_pages(url, resource_type, elements=None):
+        yield patient_search_page("2024-02-01T00:00:00Z", ("a", "female"))
+        raise aggregator.FhirPagingError("server unavailable", url, retryable=True)
+
+    monkeypatch.setattr(aggregator, "iter_fhir_pages", iter_fhir_pages)
+    aggregator.revalidate_persistent_patient_index()
+
+    # What was revalidated is kept, but the rest is searched again from the old watermark
+    assert index.get_watermark() == "2024-01-01T00:00:00Z"
+    assert index.get_many(["a"])["a"].gender == "female"
+
+
+def test_patient_searches_refetch_failed_first_pages(monkeypatch):
+    def bundle(*patient_ids):
+        response = aggregator.requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"entry": [{"resource": {"id": patient_id}} for patient_id in patient_ids]}).encode()
+        return response
+
+    searches = [{"_id": "p1"}, {"_id": "p2"}]
+    monkeypatch.setattr(
+        aggregator.fhir_transport, "request_all",
+        lambda requests_to_send: [bundle("p1"), aggregator.requests.ConnectionError("reset")],
+    )
+    refetched = []
+    monkeypatch.setattr(
+        aggregator, "iter_fhir_pages",
+        lambda url, resource_type, data=None, elements=None: refetched.append(data) or iter([{"entry": [{"resource": {"id": "p2"}}]}]),
+    )
+
+    pages = list(aggregator.iter_fhir_searches("http://fhir/Patient/_search", "Patient", searches))
+
+    assert [entry["resource"]["id"] for page in pages for entry in page["entry"]] == ["p1", "p2"]
+    assert refetched == [{"_id": "p2"}]
+
+
+def make_immunizations_and_patients(count, seed=0):
+    """FHIR Immunizations, three to a Patient, and those Patients by id."""
+    rng = random.Random(seed)
+    patients = {
+        f"p{index}": {
+            "resourceType": "Patient", "id": f"p{index}",
+            "gender": rng.choice(["male", "female", "other"]), "birthDate": f"{rng.randint(1950, 2020)}-06-01",
+        }
+        for index in range(count // 3)
+    }
+    immunizations = [
+        {
+            "resourceType": "Immunization", "id": f"i{index}",
+            "patient": {"reference": f"Patient/p{index // 3}"},
+            "occurrenceDateTime": f"{rng.choice([2021, 2022, 2023])}-03-01",
+            "protocolApplied": [{"doseNumberString": str(rng.randint(1, 3))}],
+        }
+        for index in range(count)
+    ]
+    return immunizations, patients
+
+
+def test_included_patients_aggregate_like_batched_lookups(monkeypatch):
+    immunizations, patients = make_immunizations_and_patients(60)
+    # The first page carries its Patients; on the second the server ignored `_include`
+    first_page, second_page = immunizations[:30], immunizations[30:]
+    first_page_patients = {immunization["patient"]["reference"].split("/")[1] for immunization in first_page}
+    searches, batched_ids = [], []
+
+    def iter_fhir_pages(url, resource_type, data=None, elements=None):
+        searches.append((url, elements))
+        include = "_include=Immunization:patient" in url
+        yield {
+            "entry": [{"resource": resource} for resource in first_page]
+            + [{"resource": patients[patient_id]} for patient_id in sorted(first_page_patients) if include],
+            "link": [{"relation": "next", "url": "page-2"}],
+        }
+        yield {"entry": [{"resource": resource} for resource in second_page]}
+
+    def iter_fhir_searches(url, resource_type, searches, elements=None):
+        for search in searches:
+            batched_ids.extend(search["_id"].split(","))
+            yield {"entry": [{"resource": patients[patient_id]} for patient_id in search["_id"].split(",")]}
+
+    monkeypatch.setattr(aggregator, "iter_fhir_pages", iter_fhir_pages)
+    monkeypatch.setattr(aggregator, "iter_fhir_searches", iter_fhir_searches)
+    monkeypatch.setattr(aggregator, "persistent_patient_index", None)
+    monkeypatch.setattr(aggregator, "cache_backend", MemoryCacheBackend())
+    monkeypatch.setattr(aggregator, "aggregation_checkpoint", None)
+    monkeypatch.setattr(aggregator, "FHIR_PARTITIONS", 1)
+
+    results = {}
+    for mode in ("batch", "include"):
+        monkeypatch.setattr(aggregator, "PATIENT_FETCH_MODE", mode)
+        monkeypatch.setattr(aggregator, "patient_cache", aggregator.PatientCache(max_bytes=1024 * 1024))
+        batched_ids.clear()
+        results[mode] = aggregator.aggregate_data()
+
+    assert results["include"] == results["batch"]
+    assert sum(record["Count"] for record in results["include"]) == 60
+    # Only the second page's Patients were looked up, since the first page included its own
+    assert sorted(batched_ids) == sorted(f"p{index}" for index in range(10, 20))
+    url, elements = searches[-1]
+    assert "_include=Immunization:patient" in url
+    assert elements == [
+        "Immunization.patient", "Immunization.occurrenceDateTime", "Immunization.protocolApplied",
+        "Patient.gender", "Patient.birthDate",
+    ]
+
+
+def fhir_response(status_code, body):
+    response = aggregator.requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode()
+    return response
+
+
+class ElementsRejectingTransport:
+    """Answers `get`s with `body`, unless they ask for `_elements`, which it rejects with a 400."""
+
+    def __init__(self, body):
+        self.body = body
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        if "_elements=" in url:
+            return fhir_response(400, {"resourceType": "OperationOutcome"})
+        return fhir_response(200, self.body)
+
+    decode_json = staticmethod(FhirTransport.decode_json)
+
+
+def test_rejected_elements_are_dropped_from_searches(monkeypatch):
+    transport = ElementsRejectingTransport({"entry": [{"resource": {"id": "a"}}]})
+    monkeypatch.setattr(aggregator, "fhir_transport", transport)
+    monkeypatch.setattr(aggregator, "FHIR_ELEMENTS_PROJECTION", True)
+
+    pages = list(aggregator.iter_fhir_pages("http://fhir/Immunization?_count=10", "Immunization", elements=["patient"]))
+
+    assert pages == [{"entry": [{"resource": {"id": "a"}}]}]
+    assert transport.urls == ["http://fhir/Immunization?_count=10&_elements=patient", "http://fhir/Immunization?_count=10"]
+
+
+def test_rejected_elements_are_dropped_from_single_patient_reads(monkeypatch):
+    transport = ElementsRejectingTransport({"resourceType": "Patient", "id": "a", "gender": "female", "birthDate": "2015-06-01"})
+    monkeypatch.setattr(aggregator, "fhir_transport", transport)
+    monkeypatch.setattr(aggregator, "FHIR_ELEMENTS_PROJECTION", True)
+    monkeypatch.setattr(aggregator, "persistent_patient_index", None)
+    monkeypatch.setattr(aggregator, "cache_backend", MemoryCacheBackend())
+    monkeypatch.setattr(aggregator, "patient_cache", aggregator.PatientCache(max_bytes=1024 * 1024))
+
+    summary = aggregator.fetch_patient_data("Patient/a")
+
+    assert (summary.gender, summary.birth_date) == ("female", "2015-06-01")
+    assert [url.endswith("/Patient/a") for url in transport.urls] == [False, True]
+
+
+def test_cancelled_transport_fails_requests_until_reset():
+    transport = FhirTransport(pool_size=1, retries=0, backoff_factor=0)
+    transport.cancel()
+
+    with pytest.raises(FetchCancelled):
+        transport.get("http://127.0.0.1:9/fhir/Immunization")
+    transport.reset()
+    with pytest.raises(aggregator.requests.ConnectionError):
+        transport.get("http://127.0.0.1:9/fhir/Immunization")
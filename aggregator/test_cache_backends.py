@@ -0,0 +1,63 @@
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+from cache_backends import RedisCacheBackend, SQLiteCacheBackend
+
+
+def test_sqlite_backend_round_trips_the_result_and_patients(tmp_path):
+    backend = SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"), patient_ttl=60)
+    assert backend.get_result() == (None, None, True)
+
+    backend.set_result([{"count": 1}], aggregated_at=123.0, complete=False)
+    assert backend.get_result() == ([{"count": 1}], 123.0, False)
+    assert backend.get_result_time() == 123.0
+
+    patient = {"gender": "female", "birth_date": "1980-01-01", "version_id": "2"}
+    backend.set_patients({"1": patient})
+    assert backend.get_patients(["1", "2"]) == {"1": patient}
+
+
+def test_sqlite_refresh_lock_excludes_a_second_holder(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first, second = SQLiteCacheBackend(path, patient_ttl=60), SQLiteCacheBackend(path, patient_ttl=60)
+
+    with first.refresh_lock() as is_lock_holder:
+        assert is_lock_holder
+        with second.refresh_lock() as is_second_holder:
+            assert not is_second_holder
+    with second.refresh_lock() as is_second_holder:
+        assert is_second_holder
+
+
+class FakeRedisLock:
+    def __init__(self):
+        self.reacquired = threading.Event()
+        self.released = False
+
+    def acquire(self, blocking):
+        return True
+
+    def reacquire(self):
+        self.reacquired.set()
+
+    def release(self):
+        self.released = True
+
+
+def test_redis_lock_is_extended_while_held(monkeypatch):
+    lock = FakeRedisLock()
+    client = SimpleNamespace(lock=lambda name, timeout: lock)
+    monkeypatch.setitem(sys.modules, "redis", SimpleNamespace(Redis=lambda **kwargs: client))
+    backend = RedisCacheBackend("localhost", 6379, None, "on", patient_ttl=60, lock_timeout=0.03)
+
+    with backend.refresh_lock() as is_lock_holder:
+        assert is_lock_holder
+        assert lock.reacquired.wait(timeout=1)
+    assert lock.released
+
+    # The heartbeat stops with the lock
+    lock.reacquired.clear()
+    time.sleep(0.05)
+    assert not lock.reacquired.is_set()
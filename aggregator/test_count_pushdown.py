@@ -0,0 +1,89 @@
+from collections import Counter
+from datetime import date
+
+import pytest
+
+from age_groups import AgeGrouper, parse_age_bands
+from count_pushdown import CountBudgetExceeded, CountPlan, StaleCountPlan
+
+# (occurrence date, dose, (gender, birth date) of the patient, or `None` without one) of each Immunization
+IMMUNIZATIONS = [
+    ("2021-03-01", "1", ("female", "2015-06-01")),
+    ("2021-07-15", "2", ("female", "2015-06-01")),
+    ("2021-11-30", "2", ("male", "1950-01-20")),
+    ("2022-01-05", "1", ("male", None)),
+    ("2022-02-10", "3", ("other", "2020-12-31")),
+    ("2022-06-01", "2", (None, "2030-01-01")),
+    ("2022-08-08", "2", None),
+    ("2023-09-09", "1", ("unknown", "2001-04-04")),
+    (None, "2", ("female", "2010-10-10")),
+    (None, "1", ("male", "2019-02-02")),
+    (None, "1", None),
+]
+
+
+def matches(immunization, search):
+    occurrence, dose, patient = immunization
+    gender, birth_date = patient or (None, None)
+    for param in filter(None, search.split("&")):
+        name, value = param.split("=")
+        if name == "patient:missing":
+            ok = (patient is None) == (value == "true")
+        elif name == "date:missing":
+            ok = (occurrence is None) == (value == "true")
+        elif name == "date":
+            ok = occurrence is not None and (occurrence >= value[2:] if value[:2] == "ge" else occurrence < value[2:])
+        elif name == "dose-number:exact":
+            ok = dose == value
+        elif name == "patient.gender":
+            ok = gender == value
+        elif name == "patient.birthdate":
+            ok = birth_date is not None and (birth_date > value[2:] if value[:2] == "gt" else birth_date <= value[2:])
+        else:
+            raise ValueError(name)
+        if not ok:
+            return False
+    return True
+
+
+def count_searches(searches):
+    return [sum(matches(immunization, search) for immunization in IMMUNIZATIONS) for search in searches]
+
+
+def aggregate(grouper):
+    """Group counts as downloading every Immunization computes them."""
+    counts = Counter()
+    for occurrence, dose, patient in IMMUNIZATIONS:
+        if patient is None:
+            continue
+        gender, birth_date = patient
+        year = occurrence[:4] if occurrence else "Unknown"
+        sex = gender.capitalize() if gender in ("male", "female", "other") else "Unknown"
+        counts[(year, "ON", sex, grouper.label(birth_date, year), int(dose))] += 1
+    return counts
+
+
+@pytest.mark.parametrize("bands,reference", [
+    (None, date(2024, 12, 31)),
+    ("0-4,5-11,12-17,18+", date(2024, 12, 31)),
+    ("0-4,12-17", "occurrence"),
+])
+def test_counts_match_full_aggregation(bands, reference):
+    grouper = AgeGrouper(parse_age_bands(bands or ""), reference)
+    grouper.reset()
+    plan = CountPlan([2021, 2022, 2023], [1, 2, 3], "dose-number", grouper, "ON")
+
+    assert plan.count(count_searches, max_requests=1000) == aggregate(grouper)
+    assert 0 < plan.request_count < 1000
+
+
+def test_missing_years_and_budget():
+    grouper = AgeGrouper(reference=date(2024, 12, 31))
+    grouper.reset()
+
+    # Immunizations from 2023 aren't in any searched year, so the totals don't add up
+    with pytest.raises(StaleCountPlan):
+        CountPlan([2021, 2022], [1, 2, 3], "dose-number", grouper, "ON").count(count_searches, max_requests=1000)
+
+    with pytest.raises(CountBudgetExceeded):
+        CountPlan([2021, 2022, 2023], [1, 2, 3], "dose-number", grouper, "ON").count(count_searches, max_requests=10)
@@ -0,0 +1,64 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fhir_transport import FetchCancelled, FhirTransport
+
+
+class FlakyFhirServer(BaseHTTPRequestHandler):
+    """Answers 503 to the first request and `{"resourceType": "Bundle"}` to the rest."""
+
+    requests_seen = 0
+
+    def do_GET(self):
+        FlakyFhirServer.requests_seen += 1
+        if FlakyFhirServer.requests_seen == 1:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b'{"resourceType": "Bundle"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fhir_url():
+    FlakyFhirServer.requests_seen = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyFhirServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/fhir"
+    server.shutdown()
+    server.server_close()
+
+
+def test_unavailable_responses_are_retried(fhir_url):
+    transport = FhirTransport(pool_size=1, retries=2, backoff_factor=0)
+
+    response = transport.get(f"{fhir_url}/Immunization")
+
+    assert response.status_code == 200
+    assert transport.decode_json(response) == {"resourceType": "Bundle"}
+    assert FlakyFhirServer.requests_seen == 2
+    stats = transport.stats()
+    assert (stats["requests"], stats["errors"]) == (1, 0)
+
+
+def test_cancelled_transport_sends_nothing(fhir_url):
+    transport = FhirTransport(pool_size=1, retries=2, backoff_factor=0)
+
+    transport.cancel()
+    with pytest.raises(FetchCancelled):
+        transport.get(f"{fhir_url}/Immunization")
+    assert FlakyFhirServer.requests_seen == 0
+
+    transport.reset()
+    assert transport.get(f"{fhir_url}/Immunization").status_code == 200
@@ -0,0 +1,38 @@
+from patient_cache import PatientCache, PatientSummary, get_entry_size
+
+
+def test_cache_evicts_least_recently_used_past_its_byte_budget():
+    entry_size = get_entry_size(PatientSummary("female", "1980-01-01", "1"))
+    cache = PatientCache(max_bytes=entry_size * 3)
+
+    for patient_id in ("1", "2", "3"):
+        cache[patient_id] = PatientSummary("female", "1980-01-01", "1")
+    assert cache.get("1") is not None
+    cache["4"] = PatientSummary("male", "1990-01-01", "1")
+
+    assert set(cache) == {"1", "3", "4"}
+    assert cache.currsize <= cache.maxsize
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_counts_hits_and_misses():
+    cache = PatientCache(max_bytes=1024 * 1024)
+    cache["1"] = PatientSummary("female", "1980-01-01")
+
+    assert cache.get("1").gender == "female"
+    assert cache.get("2") is None
+    assert cache.get("3", "default") == "default"
+
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 2, 0)
+    assert stats["bytes"] == get_entry_size(cache["1"])
+
+
+def test_evictions_are_not_counted_as_hits():
+    cache = PatientCache(max_bytes=get_entry_size(PatientSummary("female", "1980-01-01")) * 3)
+
+    for patient_id in range(10):
+        cache[str(patient_id)] = PatientSummary("female", "1980-01-01")
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (0, 0, 7)
@@ -0,0 +1,25 @@
+from patient_cache import PatientSummary
+from patient_index import PatientIndex
+
+
+def test_summaries_and_watermark_round_trip(tmp_path):
+    index = PatientIndex(str(tmp_path / "patients.sqlite3"))
+    index.put_many({"a": PatientSummary("female", "2015-06-01", "1"), "b": PatientSummary("male", "", None)})
+    index.put_many({"a": PatientSummary("female", "2015-06-02", "2")})
+    index.set_watermark("2024-01-01T00:00:00Z")
+
+    reopened = PatientIndex(str(tmp_path / "patients.sqlite3"))
+    summaries = reopened.get_many(["a", "b", "missing"])
+    assert {patient_id: summary.as_dict() for patient_id, summary in summaries.items()} == {
+        "a": {"gender": "female", "birth_date": "2015-06-02", "version_id": "2"},
+        "b": {"gender": "male", "birth_date": "", "version_id": None},
+    }
+    assert len(reopened) == 2
+    assert reopened.get_watermark() == "2024-01-01T00:00:00Z"
+
+
+def test_lookups_span_several_id_chunks(tmp_path):
+    index = PatientIndex(str(tmp_path / "patients.sqlite3"))
+    index.put_many({str(patient_id): PatientSummary("female", "2015-06-01") for patient_id in range(1200)})
+
+    assert len(index.get_many(str(patient_id) for patient_id in range(-100, 1300))) == 1200
@@ -0,0 +1,55 @@
+from snapshot_history import SnapshotHistory
+
+
+def record(age, dose, count):
+    return {
+        "OccurrenceYear": "2023", "Jurisdiction": "ON", "Sex": "Female", "Age": age, "Dose": dose,
+        "Count": count, "ReferenceDate": "2023-12-31",
+    }
+
+
+def test_changes_since_a_version(tmp_path):
+    history = SnapshotHistory(str(tmp_path / "snapshots.sqlite3"), max_versions=3)
+    version = history.format_version
+    first = [record("1 year", 1, 10), record("2 years", 1, 5)]
+    second = [record("1 year", 1, 11), record("2 years", 1, 5), record("3 years", 2, 1)]
+    third = [record("1 year", 1, 10), record("3 years", 2, 1)]
+
+    assert history.record(first, 0, "a") == version(1)
+    assert history.record(first, 60, "a") == version(1)  # Unchanged content keeps its version
+    assert history.record(second, 120, "b") == version(2)
+    assert history.record(third, 180, "c") == version(3)
+
+    assert history.changes(version(1), version(2)) == ([record("1 year", 1, 11), record("3 years", 2, 1)], [])
+    # "1 year" changed and changed back, so only the new row and the removed one are left
+    changed, removed = history.changes(version(1), version(3))
+    assert changed == [record("3 years", 2, 1)]
+    assert removed == [{"OccurrenceYear": "2023", "Jurisdiction": "ON", "Sex": "Female", "Age": "2 years", "Dose": 1}]
+    assert history.changes(version(3), version(3)) == ([], [])
+    assert history.changes(version(0), version(3))[0] == third
+
+    # Versions past `max_versions` are dropped; the history survives reopening the file
+    assert history.record(first, 240, "a") == version(4)
+    reopened = SnapshotHistory(str(tmp_path / "snapshots.sqlite3"), max_versions=3)
+    assert reopened.epoch == history.epoch
+    assert reopened.changes(version(0), version(4)) is None
+    assert reopened.changes(version(1), version(4)) == ([], [])
+    changed, removed = reopened.changes(version(2), version(4))
+    assert changed == [record("1 year", 1, 10)]
+    assert [row["Age"] for row in removed] == ["3 years"]
+    assert reopened.changes(version(5), version(4)) is None
+    assert reopened.record(second, 300, "b") == version(5)
+
+
+def test_versions_of_a_lost_history_are_not_caught_up(tmp_path):
+    old = SnapshotHistory(str(tmp_path / "old.sqlite3"))
+    old_version = old.record([record("1 year", 1, 10)], 0, "a")
+
+    # A new file numbers from 1 again, under another epoch
+    new = SnapshotHistory(str(tmp_path / "new.sqlite3"))
+    for count in range(1, 4):
+        latest = new.record([record("1 year", 1, 10), record("2 years", 1, count)], count, str(count))
+    assert new.epoch != old.epoch
+    assert new.changes(old_version, latest) is None
+    assert new.changes("3", latest) is None
+    assert new.changes("not a version", latest) is None
@@ -0,0 +1,75 @@
+import os
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from token_verifier import TokenVerifier
+
+
+def make_key_pair():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return private_key, public_pem
+
+
+def write_key(path, pem, mtime):
+    path.write_bytes(pem)
+    os.utime(path, (mtime, mtime))
+
+
+def test_verified_tokens_are_cached_until_they_expire(monkeypatch, tmp_path):
+    private_key, public_pem = make_key_pair()
+    write_key(tmp_path / "public_key.pem", public_pem, 1_000_000)
+    verifier = TokenVerifier(str(tmp_path / "public_key.pem"), required=True)
+    token = jwt.encode({"sub": "federator", "exp": int(time.time()) + 60}, private_key, algorithm="RS256")
+
+    decode = jwt.decode
+    decoded = []
+    monkeypatch.setattr(jwt, "decode", lambda *args, **kwargs: decoded.append(args[0]) or decode(*args, **kwargs))
+
+    assert verifier.verify(token)["sub"] == "federator"
+    assert verifier.verify(token)["sub"] == "federator"
+    assert decoded == [token]
+
+    # Once past its `exp` the cached entry is dropped and the token verified again
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    verifier.verify(token)
+    assert decoded == [token, token]
+
+    expired = jwt.encode({"sub": "federator", "exp": int(now) - 1}, private_key, algorithm="RS256")
+    assert verifier.verify(expired) is None
+    assert verifier.verify("not a token") is None
+
+
+def test_rotated_key_is_reloaded(tmp_path):
+    old_private_key, old_public_pem = make_key_pair()
+    new_private_key, new_public_pem = make_key_pair()
+    key_path = tmp_path / "public_key.pem"
+    write_key(key_path, old_public_pem, 1_000_000)
+    verifier = TokenVerifier(str(key_path), required=True, reload_interval=0)
+    old_token = jwt.encode({"sub": "old"}, old_private_key, algorithm="RS256")
+    new_token = jwt.encode({"sub": "new"}, new_private_key, algorithm="RS256")
+    assert verifier.verify(old_token) is not None
+    assert verifier.verify(new_token) is None
+
+    write_key(key_path, new_public_pem, 2_000_000)
+    assert verifier.verify(new_token)["sub"] == "new"
+    assert verifier.verify(old_token) is None
+
+    # A broken key file keeps the key already loaded
+    write_key(key_path, b"", 3_000_000)
+    assert verifier.verify(new_token)["sub"] == "new"
+
+
+def test_missing_key_only_fails_outside_local_development(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        TokenVerifier(str(tmp_path / "missing.pem"), required=True)
+
+    verifier = TokenVerifier(str(tmp_path / "missing.pem"), required=False)
+    assert not verifier.is_auth_required
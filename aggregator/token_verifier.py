@@ -0,0 +1,123 @@
+"""
+JWT verification for the aggregator API, with a cache of verified tokens.
+
+The federator polls `/aggregated-data` with the same token until it expires, so verifying its RS256
+signature on every request repeats the same work. `TokenVerifier` instead:
+- parses the PEM public key into a key object once, rather than on every `jwt.decode`;
+- remembers each verified token, keyed by its SHA-256, until its `exp` (an LRU of at most `max_tokens`),
+  so a repeat request costs a hash and a dict lookup;
+- re-reads the key file when it changes (a rotated Kubernetes secret), checking at most every
+  `reload_interval` seconds, without restarting gunicorn workers. A new key empties the token cache,
+  and an unreadable one is ignored in favour of the key already loaded.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import jwt
+from cachetools import LRUCache
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+
+class TokenVerifier:
+    """Verifies RS256 JWTs against the public key at `key_path`, caching the ones that verify."""
+
+    def __init__(self, key_path, required, max_tokens=1024, reload_interval=10):
+        self.key_path = key_path
+        self.required = required
+        self.reload_interval = reload_interval
+        self.tokens = LRUCache(maxsize=max_tokens)
+        self.lock = threading.Lock()
+        self.key = None
+        self.key_stamp = None
+        self.next_check = time.monotonic() + reload_interval
+        try:
+            self.load_key()
+        except (FileNotFoundError, ValueError) as e:
+            if required:
+                raise
+            logging.error(f"Error loading public key: {e}")
+
+    def get_key_stamp(self):
+        # `stat` follows the `..data` symlink a secret mount swaps on rotation, so the stamp changes with it
+        stat = os.stat(self.key_path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load_key(self):
+        """Load and parse the key file; raises `FileNotFoundError`/`ValueError` if it's missing or invalid."""
+        stamp = self.get_key_stamp()
+        with open(self.key_path, "rb") as key_file:
+            pem = key_file.read().strip()
+        if not pem:
+            raise ValueError("Public key file is empty!")
+        key = load_pem_public_key(pem)
+
+        with self.lock:
+            self.key = key
+            self.key_stamp = stamp
+            self.tokens.clear()
+
+    def reload_key_if_changed(self):
+        """Re-read the key file if it changed since it was loaded; checked at most every `reload_interval` seconds."""
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.reload_interval
+
+        try:
+            changed = self.get_key_stamp() != self.key_stamp
+        except FileNotFoundError:
+            changed = False  # Mid-rotation, or never mounted; keep whatever key is loaded
+        if not changed:
+            return
+        try:
+            self.load_key()
+            logging.info(f"Reloaded public key from {self.key_path}.")
+        except (FileNotFoundError, ValueError) as e:
+            logging.error(f"Could not reload public key, keeping the previous one: {e}")
+
+    @property
+    def is_auth_required(self):
+        """Whether requests must carry a valid token: always outside local development, else once a key is loaded."""
+        return self.required or self.key is not None
+
+    def verify(self, token):
+        """The claims of `token` if it verifies (and hasn't expired), else `None`."""
+        self.reload_key_if_changed()
+        token_hash = hashlib.sha256(token.encode()).digest()
+        with self.lock:
+            cached = self.tokens.get(token_hash)
+            key = self.key
+        if cached is not None:
+            claims, expires_at = cached
+            if expires_at is None or time.time() < expires_at:
+                return claims
+            with self.lock:
+                self.tokens.pop(token_hash, None)
+
+        if key is None:
+            logging.error("Public key is not loaded, cannot verify JWT!")
+            return None
+        try:
+            claims = jwt.decode(token, key, algorithms=["RS256"])
+        except jwt.ExpiredSignatureError:
+            logging.error("JWT has expired.")
+            return None
+        except jwt.InvalidSignatureError:
+            logging.error("JWT signature verification failed!")
+            return None
+        except jwt.DecodeError:
+            logging.error("JWT decode failed, invalid format!")
+            return None
+        except Exception as e:
+            logging.error(f"Unexpected JWT error: {e}")
+            return None
+
+        with self.lock:
+            # A token verified against a key that has since been replaced isn't cached
+            if self.key is key:
+                self.tokens[token_hash] = (claims, claims.get("exp"))
+        return claims
@@ -1,3 +1,8 @@
+import { generateKeyPairSync } from 'node:crypto';
+import { mkdtempSync, writeFileSync } from 'node:fs';
+import { tmpdir } from 'node:os';
+import { join } from 'node:path';
+
 import _ from 'lodash';
 import request from 'supertest';
 
@@ -156,5 +161,79 @@ describe('create_app', () => {
 
       expect(response.body.errors).toHaveLength(2);
     });
+
+    it('Reuses one signed token across requests until it nears expiry', async () => {
+      const test_url = 'https://pt-1/aggregator';
+
+      const private_key_path = join(
+        mkdtempSync(join(tmpdir(), 'federator-test-')),
+        'private_key.pem',
+      );
+      const { privateKey } = generateKeyPairSync('rsa', { modulusLength: 2048 });
+      writeFileSync(
+        private_key_path,
+        privateKey.export({ type: 'pkcs8', format: 'pem' }) as string,
+      );
+
+      const authorization_headers: (string | null)[] = [];
+      fetchMock.mockIf(
+        ({ url }) => url.startsWith(test_url),
+        async (request) => {
+          authorization_headers.push(request.headers.get('Authorization'));
+          return JSON.stringify(valid_sample_data);
+        },
+      );
+
+      process.env = {
+        ...ORIGINAL_ENV,
+        AGGREGATOR_URLS: test_url,
+        PRIVATE_KEY_PATH: private_key_path,
+      };
+
+      const app = await create_app();
+
+      await request(app).get('/aggregated-data').send();
+      await request(app).get('/aggregated-data').send();
+
+      expect(authorization_headers).toHaveLength(2);
+      expect(authorization_headers[0]).toMatch(/^Bearer /);
+      expect(authorization_headers[1]).toEqual(authorization_headers[0]);
+    });
+
+    it('Retries an aggregator that answers 503 with a Retry-After, once', async () => {
+      const pt_1_test_url = 'https://pt-1/aggregator';
+      const pt_2_test_url = 'https://pt-2/aggregator';
+      const test_urls = [pt_1_test_url, pt_2_test_url];
+
+      const requests_per_url: Record<string, number> = {};
+      fetchMock.mockIf(
+        ({ url }) => test_urls.some((test_url) => url.startsWith(test_url)),
+        async ({ url }) => {
+          requests_per_url[url] = (requests_per_url[url] ?? 0) + 1;
+
+          // pt-1 is still starting up on the first request only, pt-2 on every request
+          if (url.startsWith(pt_2_test_url) || requests_per_url[url] === 1) {
+            return { status: 503, headers: { 'Retry-After': '0' }, body: '' };
+          }
+          return JSON.stringify(valid_sample_data);
+        },
+      );
+
+      process.env = {
+        ...ORIGINAL_ENV,
+        AGGREGATOR_URLS: test_urls.join(','),
+      };
+
+      const app = await create_app();
+
+      const response = await request(app).get('/aggregated-data').send();
+
+      expect(response.statusCode).toEqual(500);
+      expect(response.body.data).toHaveLength(valid_sample_data.length);
+      expect(response.body.errors).toEqual([
+        `Aggregator at ${pt_2_test_url}/aggregated-data has no aggregated data yet (503), try again later`,
+      ]);
+      expect(Object.values(requests_per_url)).toEqual([2, 2]);
+    });
   });
 });
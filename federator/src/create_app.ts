@@ -14,6 +14,67 @@ const get_private_key = _.memoize((private_key_path) =>
   readFileSync(private_key_path, 'utf8'),
 );
 
+const TOKEN_LIFETIME_SECONDS = 5 * 60;
+// A token is reused until this close to its expiry, so aggregators verify its signature once rather than per request
+const TOKEN_RENEWAL_MARGIN_SECONDS = 60;
+
+let current_token:
+  | { token: string; private_key_path: string; expires_at: number }
+  | undefined;
+
+const get_token = (private_key_path: string) => {
+  const now = Date.now() / 1000;
+  if (
+    current_token === undefined ||
+    current_token.private_key_path !== private_key_path ||
+    current_token.expires_at - now < TOKEN_RENEWAL_MARGIN_SECONDS
+  ) {
+    current_token = {
+      token: jwt.sign(
+        // TODO payload currently arbitrary, the asymetric signing/decrypting is all that matters right now.
+        // Consider a second layer, maybe a shared secret or a time-based OTP exchanged inside the JWT, any value to that?
+        { foo: 'bar' },
+        get_private_key(private_key_path),
+        {
+          algorithm: 'RS256',
+          expiresIn: TOKEN_LIFETIME_SECONDS,
+        },
+      ),
+      private_key_path,
+      expires_at: now + TOKEN_LIFETIME_SECONDS,
+    };
+  }
+  return current_token.token;
+};
+
+// An aggregator that has no result yet (e.g. just restarted) answers 503 with a `Retry-After`. Waits up to this
+// long for it, once, before reporting it as an error
+const MAX_RETRY_AFTER_SECONDS = 10;
+
+const fetch_aggregator = async (
+  aggregator_endpoint: string,
+  init: RequestInit,
+): Promise<Response> => {
+  const response = await fetch(aggregator_endpoint, init);
+
+  const retry_after = response.headers.get('Retry-After');
+  const retry_after_seconds = Number(retry_after);
+  if (
+    response.status !== 503 ||
+    retry_after === null ||
+    !Number.isFinite(retry_after_seconds) ||
+    retry_after_seconds < 0 ||
+    retry_after_seconds > MAX_RETRY_AFTER_SECONDS
+  ) {
+    return response;
+  }
+
+  await new Promise((resolve) =>
+    setTimeout(resolve, retry_after_seconds * 1000),
+  );
+  return fetch(aggregator_endpoint, init);
+};
+
 export const create_app = async () => {
   const app = express();
 
@@ -37,19 +98,10 @@ export const create_app = async () => {
 
         const token =
           PRIVATE_KEY_PATH !== undefined
-            ? jwt.sign(
-                // TODO payload currently arbitrary, the asymetric signing/decrypting is all that matters right now.
-                // Consider a second layer, maybe a shared secret or a time-based OTP exchanged inside the JWT, any value to that?
-                { foo: 'bar' },
-                get_private_key(PRIVATE_KEY_PATH),
-                {
-                  algorithm: 'RS256',
-                  expiresIn: '5m',
-                },
-              )
+            ? get_token(PRIVATE_KEY_PATH)
             : undefined;
 
-        const response = await fetch(aggregator_endpoint, {
+        const response = await fetch_aggregator(aggregator_endpoint, {
           ...(token ? { headers: { Authorization: `Bearer ${token}` } } : {}),
         });
 
@@ -63,6 +115,10 @@ export const create_app = async () => {
               `Aggregator at ${aggregator_endpoint} responded with incorrectly formatted data`,
             );
           }
+        } else if (response.status === 503) {
+          throw new Error(
+            `Aggregator at ${aggregator_endpoint} has no aggregated data yet (503), try again later`,
+          );
         } else {
           throw new Error(
             `Aggregator at ${aggregator_endpoint} responded with non-200 code (${response.status})`,